@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Measure exec mode runs end to end, against the stub toolchain in
+tests/stubs instead of the real pacstrap, arch-chroot and mkinitcpio. The
+stubs simulate the latency of the real tools, scaled by --scale.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from typing import Any, Callable, Dict, List
+
+import common
+
+from archstrap import run
+from archstrap.journal import journal_path
+from archstrap.specification import make_specification
+
+SYSTEM = {
+    "timezone": "UTC",
+    "locale": "en_US.UTF-8",
+    "charset": "UTF-8",
+    "keymap": "us",
+    "hostname": "bench",
+    "root_password": "bench",
+}
+
+
+def spec(kernels: List[str]) -> Dict[str, Any]:
+    return {
+        "packages": {"kernels": kernels, "extra": ["vim", "git"]},
+        "system": SYSTEM,
+        "initrd": {"presets": ["default", "fallback"]},
+    }
+
+
+def install(specification: Dict[str, Any], jobs: int) -> Callable[[], None]:
+    def fn():
+        with tempfile.TemporaryDirectory() as install_root:
+            run(
+                make_specification(specification),
+                "exec",
+                install_root,
+                jobs=jobs,
+                journal=journal_path(install_root),
+            )
+
+    return fn
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of times to run each benchmark (default: 3)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.1,
+        help="Factor to scale the stub tools' latencies by (default: 0.1)",
+    )
+    parser.add_argument(
+        "--history",
+        default=common.DEFAULT_HISTORY,
+        help=
+        f"JSON history file to add the results to (default: {common.DEFAULT_HISTORY})",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+
+    logging.disable(logging.INFO)
+    os.environ["PATH"] = os.pathsep.join([common.STUBS_DIR, os.environ["PATH"]])
+    os.environ["ARCHSTRAP_STUB_SCALE"] = str(args.scale)
+
+    one = spec(["linux"])
+    three = spec(["linux", "linux-lts", "linux-zen"])
+    benchmarks = {
+        "1-kernel/jobs=1": install(one, 1),
+        "1-kernel/jobs=4": install(one, 4),
+        "3-kernels/jobs=1": install(three, 1),
+        "3-kernels/jobs=4": install(three, 4),
+    }
+    results = {
+        name: common.measure(fn, args.repeat)
+        for name, fn in benchmarks.items()
+    }
+    for line in common.record(f"exec@{args.scale}", results, args.history):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Measure how long it takes to build specifications and apply them in dryrun
+and shell mode, for very large specifications and for many small ones.
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import sys
+from typing import Any, Callable, Dict, List
+
+import common
+
+from archstrap.mode import DryrunMode, ShellMode
+from archstrap.specification import make_specification
+
+SYSTEM = {
+    "timezone": "UTC",
+    "locale": "en_US.UTF-8",
+    "charset": "UTF-8",
+    "keymap": "us",
+    "hostname": "bench",
+    "root_password": "bench",
+}
+
+
+def large_spec() -> Dict[str, Any]:
+    return {
+        "packages": {
+            "extra": [f"package-{i}" for i in range(5000)],
+            "kernels": ["linux", "linux-lts", "linux-zen"],
+        },
+        "system": SYSTEM,
+        "initrd": {
+            "modules": [f"module-{i}" for i in range(300)],
+            "hooks": [f"hook-{i}" for i in range(300)],
+            "presets": ["default", "fallback"],
+        },
+    }
+
+
+def small_specs(count: int) -> List[Dict[str, Any]]:
+    return [{
+        "packages": {"extra": ["vim", f"package-{i}"]},
+        "system": {**SYSTEM, "hostname": f"host-{i}"},
+    } for i in range(count)]
+
+
+def apply(specs: List[Dict[str, Any]], mode: Callable) -> Callable[[], None]:
+    def fn():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for spec in specs:
+                make_specification(spec).apply("/mnt", mode())
+
+    return fn
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of times to run each benchmark (default: 5)",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=2000,
+        help="Number of small specifications (default: 2000)",
+    )
+    parser.add_argument(
+        "--history",
+        default=common.DEFAULT_HISTORY,
+        help=
+        f"JSON history file to add the results to (default: {common.DEFAULT_HISTORY})",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+
+    # Dryrun mode logs every command.
+    logging.disable(logging.INFO)
+
+    large = [large_spec()]
+    many = small_specs(args.count)
+    benchmarks = {
+        "large/make_specification": lambda: make_specification(large[0]),
+        "large/dryrun": apply(large, DryrunMode),
+        "large/shell": apply(large, ShellMode),
+        "many/make_specification": lambda: [
+            make_specification(spec) for spec in many
+        ],
+        "many/dryrun": apply(many, DryrunMode),
+        "many/shell": apply(many, ShellMode),
+    }
+    results = {
+        name: common.measure(fn, args.repeat)
+        for name, fn in benchmarks.items()
+    }
+    for line in common.record("plan", results, args.history):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+"""
+Timing and result history shared by the benchmarks.
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+STUBS_DIR = os.path.join(ROOT_DIR, "tests", "stubs", "bin")
+
+DEFAULT_HISTORY = os.path.join(BENCH_DIR, "history.json")
+
+# Changes smaller than this fraction are reported as noise.
+THRESHOLD = 0.10
+
+# Import the archstrap module from the source tree.
+sys.path.insert(0, SRC_DIR)
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> float:
+    """
+    The median wall time of `repeat` calls, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def record(suite: str, results: Dict[str, float], path: str) -> List[str]:
+    """
+    Append results to the history file, and describe how they compare to the
+    previous results of the same suite.
+    """
+    history = load_history(path)
+    previous = next(
+        (entry["results"] for entry in reversed(history)
+         if entry["suite"] == suite),
+        {},
+    )
+    history.append({
+        "suite": suite,
+        "timestamp": time.time(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "results": results,
+    })
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
+
+    lines = []
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        line = f"{name:<{width}}  {seconds * 1000:10.1f}ms"
+        if previous.get(name):
+            change = seconds / previous[name] - 1
+            line += f"  {change:+7.1%}"
+            if change > THRESHOLD:
+                line += "  REGRESSION"
+            elif change < -THRESHOLD:
+                line += "  improvement"
+        lines.append(line)
+    return lines
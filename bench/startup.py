@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Measure how long archstrap takes to start up and produce its output, for
+`--version` and for the shell and dryrun modes of the example specification.
+
+Cold runs start without any cached bytecode (each one gets an empty
+PYTHONPYCACHEPREFIX), like the first run after an install or upgrade. Warm
+runs follow a run that populated the bytecode cache.
+
+Fails if any case imports a module that only some runs need, such as sqlite3
+for the command history or tarfile for bundles.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Set
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_ARCHSTRAP = shlex.join([
+    sys.executable,
+    os.path.join(ROOT_DIR, "src", "__main__.py"),
+])
+EXAMPLE_SPEC = os.path.join(ROOT_DIR, "data", "example.spec.json")
+
+CASES = {
+    "version": ["--version"],
+    "shell": [EXAMPLE_SPEC, "--mode=shell", "--quiet"],
+    "dryrun": [EXAMPLE_SPEC, "--mode=dryrun", "--quiet"],
+}
+
+# Modules that only some runs need, and that none of the cases may import.
+LAZY_MODULES = [
+    "archstrap.bundle",
+    "archstrap.history",
+    "archstrap.syncdb",
+    "gzip",
+    "http.server",
+    "sqlite3",
+    "tarfile",
+    "urllib.request",
+]
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--archstrap",
+        default=DEFAULT_ARCHSTRAP,
+        help=
+        "Command to run archstrap with, e.g. './dist/archstrap.pyz' (default: the source tree)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="Number of cold and of warm runs of each case (default: 10)",
+    )
+    parser.add_argument(
+        "--json",
+        default=None,
+        help="Also write the results to this JSON file",
+    )
+    return parser.parse_args(argv)
+
+
+def timed(argv: List[str], env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        argv,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def measure(argv: List[str], runs: int) -> Dict[str, Dict[str, float]]:
+    cold = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as pycache:
+            env = {**os.environ, "PYTHONPYCACHEPREFIX": pycache}
+            cold.append(timed(argv, env))
+
+    with tempfile.TemporaryDirectory() as pycache:
+        env = {**os.environ, "PYTHONPYCACHEPREFIX": pycache}
+        timed(argv, env)
+        warm = [timed(argv, env) for _ in range(runs)]
+
+    return {
+        "cold": summarize(cold),
+        "warm": summarize(warm),
+    }
+
+
+def imported_modules(argv: List[str]) -> Set[str]:
+    """
+    The modules a run imports, from Python's import time report.
+    """
+    process = subprocess.run(
+        argv,
+        env={**os.environ, "PYTHONPROFILEIMPORTTIME": "1"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    modules = set()
+    for line in process.stderr.decode("utf-8").splitlines():
+        if line.startswith("import time:"):
+            modules.add(line.rsplit("|", 1)[-1].strip())
+    return modules
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+    }
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+    archstrap = shlex.split(args.archstrap)
+
+    unexpected = {}
+    for name, case in CASES.items():
+        modules = imported_modules([*archstrap, *case])
+        imported = [module for module in LAZY_MODULES if module in modules]
+        if imported:
+            unexpected[name] = imported
+
+    results = {}
+    print(f"{'CASE':<8}  {'COLD':>17}  {'WARM':>17}")
+    for name, case in CASES.items():
+        result = measure([*archstrap, *case], args.runs)
+        results[name] = result
+        cold = result["cold"]
+        warm = result["warm"]
+        print(
+            f"{name:<8}  "
+            f"{cold['median_ms']:7.1f}ms ({cold['min_ms']:5.1f})  "
+            f"{warm['median_ms']:7.1f}ms ({warm['min_ms']:5.1f})"
+        )
+    print("Median over all runs (minimum in parentheses)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "archstrap": args.archstrap,
+                "runs": args.runs,
+                "results": results,
+            }, f, indent=2)
+
+    for name, imported in unexpected.items():
+        print(f"{name} imports {', '.join(imported)}", file=sys.stderr)
+    return 1 if unexpected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
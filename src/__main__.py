@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import logging
 import os
 import sys
-from typing import List, Optional
+import zipimport
+from typing import TYPE_CHECKING, List, Optional
 
-from archstrap import run
-from archstrap.specification import Specification, make_specification
+from archstrap.defaults import (
+    DEFAULT_HISTORY_PATH,
+    DEFAULT_KEEP_JOBS,
+    DEFAULT_PACKAGE_CACHE_DIR,
+    DEFAULT_PROFILE_INTERVAL,
+    DEFAULT_SYNC_DIR,
+)
+
+if TYPE_CHECKING:
+    from archstrap.specification import Specification
+
+# The rest of archstrap and everything else that only some commands need are
+# imported where they are used, so that e.g. `--version` starts quickly.
 
 
 def runtime_dir():
@@ -19,20 +30,36 @@ def runtime_dir():
         return os.path.join(script_dir, "..")
 
 
+def read_readme() -> str:
+    loader = globals().get("__loader__")
+    if isinstance(loader, zipimport.zipimporter):
+        # Running from a zipapp, which contains the README.
+        return loader.get_data("README.md").decode("utf-8")
+    with open(README_PATH, "r") as f:
+        return f.read()
+
+
 ARCHSTRAP_VERSION = "0.0.1"
 
 README_PATH = os.path.join(runtime_dir(), "README.md")
 
 DEFAULT_INSTALL_ROOT = "/mnt"
 
+DEFAULT_FLEET_LOG_DIR = "archstrap-logs"
+
+DEFAULT_SERVE_SOCKET = "/run/archstrap.sock"
+
+DEFAULT_SERVE_TOKEN = "/run/archstrap.token"
+
+DEFAULT_SERVE_LOG_DIR = "archstrap-jobs"
+
 
 class DocumentationAction(argparse.Action):
     def __init__(self, option_strings, dest, **kwargs):
         super().__init__(option_strings, dest, nargs=0, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string=None):
-        with open(README_PATH, "r") as f:
-            print(f.read().rstrip())
+        print(read_readme().rstrip())
         parser.exit()
 
 
@@ -61,10 +88,96 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     )
     parser.add_argument(
         "--mode",
-        choices=("exec", "dryrun", "shell"),
+        choices=("exec", "dryrun", "shell", "ninja"),
         default="shell",
         help="Operational mode (default: shell)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=
+        "Maximum number of independent commands to run at once in exec mode (default: 1)",
+    )
+    parser.add_argument(
+        "--package-cache",
+        default=None,
+        help=
+        "Path to a host package cache shared between installs (default: from specification)",
+    )
+    parser.add_argument(
+        "--package-cache-size",
+        default=None,
+        help=
+        "Evict packages from the shared package cache beyond this size, e.g. 20G (default: from specification)",
+    )
+    parser.add_argument(
+        "--golden-dir",
+        default=None,
+        help=
+        "Path to a directory of golden root filesystems to clone instead of running pacstrap (default: from specification)",
+    )
+    parser.add_argument(
+        "--bundle",
+        default=None,
+        help=
+        "Path to a bundle made by `archstrap bundle` to install packages from instead of the mirrors (default: from specification)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=
+        "Skip commands that a previous, interrupted exec mode run already completed",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help=
+        "Write a Chrome trace event (Perfetto) JSON file of the commands run in exec mode",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help=
+        "Sample the CPU, memory, I/O and context switches of the commands run in exec mode, log a summary per section and per program, and write the samples to this JSON file",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=DEFAULT_PROFILE_INTERVAL,
+        help=
+        f"Seconds between samples for --profile (default: {DEFAULT_PROFILE_INTERVAL})",
+    )
+    parser.add_argument(
+        "--unsafe-fast-io",
+        action="store_true",
+        help=
+        "Make the fsync calls of pacstrap and mkinitcpio do nothing (needs libeatmydata on the host), and sync the install root once at the end; an install interrupted by a crash must be started over",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help=
+        "Record how long each command takes, and have exec mode estimate its progress from past runs",
+    )
+    parser.add_argument(
+        "--history-file",
+        default=DEFAULT_HISTORY_PATH,
+        help=
+        "Path to the database of past command durations (default: ~/.cache/archstrap/history.sqlite)",
+    )
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help=
+        "Resolve all packages and their dependencies against the host's sync databases first, and stop if any are missing",
+    )
+    parser.add_argument(
+        "--sync-dir",
+        default=DEFAULT_SYNC_DIR,
+        help=
+        f"Path to the pacman sync databases used by --preflight (default: {DEFAULT_SYNC_DIR})",
+    )
     log_level_group = parser.add_mutually_exclusive_group()
     log_level_group.add_argument(
         "--debug",
@@ -85,25 +198,558 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     return parser.parse_args(argv)
 
 
-def load_spec(specification: Optional[str]) -> Specification:
+def parse_fleet_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="archstrap fleet",
+        description=
+        "Apply many specifications to many install roots concurrently",
+    )
+    parser.add_argument(
+        "manifest",
+        help=
+        "Path to a JSON list of {specification, install_root, name} targets",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("exec", "dryrun", "shell", "ninja"),
+        default="shell",
+        help="Operational mode (default: shell)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help=
+        "Maximum number of targets to apply at once (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=
+        "Maximum number of independent commands to run at once per target in exec mode (default: 1)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=
+        "Skip commands that a previous, interrupted exec mode run already completed",
+    )
+    parser.add_argument(
+        "--log-dir",
+        default=DEFAULT_FLEET_LOG_DIR,
+        help=
+        f"Directory for per-target logs and output (default: {DEFAULT_FLEET_LOG_DIR})",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write a trace file for each target to the log directory",
+    )
+    parser.add_argument(
+        "--unsafe-fast-io",
+        action="store_true",
+        help=
+        "Make the fsync calls of pacstrap and mkinitcpio do nothing (needs libeatmydata on the host), and sync the install root once at the end; an install interrupted by a crash must be started over",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help=
+        "Record how long each command takes, and have exec mode estimate each target's progress from past runs",
+    )
+    parser.add_argument(
+        "--history-file",
+        default=DEFAULT_HISTORY_PATH,
+        help=
+        "Path to the database of past command durations (default: ~/.cache/archstrap/history.sqlite)",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_const",
+        const=logging.DEBUG,
+        default=logging.INFO,
+        dest="log_level",
+        help="Write debug log messages to the per-target logs",
+    )
+    return parser.parse_args(argv)
+
+
+def fleet_main(argv: List[str]):
+    from archstrap.fleet import load_manifest, run_fleet, summarize
+
+    args = parse_fleet_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = run_fleet(
+        load_manifest(args.manifest),
+        args.mode,
+        args.workers,
+        args.log_dir,
+        log_level=args.log_level,
+        jobs=args.jobs,
+        resume=args.resume,
+        trace=args.trace,
+        history=args.history_file if args.history else None,
+        unsafe_fast_io=args.unsafe_fast_io,
+        self_command=self_command(),
+    )
+    for line in summarize(results, args.log_dir):
+        print(line)
+
+    return 0 if all(result.ok for result in results) else 1
+
+
+def parse_serve_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="archstrap serve",
+        description=
+        "Accept jobs that apply a specification to an install root over a Unix socket (and optionally HTTP), and run them in a pool of workers",
+    )
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SERVE_SOCKET,
+        help=
+        f"Path of the Unix socket to listen on (default: {DEFAULT_SERVE_SOCKET})",
+    )
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        default=None,
+        help=
+        "Also listen for HTTP on this port of 127.0.0.1, accepting only requests with the bearer token in --token-file (default: Unix socket only)",
+    )
+    parser.add_argument(
+        "--token-file",
+        default=DEFAULT_SERVE_TOKEN,
+        help=
+        f"Path to write the bearer token for --http-port to, readable only by its owner (default: {DEFAULT_SERVE_TOKEN})",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("exec", "dryrun", "shell", "ninja"),
+        default="exec",
+        help="Operational mode of jobs that do not choose one (default: exec)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help=
+        "Maximum number of jobs to run at once (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=
+        "Maximum number of independent commands to run at once per job in exec mode, unless the job chooses (default: 1)",
+    )
+    parser.add_argument(
+        "--log-dir",
+        default=DEFAULT_SERVE_LOG_DIR,
+        help=
+        f"Directory for per-job logs and output (default: {DEFAULT_SERVE_LOG_DIR})",
+    )
+    parser.add_argument(
+        "--keep-jobs",
+        type=int,
+        default=DEFAULT_KEEP_JOBS,
+        help=
+        f"Number of finished jobs to remember; the logs and output of older jobs are removed (default: {DEFAULT_KEEP_JOBS})",
+    )
+    parser.add_argument(
+        "--unsafe-fast-io",
+        action="store_true",
+        help="Install with --unsafe-fast-io, unless the job chooses",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help=
+        "Record how long each command takes, and have exec mode estimate each job's progress from past runs",
+    )
+    parser.add_argument(
+        "--history-file",
+        default=DEFAULT_HISTORY_PATH,
+        help=
+        "Path to the database of past command durations (default: ~/.cache/archstrap/history.sqlite)",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_const",
+        const=logging.DEBUG,
+        default=logging.INFO,
+        dest="log_level",
+        help="Show debug log messages, and write them to the per-job logs",
+    )
+    return parser.parse_args(argv)
+
+
+def serve_main(argv: List[str]):
+    from archstrap.serve import JobQueue, serve
+
+    args = parse_serve_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    queue = JobQueue(
+        args.log_dir,
+        args.workers,
+        args.mode,
+        keep_jobs=args.keep_jobs,
+        log_level=args.log_level,
+        jobs=args.jobs,
+        history=args.history_file if args.history else None,
+        unsafe_fast_io=args.unsafe_fast_io,
+        self_command=self_command(),
+    )
+    serve(
+        queue,
+        args.socket,
+        ("127.0.0.1", args.http_port) if args.http_port else None,
+        args.token_file,
+    )
+    return 0
+
+
+def parse_bench_initrd_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="archstrap bench-initrd",
+        description=
+        "Compare initramfs compressors on an installed system and remember the results for \"compression\": \"auto\"",
+    )
+    parser.add_argument(
+        "specification",
+        default=None,
+        help="Path to specification file (default: stdin)",
+    )
+    parser.add_argument(
+        "--install-root",
+        default=DEFAULT_INSTALL_ROOT,
+        help=
+        f"Path to an installed Arch Linux system with a kernel (default: {DEFAULT_INSTALL_ROOT})",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help=
+        "Number of times to time each decompression, keeping the best (default: 3)",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_const",
+        const=logging.DEBUG,
+        default=logging.INFO,
+        dest="log_level",
+        help="Show debug log messages",
+    )
+    return parser.parse_args(argv)
+
+
+def bench_initrd_main(argv: List[str]):
+    from archstrap.initrd import (
+        GOALS,
+        BenchmarkCache,
+        benchmark,
+        choose,
+        kernel_package,
+        render_results,
+    )
+
+    args = parse_bench_initrd_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    spec = load_spec(args.specification)
+    kernel, results = benchmark(
+        spec.initrd.config(spec.packages.kernel_packages()),
+        args.install_root,
+        repeat=args.repeat,
+    )
+    BenchmarkCache(spec.initrd.benchmark_cache).save(
+        kernel,
+        results,
+        kernel_package(args.install_root, kernel),
+    )
+
+    print(f"Kernel {kernel}")
+    for line in render_results(results):
+        print(line)
+    for goal in GOALS:
+        print(f"Best for {goal}: {choose(results, goal).label}")
+
+    return 0
+
+
+def parse_bundle_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="archstrap bundle",
+        description=
+        "Write the packages of a specification and all of their dependencies into a single bundle file for offline installs",
+    )
+    parser.add_argument(
+        "specification",
+        help="Path to specification file (- for stdin)",
+    )
+    parser.add_argument("output", help="Path of the bundle to write")
+    parser.add_argument(
+        "--sync-dir",
+        default=DEFAULT_SYNC_DIR,
+        help=
+        f"Path to the pacman sync databases to resolve packages against (default: {DEFAULT_SYNC_DIR})",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="append",
+        default=None,
+        help=
+        f"Package cache to take packages from before downloading them; may be repeated (default: the specification's cache and {DEFAULT_PACKAGE_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--server",
+        action="append",
+        default=[],
+        help=
+        "Mirror URL to download packages from, in mirrorlist format; may be repeated (default: the specification's mirrors)",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_const",
+        const=logging.DEBUG,
+        default=logging.INFO,
+        dest="log_level",
+        help="Show debug log messages",
+    )
+    return parser.parse_args(argv)
+
+
+def bundle_main(argv: List[str]):
+    from archstrap.bundle import create_bundle
+
+    args = parse_bundle_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    spec = load_spec(args.specification)
+    cache_dirs = args.cache_dir
+    if cache_dirs is None:
+        cache_dirs = [spec.packages.cache] if spec.packages.cache else []
+        cache_dirs.append(DEFAULT_PACKAGE_CACHE_DIR)
+    servers = list(args.server)
+    repositories = None
+    architecture = "x86_64"
+    if spec.mirrors:
+        servers += spec.mirrors.servers
+        repositories = spec.mirrors.repositories
+        architecture = spec.mirrors.architecture
+
+    resolution = create_bundle(
+        spec.packages.packages(),
+        args.output,
+        args.sync_dir,
+        repositories,
+        cache_dirs,
+        servers,
+        architecture,
+    )
+    print(resolution.summary())
+
+    return 0
+
+
+def bundle_fetch_main(argv: List[str]):
+    from archstrap.bundle import fetch
+
+    # Run by pacman as its XferCommand, with the bundle, then pacman's %o
+    # and %u.
+    if len(argv) != 3:
+        print(
+            "usage: archstrap bundle-fetch BUNDLE OUTPUT URL",
+            file=sys.stderr,
+        )
+        return 2
+    try:
+        fetch(*argv)
+    except (OSError, ValueError) as e:
+        print(f"archstrap bundle-fetch: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def parse_rank_mirrors_args(argv: List[str]) -> argparse.Namespace:
+    from archstrap.mirrors import DEFAULT_RANKING_CACHE
+
+    parser = argparse.ArgumentParser(
+        prog="archstrap rank-mirrors",
+        description=
+        "Rank mirrors by how quickly they serve a repository database, and write them to a mirrorlist, best first; installs run this for specifications with ranked mirrors",
+    )
+    parser.add_argument(
+        "servers",
+        nargs="+",
+        help="Mirror URLs, in mirrorlist format",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Path to write the mirrorlist to",
+    )
+    parser.add_argument(
+        "--repository",
+        default="core",
+        help="Repository whose database to download (default: core)",
+    )
+    parser.add_argument(
+        "--architecture",
+        default="x86_64",
+        help="Architecture substituted for $arch (default: x86_64)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=5.0,
+        help="Seconds to wait for a mirror to respond (default: 5)",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=86400,
+        help=
+        "Seconds to reuse earlier probe results for before probing a mirror again (default: 86400)",
+    )
+    parser.add_argument(
+        "--ranking-cache",
+        default=DEFAULT_RANKING_CACHE,
+        help=
+        f"Path to the file of earlier probe results (default: {DEFAULT_RANKING_CACHE})",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_const",
+        const=logging.DEBUG,
+        default=logging.INFO,
+        dest="log_level",
+        help="Show debug log messages",
+    )
+    return parser.parse_args(argv)
+
+
+def rank_mirrors_main(argv: List[str]):
+    from archstrap.mirrors import write_ranked_mirrorlist
+
+    args = parse_rank_mirrors_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    write_ranked_mirrorlist(
+        args.output,
+        args.servers,
+        args.repository,
+        args.architecture,
+        args.timeout,
+        args.ranking_cache,
+        args.ttl,
+    )
+    return 0
+
+
+COMMANDS = {
+    "fleet": fleet_main,
+    "serve": serve_main,
+    "bench-initrd": bench_initrd_main,
+    "bundle": bundle_main,
+    "bundle-fetch": bundle_fetch_main,
+    "rank-mirrors": rank_mirrors_main,
+}
+
+
+def self_command() -> List[str]:
+    """
+    The command that runs this archstrap, from a source tree, a zipapp or a
+    PyInstaller build.
+    """
+    if getattr(sys, "frozen", False):
+        return [sys.executable]
+    return [sys.executable, os.path.abspath(sys.argv[0])]
+
+
+def load_spec(specification: Optional[str]) -> "Specification":
+    import json
+
+    from archstrap.layering import LOADER
+    from archstrap.specification import load_specification, make_specification
+
     if not specification or specification == "-":
-        spec = json.load(sys.stdin)
-    with open(specification, "r") as f:
-        spec = json.load(f)
-    return make_specification(spec)
+        # Files extended by a specification on stdin are relative to the
+        # working directory.
+        return make_specification(
+            LOADER.resolve(json.load(sys.stdin), os.getcwd())
+        )
+    return load_specification(specification)
+
+
+def preflight(spec: "Specification", sync_dir: str) -> bool:
+    from archstrap import syncdb
+
+    repositories = spec.mirrors.repositories if spec.mirrors else None
+    resolution = syncdb.preflight(
+        spec.packages.packages(),
+        sync_dir,
+        repositories,
+    )
+    for error in resolution.errors():
+        logging.error(error)
+    logging.info(resolution.summary())
+    return not resolution.missing
 
 
 def main(argv: List[str]):
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
     args = parse_args(argv)
 
+    from archstrap import run
+    from archstrap.journal import journal_path
+
     logging.basicConfig(level=args.log_level)
 
     spec = load_spec(args.specification)
+    if args.package_cache:
+        spec.packages.cache = args.package_cache
+    if args.package_cache_size:
+        spec.packages.cache_size = args.package_cache_size
+    if args.golden_dir:
+        spec.packages.golden = args.golden_dir
+    if args.bundle:
+        spec.packages.bundle = args.bundle
+    if args.mode == "exec":
+        # Generated scripts and ninja files run `archstrap` from the PATH of
+        # the host that runs them.
+        spec.use_command(self_command())
 
-    run(spec, args.mode, args.install_root)
+    if args.preflight and not preflight(spec, args.sync_dir):
+        return 1
+
+    run(
+        spec,
+        args.mode,
+        args.install_root,
+        jobs=args.jobs,
+        journal=journal_path(args.install_root),
+        resume=args.resume,
+        trace=args.trace,
+        profile=args.profile,
+        profile_interval=args.profile_interval,
+        history=args.history_file if args.history else None,
+        unsafe_fast_io=args.unsafe_fast_io,
+    )
 
     return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,63 @@
-from archstrap.mode import make_mode
-from archstrap.specification import Specification
+import logging
+from typing import TYPE_CHECKING, Optional
 
+from archstrap.defaults import DEFAULT_PROFILE_INTERVAL
 
-def run(specification: Specification, mode_name: str, install_root: str):
-    mode = make_mode(mode_name)
-    specification.apply(install_root, mode)
+if TYPE_CHECKING:
+    from archstrap.specification import Specification
+
+# Importing the package must stay cheap, since the command line imports its
+# defaults module for every command. What run() needs is imported in it.
+
+
+def run(
+    specification: "Specification",
+    mode_name: str,
+    install_root: str,
+    trace: Optional[str] = None,
+    profile: Optional[str] = None,
+    profile_interval: float = DEFAULT_PROFILE_INTERVAL,
+    history: Optional[str] = None,
+    unsafe_fast_io: bool = False,
+    **options,
+):
+    from archstrap.cache import PackageCache
+    from archstrap.mode import make_mode
+    from archstrap.profile import Profiler
+    from archstrap.trace import Tracer
+
+    if unsafe_fast_io:
+        specification.unsafe_fast_io = True
+    tracer = Tracer() if trace else None
+    if tracer:
+        options["tracer"] = tracer
+    profiler = Profiler(profile_interval) if profile else None
+    if profiler:
+        options["profiler"] = profiler
+    # Only exec mode runs commands, so other modes have nothing to time.
+    timings = None
+    if history and mode_name == "exec":
+        from archstrap.history import History
+
+        timings = History(history, install_root)
+        options["history"] = timings
+    mode = make_mode(mode_name, **options)
+
+    status = "error"
+    try:
+        specification.apply(install_root, mode)
+        status = 0
+    finally:
+        if tracer:
+            tracer.end(status)
+            tracer.write(trace)
+        if profiler:
+            profiler.write(profile)
+            for line in profiler.report():
+                logging.info("%s", line)
+        if timings:
+            timings.close()
+
+    packages = specification.packages
+    if mode_name == "exec" and packages.cache and packages.cache_size:
+        PackageCache(packages.cache, packages.cache_size).evict()
@@ -0,0 +1,312 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import shlex
+import struct
+import tarfile
+import tempfile
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from archstrap import syncdb
+from archstrap.defaults import DEFAULT_PACKAGE_CACHE_DIR, DEFAULT_SYNC_DIR
+
+BUNDLE_MAGIC = b"ARCHSTRAP-BUNDLE\n"
+
+# Index offset, index length and magic, at the very end of a bundle.
+TRAILER = struct.Struct("<QQ8s")
+TRAILER_MAGIC = b"ASBINDEX"
+
+# The repository that pacstrap installs a bundle's packages from. Its server
+# is never contacted: pacman asks the XferCommand for every file instead.
+REPOSITORY = "archstrap-bundle"
+DATABASE = f"{REPOSITORY}.db"
+SERVER = "https://archstrap-bundle.invalid"
+
+# The command pacman runs to read a file from a bundle, followed by the bundle
+# path, and pacman's output path and URL.
+FETCH_COMMAND = ["archstrap", "bundle-fetch"]
+
+COPY_CHUNK_SIZE = 2**20
+
+
+class BundleWriter:
+    """
+    Writes a bundle: the files added to it, one after the other, followed by
+    a JSON index of their offsets, sizes and SHA-256 digests, and a trailer
+    that locates the index. The bundle only appears under its final name once
+    it is complete.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path) or "."
+        fd, self._temp_path = tempfile.mkstemp(dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(BUNDLE_MAGIC)
+        self.index: Dict[str, Dict] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.unlink(self._temp_path)
+
+    def add(self, name: str, source: BinaryIO) -> str:
+        """
+        Stream a file into the bundle, returning its SHA-256 digest.
+        """
+        if name in self.index:
+            raise ValueError(f"Bundle already contains {name}")
+        offset = self._file.tell()
+        digest = hashlib.sha256()
+        while True:
+            chunk = source.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            self._file.write(chunk)
+        self.index[name] = {
+            "offset": offset,
+            "size": self._file.tell() - offset,
+            "sha256": digest.hexdigest(),
+        }
+        return digest.hexdigest()
+
+    def close(self):
+        index = json.dumps(self.index, sort_keys=True).encode("utf-8")
+        offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(TRAILER.pack(offset, len(index), TRAILER_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.chmod(self._temp_path, 0o644)
+        os.replace(self._temp_path, self.path)
+
+
+class Bundle:
+    """
+    A bundle opened for reading. Only the trailer and index are read up
+    front; files are copied straight out of the bundle when requested.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self.index = self._read_index()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _read_index(self) -> Dict[str, Dict]:
+        if self._file.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{self.path} is not an archstrap bundle")
+        self._file.seek(-TRAILER.size, os.SEEK_END)
+        offset, length, magic = TRAILER.unpack(self._file.read(TRAILER.size))
+        if magic != TRAILER_MAGIC:
+            raise ValueError(f"{self.path} is an incomplete archstrap bundle")
+        self._file.seek(offset)
+        return json.loads(self._file.read(length))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self) -> List[str]:
+        return sorted(self.index)
+
+    def copy(self, name: str, destination: BinaryIO):
+        """
+        Copy a file out of the bundle, in the kernel where possible.
+        """
+        entry = self.index.get(name)
+        if entry is None:
+            raise KeyError(f"{self.path} does not contain {name}")
+        offset, remaining = entry["offset"], entry["size"]
+        destination.flush()
+        try:
+            while remaining:
+                sent = os.sendfile(
+                    destination.fileno(),
+                    self._file.fileno(),
+                    offset,
+                    remaining,
+                )
+                if not sent:
+                    raise OSError(f"{self.path} ends before {name}")
+                offset += sent
+                remaining -= sent
+        except (AttributeError, io.UnsupportedOperation):
+            # No sendfile, or a destination that is not a file.
+            self._file.seek(offset)
+            while remaining:
+                chunk = self._file.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"{self.path} ends before {name}")
+                destination.write(chunk)
+                remaining -= len(chunk)
+
+    def read(self, name: str) -> bytes:
+        destination = io.BytesIO()
+        self.copy(name, destination)
+        return destination.getvalue()
+
+
+def render_pacman_conf(
+    bundle_path: str,
+    fetch_command: Iterable[str] = FETCH_COMMAND,
+) -> List[str]:
+    """
+    A pacman.conf that installs packages from a bundle only.
+    """
+    fetch = shlex.join([*fetch_command, os.path.abspath(bundle_path)])
+    return [
+        "[options]",
+        "HoldPkg = pacman glibc",
+        "Architecture = auto",
+        "CheckSpace",
+        f"XferCommand = {fetch} %o %u",
+        "SigLevel = Required DatabaseOptional",
+        "LocalFileSigLevel = Optional",
+        "",
+        f"[{REPOSITORY}]",
+        f"Server = {SERVER}",
+    ]
+
+
+def build_database(entries: Iterable[Tuple[str, Dict[str, bytes]]]) -> bytes:
+    """
+    A sync database of the given (directory, files) entries.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for directory, files in entries:
+            info = tarfile.TarInfo(directory)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            for filename, content in sorted(files.items()):
+                info = tarfile.TarInfo(f"{directory}/{filename}")
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def _open_package(
+    filename: str,
+    repository: str,
+    cache_dirs: Iterable[str],
+    servers: Iterable[str],
+    architecture: str,
+) -> BinaryIO:
+    for cache_dir in cache_dirs:
+        path = os.path.join(cache_dir, filename)
+        if os.path.isfile(path):
+            logging.debug("Bundling %s from %s", filename, path)
+            return open(path, "rb")
+
+    # Only needed when packages are actually downloaded, and slow to import.
+    import urllib.request
+
+    errors = []
+    for server in servers:
+        url = server.replace("$repo", repository)
+        url = url.replace("$arch", architecture)
+        url = f"{url.rstrip('/')}/{filename}"
+        try:
+            response = urllib.request.urlopen(url)
+        except OSError as e:
+            errors.append(f"{url}: {e}")
+            continue
+        logging.debug("Bundling %s from %s", filename, url)
+        return response
+    raise FileNotFoundError(
+        f"Cannot find {filename} in any package cache or mirror"
+        + "".join(f"\n  {error}" for error in errors)
+    )
+
+
+def create_bundle(
+    packages: Iterable[str],
+    output: str,
+    sync_dir: str = DEFAULT_SYNC_DIR,
+    repositories: Optional[Iterable[str]] = None,
+    cache_dirs: Iterable[str] = (DEFAULT_PACKAGE_CACHE_DIR, ),
+    servers: Iterable[str] = (),
+    architecture: str = "x86_64",
+    index_dir: str = syncdb.DEFAULT_INDEX_DIR,
+) -> syncdb.Resolution:
+    """
+    Resolve the dependency closure of `packages` against the host's sync
+    databases, and write those exact package files, taken from a package
+    cache or else downloaded from a mirror, into a bundle along with a
+    database of just those packages.
+    """
+    resolution = syncdb.preflight(packages, sync_dir, repositories, index_dir)
+    if resolution.missing:
+        raise ValueError("\n".join(resolution.errors()))
+
+    entries: List[Tuple[str, Dict[str, bytes], Dict[str, List[str]]]] = []
+    for repository, path in syncdb.find_databases(sync_dir, repositories):
+        for directory, entry in syncdb.read_entries(path).items():
+            fields = syncdb.parse_entry(entry)
+            package = resolution.packages.get(fields.get("NAME", [""])[0])
+            if package and package.repository == repository:
+                entries.append((directory, entry, fields))
+
+    with BundleWriter(output) as writer:
+        writer.add(
+            DATABASE,
+            io.BytesIO(
+                build_database(
+                    (directory, entry) for directory, entry, _ in entries
+                )
+            ),
+        )
+        for _, _, fields in entries:
+            filename = fields["FILENAME"][0]
+            package = resolution.packages[fields["NAME"][0]]
+            with _open_package(
+                filename,
+                package.repository,
+                cache_dirs,
+                servers,
+                architecture,
+            ) as source:
+                digest = writer.add(filename, source)
+            expected = fields.get("SHA256SUM", [digest])[0]
+            if digest != expected:
+                raise ValueError(
+                    f"{filename} has SHA-256 {digest} but its database entry "
+                    f"expects {expected}"
+                )
+    logging.info(
+        "Bundled %d packages into %s",
+        len(entries),
+        output,
+    )
+    return resolution
+
+
+def fetch(bundle_path: str, output: str, url: str):
+    """
+    Copy the file that pacman requests by URL out of a bundle.
+    """
+    name = url.rsplit("/", 1)[-1]
+    with Bundle(bundle_path) as bundle:
+        if name not in bundle.index:
+            raise FileNotFoundError(f"{bundle_path} does not contain {name}")
+        with open(output, "wb") as f:
+            bundle.copy(name, f)
+
@@ -0,0 +1,161 @@
+import contextlib
+import fcntl
+import logging
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Union
+
+from archstrap.vercmp import vercmp
+
+LOCK_FILE = ".archstrap.lock"
+
+PACKAGE_FILE_PATTERN = re.compile(
+    r"^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-(?P<arch>[^-]+)\.pkg\.tar(\.\w+)?$"
+)
+
+SIZE_SUFFIXES = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# Marks the cached files of every package installed in a root as used. Each
+# entry of the local database is named after the package and version, like the
+# cached file, less its architecture and extension.
+TOUCH_SCRIPT = """\
+for package in "$2"/var/lib/pacman/local/*/; do
+    package=${package%/}
+    touch -a -c "$1/${package##*/}"-*.pkg.tar*
+done"""
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """
+    Parse a size in bytes, optionally suffixed with K, M, G or T (powers of
+    1024).
+    """
+    if isinstance(size, int):
+        return size
+    match = re.match(r"^\s*(\d+)\s*([KMGT]?)i?B?\s*$", size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size '{size}'")
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def format_size(size: int) -> str:
+    """
+    Format a size in bytes with the largest suffix that parse_size accepts.
+    """
+    for suffix in ("T", "G", "M", "K"):
+        if size >= SIZE_SUFFIXES[suffix]:
+            return f"{size / SIZE_SUFFIXES[suffix]:.1f}{suffix}"
+    return str(size)
+
+
+def touch_command(path: str, root: str) -> List[str]:
+    """
+    Build a command that records the use of the packages installed in `root`
+    by the cache at `path`.
+
+    Use is recorded by setting access times explicitly, which works even where
+    reads do not update them (noatime, and relatime once a day).
+    """
+    return ["sh", "-c", TOUCH_SCRIPT, "sh", path, root]
+
+
+class CacheEntry:
+    def __init__(self, path: str, name: str, version: str):
+        self.path = path
+        self.name = name
+        self.version = version
+        self.files = [path]
+        if os.path.exists(f"{path}.sig"):
+            self.files.append(f"{path}.sig")
+
+        stats = [os.stat(f) for f in self.files]
+        self.size = sum(stat.st_size for stat in stats)
+        self.last_used = max(stats[0].st_atime, stats[0].st_mtime)
+
+
+class PackageCache:
+    """
+    A host-level pacman package cache that is shared by many installs.
+
+    Installs hold a lock on a file in the cache directory shared while they
+    run, and record the packages they used with `touch_command`. Eviction
+    holds the same lock exclusively, so that it never removes a package from
+    under an install.
+    """
+    def __init__(self, path: str, max_size: Optional[Union[int, str]] = None):
+        self.path = path
+        self.max_size = parse_size(max_size) if max_size is not None else None
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.path, LOCK_FILE)
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def entries(self) -> List[CacheEntry]:
+        entries = []
+        for name in os.listdir(self.path):
+            match = PACKAGE_FILE_PATTERN.match(name)
+            if match:
+                entries.append(
+                    CacheEntry(
+                        os.path.join(self.path, name),
+                        match.group("name"),
+                        match.group("version"),
+                    )
+                )
+        return entries
+
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries())
+
+    def evict(self) -> List[CacheEntry]:
+        """
+        Remove packages until the cache fits in `max_size`.
+
+        Every cached version of a package is a separate entry. Versions that
+        are older than another cached version of the same package, as compared
+        by pacman, are removed first, least recently used first, followed by
+        the remaining entries in least recently used order.
+        """
+        if self.max_size is None:
+            return []
+
+        with self.lock():
+            entries = self.entries()
+            newest: Dict[str, CacheEntry] = {}
+            for entry in entries:
+                current = newest.get(entry.name)
+                if not current or vercmp(entry.version, current.version) > 0:
+                    newest[entry.name] = entry
+
+            entries.sort(
+                key=lambda entry:
+                (newest[entry.name] is entry, entry.last_used, entry.path)
+            )
+
+            total = sum(entry.size for entry in entries)
+            evicted = []
+            for entry in entries:
+                if total <= self.max_size:
+                    break
+                logging.debug("Evicting %s from package cache", entry.path)
+                for f in entry.files:
+                    os.unlink(f)
+                total -= entry.size
+                evicted.append(entry)
+
+        logging.info(
+            "Evicted %d packages from package cache %s",
+            len(evicted),
+            self.path,
+        )
+        return evicted
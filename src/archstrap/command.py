@@ -0,0 +1,127 @@
+import shlex
+from typing import Iterable, List, Mapping, Optional
+
+
+class Command:
+    """
+    A program invocation: an argument vector, plus optional extra environment
+    variables, text to feed to its standard input, a file to redirect its
+    standard output to, and a root directory to run it inside of. Interactive
+    commands (like `passwd`) need the terminal.
+
+    Commands are run directly, without a shell. `render` produces the
+    equivalent shell syntax, with every user-supplied value quoted; commands
+    with a `chroot` render as a standalone `arch-chroot` invocation.
+    """
+    def __init__(
+        self,
+        argv: Iterable[str],
+        env: Optional[Mapping[str, str]] = None,
+        stdin: Optional[str] = None,
+        stdout: Optional[str] = None,
+        append: bool = False,
+        chroot: Optional[str] = None,
+        interactive: bool = False,
+    ):
+        self.argv = list(argv)
+        self.env = dict(env or {})
+        self.stdin = stdin
+        self.stdout = stdout
+        self.append = append
+        self.chroot = chroot
+        self.interactive = interactive
+
+    @staticmethod
+    def write(path: str, lines: Iterable[str], append: bool = False):
+        """
+        A command that writes lines of text to a file.
+        """
+        content = "".join(f"{line}\n" for line in lines)
+        return FileWrite(path, content, append=append)
+
+    def in_root(self, prefix: Iterable[str]) -> "Command":
+        """
+        The equivalent command outside of its root, run through `prefix`
+        (e.g. `["chroot", root]`).
+        """
+        return Command(
+            [*prefix, *self.argv],
+            self.env,
+            self.stdin,
+            self.stdout,
+            self.append,
+            interactive=self.interactive,
+        )
+
+    def render(self) -> str:
+        if self.chroot is not None:
+            return self.in_root(["arch-chroot", self.chroot]).render()
+
+        words: List[str] = [
+            f"{name}={shlex.quote(value)}"
+            for name, value in sorted(self.env.items())
+        ]
+        words += [shlex.quote(arg) for arg in self.argv]
+        if self.stdout is not None:
+            words += [">>" if self.append else ">", shlex.quote(self.stdout)]
+        if self.stdin is None:
+            return " ".join(words)
+
+        # A heredoc always ends with a newline, so content without a trailing
+        # newline gains one when rendered.
+        delimiter = _heredoc_delimiter(self.stdin)
+        body = self.stdin
+        if body and not body.endswith("\n"):
+            body += "\n"
+        return f"{' '.join(words)} <<'{delimiter}'\n{body}{delimiter}"
+
+    def _key(self):
+        return (
+            tuple(self.argv),
+            tuple(sorted(self.env.items())),
+            self.stdin,
+            self.stdout,
+            self.append,
+            self.chroot,
+            self.interactive,
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return f"Command({self.render()!r})"
+
+
+class FileWrite(Command):
+    """
+    A command that writes text to a file. It is equivalent to `cat` with the
+    text as its standard input, and renders that way, but modes that run
+    commands can write the file themselves instead of starting a process.
+    """
+    def __init__(self, path: str, content: str, append: bool = False):
+        super().__init__(["cat"], stdin=content, stdout=path, append=append)
+
+    @property
+    def path(self) -> str:
+        return self.stdout
+
+    @property
+    def content(self) -> str:
+        return self.stdin
+
+
+def _heredoc_delimiter(content: str) -> str:
+    lines = set(content.splitlines())
+    delimiter = "EOF"
+    index = 0
+    while delimiter in lines:
+        index += 1
+        delimiter = f"EOF_{index}"
+    return delimiter
@@ -0,0 +1,25 @@
+# Defaults shared by the command line and the modules that use them. This
+# module imports nothing else, so that the command line can read them without
+# loading the rest of archstrap.
+
+import os
+
+
+def user_cache_dir() -> str:
+    """
+    Directory for archstrap's own caches on the host.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "archstrap")
+
+
+DEFAULT_SYNC_DIR = "/var/lib/pacman/sync"
+
+DEFAULT_PACKAGE_CACHE_DIR = "/var/cache/pacman/pkg"
+
+DEFAULT_PROFILE_INTERVAL = 0.1
+
+DEFAULT_HISTORY_PATH = os.path.join(user_cache_dir(), "history.sqlite")
+
+# Finished jobs that the provisioning daemon remembers, along with their logs.
+DEFAULT_KEEP_JOBS = 100
@@ -0,0 +1,64 @@
+import os
+from typing import Dict
+
+from archstrap.command import Command
+from archstrap.journal import STATE_DIR
+from archstrap.mode import Mode
+
+# eatmydata's preload library, which turns fsync, fdatasync, sync and
+# O_SYNC/O_DSYNC opens into no-ops for the processes it is loaded into.
+LIBRARY = "libeatmydata.so"
+HOST_LIBRARY = os.path.join("/usr/lib", LIBRARY)
+
+# Where a copy of the library is put inside the install root, for commands
+# that run in it (such as pacman's install scriptlets).
+LIBRARY_DIR = os.path.join(STATE_DIR, "eatmydata")
+
+
+def library_dir(install_root: str) -> str:
+    return os.path.join(install_root, LIBRARY_DIR)
+
+
+def library_path(install_root: str) -> str:
+    return os.path.join(library_dir(install_root), LIBRARY)
+
+
+def environment() -> Dict[str, str]:
+    """
+    The environment that preloads the library both on the host and inside the
+    install root. The library is looked up by name: the host finds its own
+    copy in the default search path, where the directory of the copy inside
+    the root does not exist, and commands in the root find that copy.
+    """
+    return {
+        "LD_PRELOAD": LIBRARY,
+        "LD_LIBRARY_PATH": os.path.join("/", LIBRARY_DIR),
+    }
+
+
+def setup(install_root: str, mode: Mode, host_library: str = HOST_LIBRARY):
+    """
+    Copy the host's eatmydata library into the install root, for commands run
+    with `environment()` that read `library_path(install_root)`.
+    """
+    mode.on_section("Disable Fsync")
+    directory = library_dir(install_root)
+    mode.on_command(
+        Command(["mkdir", "-p", directory]),
+        writes=[directory],
+    )
+    mode.on_command(
+        Command(["cp", host_library, library_path(install_root)]),
+        reads=[directory],
+        writes=[library_path(install_root)],
+    )
+
+
+def finish(install_root: str, mode: Mode):
+    """
+    Remove the library from the install root, and flush everything written to
+    the install root's filesystem with a single syncfs.
+    """
+    mode.on_section("Sync")
+    mode.on_command(Command(["rm", "-rf", library_dir(install_root)]))
+    mode.on_command(Command(["sync", "--file-system", install_root]))
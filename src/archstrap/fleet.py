@@ -0,0 +1,230 @@
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from archstrap import run
+from archstrap.journal import journal_path
+from archstrap.specification import load_specification
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+
+class Target:
+    def __init__(self, name: str, specification: str, install_root: str):
+        self.name = name
+        self.specification = specification
+        self.install_root = install_root
+
+    def log_path(self, log_dir: str) -> str:
+        return os.path.join(log_dir, f"{self.name}.log")
+
+    def output_path(self, log_dir: str) -> str:
+        return os.path.join(log_dir, f"{self.name}.out")
+
+    def trace_path(self, log_dir: str) -> str:
+        return os.path.join(log_dir, f"{self.name}.trace.json")
+
+
+class Result:
+    def __init__(
+        self,
+        target: Target,
+        ok: bool,
+        duration: float,
+        error: Optional[str] = None,
+    ):
+        self.target = target
+        self.ok = ok
+        self.duration = duration
+        self.error = error
+
+
+def load_manifest(path: str) -> List[Target]:
+    """
+    Load the targets of a fleet manifest: a JSON list (or an object with a
+    `targets` list) of objects with `specification` and `install_root` keys,
+    and an optional unique `name`. Relative specification paths are resolved
+    against the manifest's directory.
+    """
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest["targets"]
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    targets = []
+    for entry in manifest:
+        install_root = entry["install_root"]
+        name = entry.get("name") or _default_name(install_root)
+        targets.append(
+            Target(
+                name,
+                os.path.join(base_dir, entry["specification"]),
+                install_root,
+            )
+        )
+
+    names = [target.name for target in targets]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate target names {', '.join(duplicates)}")
+    return targets
+
+
+def _default_name(install_root: str) -> str:
+    return install_root.strip("/").replace("/", "_") or "root"
+
+
+@contextlib.contextmanager
+def redirect_output(path: str) -> Iterator[None]:
+    """
+    Point file descriptors 1 and 2 at a file for the duration of the context,
+    so that the output of child processes, which inherit them, goes there too.
+    Python's own `sys.stdout` and `sys.stderr` are left alone. The file is
+    opened for appending, so that writes through other descriptors of it (such
+    as a logging handler's) are not overwritten.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        yield
+    finally:
+        os.close(fd)
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for descriptor in saved:
+            os.close(descriptor)
+
+
+def apply_target(
+    target: Target,
+    mode_name: str,
+    log_dir: str,
+    log_level: int = logging.INFO,
+    trace: bool = False,
+    self_command: Optional[List[str]] = None,
+    **options: Any,
+) -> Result:
+    """
+    Apply one target's specification, sending its log messages and the output
+    of the commands it runs to one file in `log_dir`, and its standard output
+    (e.g. the script generated in shell mode) to another. Intended to be run in
+    a worker process. `self_command`, if given, is how an install in exec
+    mode runs archstrap's helper commands.
+    """
+    log_path = target.log_path(log_dir)
+    open(log_path, "w").close()
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    handler = logging.FileHandler(log_path, mode="a")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger.addHandler(handler)
+    root_logger.setLevel(log_level)
+
+    start = time.monotonic()
+    try:
+        with open(target.output_path(log_dir), "w") as output:
+            with contextlib.redirect_stdout(output), redirect_output(log_path):
+                specification = load_specification(target.specification)
+                if self_command and mode_name == "exec":
+                    specification.use_command(self_command)
+                run(
+                    specification,
+                    mode_name,
+                    target.install_root,
+                    journal=journal_path(target.install_root),
+                    trace=target.trace_path(log_dir) if trace else None,
+                    **options,
+                )
+    except Exception as e:
+        logging.error("%s", traceback.format_exc().rstrip())
+        return Result(target, False, time.monotonic() - start, str(e))
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+    return Result(target, True, time.monotonic() - start)
+
+
+def run_fleet(
+    targets: Iterable[Target],
+    mode_name: str,
+    workers: int,
+    log_dir: str,
+    **options: Any,
+) -> List[Result]:
+    """
+    Apply every target in a pool of at most `workers` processes. Failures are
+    reported in the results rather than raised, so one broken target does not
+    stop the others.
+    """
+    targets = list(targets)
+    os.makedirs(log_dir, exist_ok=True)
+
+    results: Dict[str, Result] = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(
+                apply_target,
+                target,
+                mode_name,
+                log_dir,
+                **options,
+            ): target
+            for target in targets
+        }
+        for future in concurrent.futures.as_completed(futures):
+            target = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = Result(target, False, 0.0, str(e))
+            logging.info(
+                "%s %s in %.1fs",
+                "SUCCEEDED" if result.ok else "FAILED",
+                target.name,
+                result.duration,
+            )
+            results[target.name] = result
+
+    return [results[target.name] for target in targets]
+
+
+def summarize(results: Iterable[Result], log_dir: str) -> List[str]:
+    results = list(results)
+    rows = [("TARGET", "STATUS", "DURATION", "LOG")]
+    for result in results:
+        rows.append((
+            result.target.name,
+            "ok" if result.ok else "FAILED",
+            f"{result.duration:.1f}s",
+            result.target.log_path(log_dir),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    lines = [
+        "  ".join([*(row[i].ljust(widths[i]) for i in range(3)), row[3]])
+        for row in rows
+    ]
+
+    succeeded = sum(1 for result in results if result.ok)
+    total = sum(result.duration for result in results)
+    longest = max((result.duration for result in results), default=0.0)
+    lines.append(
+        f"{succeeded} succeeded, {len(results) - succeeded} failed, "
+        f"{total:.1f}s total, {longest:.1f}s longest"
+    )
+    for result in results:
+        if not result.ok:
+            lines.append(f"{result.target.name}: {result.error}")
+    return lines
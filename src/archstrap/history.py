@@ -0,0 +1,237 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from archstrap.command import Command
+from archstrap.defaults import DEFAULT_HISTORY_PATH
+from archstrap.scheduler import Step
+
+# Durations kept per command. The expected duration is their median, so one
+# unusually slow or fast run does not throw the estimate off.
+KEEP = 10
+
+# Seconds between progress reports while commands are running.
+PROGRESS_INTERVAL = 10.0
+
+ROOT_PLACEHOLDER = "<root>"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02}m"
+
+
+class History:
+    """
+    The durations of past commands, in a SQLite database shared by every run
+    on the host. Commands are keyed by a fingerprint of their rendered shell
+    syntax with the install root replaced, so that installs of the same
+    specification to different roots share their history.
+    """
+    def __init__(
+        self,
+        path: str = DEFAULT_HISTORY_PATH,
+        root: Optional[str] = None,
+    ):
+        self.path = path
+        self.root = root.rstrip("/") if root and root != "/" else None
+        # The root as a whole word of the rendered command, or the start of a
+        # path beneath it, but not as a prefix of another path like "/mnt2".
+        self._root_pattern = None
+        if self.root:
+            self._root_pattern = re.compile(
+                rf"(?<![^\s'\"=]){re.escape(self.root)}(?=[/\s'\"]|$)"
+            )
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Commands finish on the scheduler's threads, and fleets run many
+        # installs at once, each in its own process.
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS durations ("
+                    "fingerprint TEXT NOT NULL, "
+                    "command TEXT NOT NULL, "
+                    "duration REAL NOT NULL, "
+                    "recorded REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS durations_fingerprint "
+                    "ON durations (fingerprint, recorded)"
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def normalize(self, command: Command) -> str:
+        rendered = command.render()
+        if self._root_pattern:
+            rendered = self._root_pattern.sub(ROOT_PLACEHOLDER, rendered)
+        return rendered
+
+    def fingerprint(self, command: Command) -> str:
+        return hashlib.sha256(
+            self.normalize(command).encode("utf-8")
+        ).hexdigest()
+
+    def expected(self, command: Command) -> Optional[float]:
+        """
+        The median of the recorded durations of a command, or None if it has
+        never completed.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT duration FROM durations WHERE fingerprint = ? "
+                "ORDER BY duration",
+                (self.fingerprint(command), ),
+            ).fetchall()
+        if not rows:
+            return None
+        middle = len(rows) // 2
+        if len(rows) % 2:
+            return rows[middle][0]
+        return (rows[middle - 1][0] + rows[middle][0]) / 2
+
+    def record(self, command: Command, duration: float):
+        fingerprint = self.fingerprint(command)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO durations VALUES (?, ?, ?, ?)",
+                (fingerprint, self.normalize(command), duration, time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM durations WHERE fingerprint = ? AND rowid NOT IN "
+                "(SELECT rowid FROM durations WHERE fingerprint = ? "
+                "ORDER BY recorded DESC LIMIT ?)",
+                (fingerprint, fingerprint, KEEP),
+            )
+
+
+class Progress:
+    """
+    Follows the steps of a run against their expected durations, and logs
+    how many are done and how long the rest should take: when each step
+    finishes, and every `interval` seconds in between, along with the steps
+    that are still running and how long they usually take.
+
+    The estimate is the larger of the remaining work spread over all jobs and
+    the longest remaining chain of dependent steps. Steps that have never
+    completed count as instant, and are reported separately.
+    """
+    def __init__(
+        self,
+        steps: Sequence[Step],
+        expected: Sequence[Optional[float]],
+        critical_paths: Sequence[float],
+        jobs: int = 1,
+        interval: float = PROGRESS_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.steps = list(steps)
+        self.expected = list(expected)
+        self.critical_paths = list(critical_paths)
+        self.jobs = jobs
+        self.interval = interval
+        self.clock = clock
+        self.begun = clock()
+        self.started: Dict[int, float] = {}
+        self.finished: Dict[int, float] = {}
+        self._indices = {id(step): index for index, step in enumerate(steps)}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self):
+        self.begun = self.clock()
+        self._thread = threading.Thread(target=self._report, daemon=True)
+        self._thread.start()
+
+    def end(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            for line in self.status(running=True):
+                logging.info("%s", line)
+
+    def start(self, step: Step):
+        with self._lock:
+            self.started[self._indices[id(step)]] = self.clock()
+
+    def finish(self, step: Step):
+        with self._lock:
+            self.finished[self._indices[id(step)]] = self.clock()
+        for line in self.status():
+            logging.info("%s", line)
+
+    def remaining(self) -> Tuple[float, int]:
+        """
+        The expected seconds until the run finishes, and the number of
+        unfinished steps with no expected duration.
+        """
+        now = self.clock()
+        work, path, unknown = 0.0, 0.0, 0
+        with self._lock:
+            for index, expected in enumerate(self.expected):
+                if index in self.finished:
+                    continue
+                if expected is None:
+                    unknown += 1
+                    expected = 0.0
+                elapsed = now - self.started.get(index, now)
+                work += max(expected - elapsed, 0.0)
+                path = max(
+                    path,
+                    self.critical_paths[index] - min(elapsed, expected),
+                )
+        return max(path, work / self.jobs), unknown
+
+    def status(self, running: bool = False) -> List[str]:
+        eta, unknown = self.remaining()
+        now = self.clock()
+        line = (
+            f"PROGRESS {len(self.finished)}/{len(self.steps)} steps, "
+            f"{format_duration(now - self.begun)} elapsed, "
+            f"about {format_duration(eta)} left"
+        )
+        if unknown:
+            line += f", plus {unknown} never timed before"
+        lines = [line]
+        if running:
+            with self._lock:
+                active = [(index, start)
+                          for index, start in self.started.items()
+                          if index not in self.finished]
+            for index, start in sorted(active, key=lambda item: item[1]):
+                expected = self.expected[index]
+                usually = (
+                    "never timed before" if expected is None else
+                    f"usually {format_duration(expected)}"
+                )
+                lines.append(
+                    f"RUNNING {self.steps[index].command} for "
+                    f"{format_duration(now - start)} ({usually})"
+                )
+        return lines
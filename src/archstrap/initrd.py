@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from archstrap.command import Command
+from archstrap.defaults import user_cache_dir
+from archstrap.journal import STATE_DIR
+from archstrap.mode import spawn
+from archstrap.vercmp import version_key
+
+DEFAULT_BENCHMARK_CACHE = os.path.join(user_cache_dir(), "initrd.json")
+
+# What "compression": "auto" optimizes for.
+GOALS = ("build", "size", "boot")
+
+# Compressors and COMPRESSION_OPTIONS to benchmark.
+COMPRESSORS: List[Tuple[str, List[str]]] = [
+    ("zstd", ["-T0", "-1"]),
+    ("zstd", ["-T0", "-3"]),
+    ("zstd", ["-T0", "-19"]),
+    ("lz4", []),
+    ("lz4", ["-9"]),
+    ("xz", ["-T0"]),
+    ("xz", ["-T0", "-9"]),
+    ("gzip", ["-6"]),
+    ("gzip", ["-9"]),
+]
+
+# Flags that mkinitcpio itself passes to each compressor, so that the
+# benchmark produces the same images.
+COMPRESSOR_FLAGS = {
+    "zstd": ["-q"],
+    "lz4": ["-l"],
+    "xz": ["--check=crc32"],
+    "gzip": [],
+}
+
+# Used for "auto" until `archstrap bench-initrd` has been run.
+DEFAULT_CHOICES = {
+    "build": ("zstd", ["-T0", "-1"]),
+    "size": ("xz", ["-T0", "-9"]),
+    "boot": ("lz4", []),
+}
+
+
+class BenchResult:
+    def __init__(
+        self,
+        compression: str,
+        options: Iterable[str],
+        build_time: float,
+        size: int,
+        decompress_time: float,
+    ):
+        self.compression = compression
+        self.options = list(options)
+        self.build_time = build_time
+        self.size = size
+        self.decompress_time = decompress_time
+
+    @property
+    def label(self) -> str:
+        return " ".join([self.compression, *self.options])
+
+    def to_json(self) -> Dict:
+        return {
+            "compression": self.compression,
+            "options": self.options,
+            "build_time": self.build_time,
+            "size": self.size,
+            "decompress_time": self.decompress_time,
+        }
+
+    @staticmethod
+    def from_json(data: Dict) -> "BenchResult":
+        return BenchResult(**data)
+
+
+class BenchmarkCache:
+    """
+    Benchmark results persisted on the host, keyed by kernel version. Each
+    entry also names the kernel package it was measured for, if known, so
+    that installs can choose from them before the kernel is installed.
+    """
+    def __init__(self, path: str = DEFAULT_BENCHMARK_CACHE):
+        self.path = path
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(
+        self,
+        kernel: Optional[str] = None,
+        package: Optional[str] = None,
+    ) -> List[BenchResult]:
+        """
+        The results for a kernel version, for the most recently benchmarked
+        version of a kernel package, or for the most recently benchmarked
+        kernel if neither is given.
+        """
+        data = self._load()
+        if kernel is None:
+            candidates = [
+                key for key, entry in data.items()
+                if package is None or entry.get("package") == package
+            ]
+            if candidates:
+                kernel = max(
+                    candidates,
+                    key=lambda key: data[key]["timestamp"],
+                )
+        entry = data.get(kernel)
+        if not entry:
+            return []
+        return [BenchResult.from_json(result) for result in entry["results"]]
+
+    def save(
+        self,
+        kernel: str,
+        results: Iterable[BenchResult],
+        package: Optional[str] = None,
+    ):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        data = self._load()
+        data[kernel] = {
+            "timestamp": time.time(),
+            "package": package,
+            "results": [result.to_json() for result in results],
+        }
+
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+
+def choose(results: Iterable[BenchResult], goal: str) -> BenchResult:
+    """
+    The best result for a goal: the fastest build, the smallest image, or the
+    fastest decompression at boot. Ties go to the smaller image.
+    """
+    if goal not in GOALS:
+        raise ValueError(f"Unknown compression goal '{goal}'")
+    metric = {
+        "build": lambda result: (result.build_time, result.size),
+        "size": lambda result: (result.size, result.decompress_time),
+        "boot": lambda result: (result.decompress_time, result.size),
+    }[goal]
+    return min(results, key=metric)
+
+
+def kernel_version(install_root: str) -> Optional[str]:
+    """
+    The version of the newest kernel installed in a root, if any.
+    """
+    try:
+        versions = os.listdir(os.path.join(install_root, "usr/lib/modules"))
+    except OSError:
+        return None
+    return max(versions, key=version_key) if versions else None
+
+
+def kernel_package(install_root: str, kernel: str) -> Optional[str]:
+    """
+    The package that installed a kernel version, from the `pkgbase` file
+    that Arch kernel packages put next to their modules.
+    """
+    path = os.path.join(install_root, "usr/lib/modules", kernel, "pkgbase")
+    try:
+        with open(path, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def benchmark(
+    config: Iterable[str],
+    install_root: str,
+    compressors: Iterable[Tuple[str, List[str]]] = COMPRESSORS,
+    repeat: int = 3,
+) -> Tuple[str, List[BenchResult]]:
+    """
+    Build the initramfs for `config` (the lines of a mkinitcpio.conf) once
+    without compression, then compress and decompress that image with each
+    compressor. Timings are wall clock; decompression is the best of `repeat`
+    runs. Returns the kernel version and the results.
+    """
+    kernel = kernel_version(install_root)
+    if not kernel:
+        raise RuntimeError(f"No kernel installed in {install_root}")
+
+    bench_dir = os.path.join(install_root, STATE_DIR, "bench")
+    os.makedirs(bench_dir, exist_ok=True)
+    try:
+        conf = os.path.join(bench_dir, "mkinitcpio.conf")
+        image = os.path.join(bench_dir, "initramfs.cpio")
+        with open(conf, "w") as f:
+            for line in config:
+                if not line.startswith("COMPRESSION"):
+                    f.write(f"{line}\n")
+            f.write("COMPRESSION=\"cat\"\n")
+
+        start = time.monotonic()
+        spawn(
+            Command(
+                [
+                    "mkinitcpio",
+                    "--config",
+                    _chroot_path(install_root, conf),
+                    "--kernel",
+                    kernel,
+                    "--generate",
+                    _chroot_path(install_root, image),
+                ],
+                chroot=install_root,
+            )
+        )
+        logging.info(
+            "Built uncompressed initramfs for %s in %.2fs",
+            kernel,
+            time.monotonic() - start,
+        )
+
+        results = []
+        for compression, options in compressors:
+            compressed = f"{image}.{compression}"
+            build_time = _timed(
+                [compression, *COMPRESSOR_FLAGS[compression], *options, "-c"],
+                image,
+                compressed,
+            )
+            decompress_time = min(
+                _timed([compression, "-d", "-c"], compressed)
+                for _ in range(repeat)
+            )
+            result = BenchResult(
+                compression,
+                options,
+                build_time,
+                os.path.getsize(compressed),
+                decompress_time,
+            )
+            logging.info(
+                "%s: build %.2fs, size %d, decompress %.3fs",
+                result.label,
+                result.build_time,
+                result.size,
+                result.decompress_time,
+            )
+            results.append(result)
+            os.unlink(compressed)
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(bench_dir))
+        except OSError:
+            pass
+    return kernel, results
+
+
+def _chroot_path(install_root: str, path: str) -> str:
+    return "/" + os.path.relpath(path, install_root)
+
+
+def _timed(
+    argv: List[str],
+    stdin_path: str,
+    stdout_path: Optional[str] = None,
+) -> float:
+    with open(stdin_path, "rb") as stdin:
+        stdout = open(stdout_path, "wb") if stdout_path else None
+        try:
+            start = time.monotonic()
+            subprocess.run(
+                argv,
+                stdin=stdin,
+                stdout=stdout or subprocess.DEVNULL,
+                check=True,
+            )
+            return time.monotonic() - start
+        finally:
+            if stdout:
+                stdout.close()
+
+
+def render_results(results: Iterable[BenchResult]) -> List[str]:
+    rows = [("COMPRESSION", "BUILD", "SIZE", "DECOMPRESS")]
+    for result in results:
+        rows.append((
+            result.label,
+            f"{result.build_time:.2f}s",
+            f"{result.size / 2**20:.1f}M",
+            f"{result.decompress_time:.3f}s",
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    return [
+        "  ".join(row[i].ljust(widths[i]) for i in range(4)).rstrip()
+        for row in rows
+    ]
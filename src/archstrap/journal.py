@@ -0,0 +1,84 @@
+import collections
+import hashlib
+import os
+import threading
+from typing import Counter, Optional, TextIO
+
+# Location of archstrap's own bookkeeping, relative to the install root.
+STATE_DIR = ".archstrap"
+JOURNAL_FILE = "journal"
+
+
+def journal_path(install_root: str) -> str:
+    return os.path.join(install_root, STATE_DIR, JOURNAL_FILE)
+
+
+def fingerprint(command: str) -> str:
+    return hashlib.sha256(command.encode("utf-8")).hexdigest()
+
+
+class Journal:
+    """
+    Append-only record of the commands that have completed successfully. Each
+    entry is the fingerprint of a command, and is flushed to disk before the
+    next command starts so that the journal survives a crash.
+
+    When resuming, a command is considered done if an equal number of matching
+    entries remain in the journal; this keeps repeated identical commands
+    apart.
+    """
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.resume = resume
+        self.completed: Counter[str] = collections.Counter()
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        if self.resume and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.completed.update(line.strip() for line in f if line.strip())
+
+        self._file = open(self.path, "a" if self.resume else "w")
+        os.fsync(self._file.fileno())
+        fsync_directory(directory)
+
+    def done(self, command: str) -> bool:
+        """
+        Check whether a command was completed by a previous run. Each matching
+        journal entry is only consumed once.
+        """
+        key = fingerprint(command)
+        with self._lock:
+            if self.completed[key] > 0:
+                self.completed[key] -= 1
+                return True
+            return False
+
+    def record(self, command: str):
+        with self._lock:
+            self._file.write(fingerprint(command) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self, remove: bool = False):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if remove:
+            os.unlink(self.path)
+            try:
+                os.rmdir(os.path.dirname(self.path))
+            except OSError:
+                pass
+
+
+def fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
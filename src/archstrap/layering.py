@@ -0,0 +1,205 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+# Keys of a specification file that name other specification files to build
+# on. Neither is part of the resolved specification.
+LAYER_KEYS = ("extends", "include")
+
+# Operations that modify an inherited list instead of replacing it, applied in
+# this order.
+LIST_OPS = ("remove", "before", "after", "prepend", "append")
+
+# Parsed files, and resolved specifications, that a loader keeps.
+MEMO_SIZE = 256
+
+
+class ListOps:
+    """
+    Pending modifications of a list whose value is not known yet, e.g. an
+    overlay that appends to `hooks` on top of a base that leaves `hooks` at its
+    default.
+    """
+    def __init__(self, ops: Iterable[Mapping[str, Any]]):
+        self.ops = list(ops)
+
+    def apply(self, base: Optional[Iterable[Any]]) -> List[Any]:
+        result = list(base or [])
+        for op in self.ops:
+            result = _apply_list_op(op, result)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, ListOps) and self.ops == other.ops
+
+    def __repr__(self):
+        return f"ListOps({self.ops!r})"
+
+
+def is_list_op(value: Any) -> bool:
+    return (
+        isinstance(value, dict) and bool(value) and
+        all(key in LIST_OPS for key in value)
+    )
+
+
+def _apply_list_op(op: Mapping[str, Any], base: List[Any]) -> List[Any]:
+    remove = op.get("remove", [])
+    result = [item for item in base if item not in remove]
+    for key, offset in (("before", 0), ("after", 1)):
+        for anchor, items in op.get(key, {}).items():
+            if anchor not in result:
+                raise ValueError(f"Cannot insert {key} missing item '{anchor}'")
+            index = result.index(anchor) + offset
+            result[index:index] = items
+    return [*op.get("prepend", []), *result, *op.get("append", [])]
+
+
+def merge(base: Any, overlay: Any) -> Any:
+    """
+    Merge an overlay onto a base value, returning a new value:
+
+    - Objects are merged key by key. A key set to null in the overlay is
+      removed.
+    - An object of list operations (`remove`, `before`, `after`, `prepend`,
+      `append`) modifies the base list.
+    - Anything else in the overlay, including a list, replaces the base.
+    """
+    if is_list_op(overlay):
+        if isinstance(base, list):
+            return _apply_list_op(overlay, base)
+        if isinstance(base, ListOps):
+            return ListOps([*base.ops, overlay])
+        return ListOps([overlay])
+    if isinstance(base, dict) and isinstance(overlay, dict):
+        result = dict(base)
+        for key, value in overlay.items():
+            if value is None:
+                result.pop(key, None)
+            elif key in result:
+                result[key] = merge(result[key], value)
+            else:
+                result[key] = merge(None, value)
+        return result
+    if isinstance(overlay, dict):
+        return merge({}, overlay)
+    return overlay
+
+
+class _Memo:
+    """
+    A mapping that keeps only its `size` most recently used entries.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class SpecificationLoader:
+    """
+    Loads specification files, resolving the files they extend and include.
+
+    A file's layers are merged in order: every file in `extends`, then every
+    file in `include`, then the file's own content. Paths are relative to the
+    file that names them.
+
+    Parsed files and resolved specifications are memoized by content hash: a
+    resolved specification is reused as long as no file in its chain has
+    changed, so a base shared by many overlays is parsed and merged once.
+    Files are read on every load, so a changed file is never served from the
+    memo. Only the `memo_size` most recently used entries of each kind are
+    kept, so that a long-running process does not grow with every version of
+    every file it has loaded. Resolved specifications are shared between
+    callers and must not be modified.
+    """
+    def __init__(self, memo_size: int = MEMO_SIZE):
+        self._parsed = _Memo(memo_size)
+        self._resolved = _Memo(memo_size)
+        self._lock = threading.Lock()
+
+    def load(self, path: str) -> Dict[str, Any]:
+        return self._load(os.path.abspath(path), ())[1]
+
+    def resolve(self, data: Mapping[str, Any], base_dir: str) -> Dict[str, Any]:
+        """
+        Resolve a specification that did not come from a file, e.g. from stdin.
+        """
+        layers = [
+            self._load(os.path.join(base_dir, path), ())[1]
+            for path in _layer_paths(data)
+        ]
+        return _merge_layers(layers, data)
+
+    def _load(self, path: str, stack: Tuple[str, ...]) -> Tuple[str, Dict]:
+        if path in stack:
+            chain = " -> ".join([*stack, path])
+            raise ValueError(f"Specification extends itself: {chain}")
+
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        with self._lock:
+            data = self._parsed.get(digest)
+        if data is None:
+            data = json.loads(content)
+            with self._lock:
+                self._parsed.put(digest, data)
+
+        base_dir = os.path.dirname(path)
+        parents = [
+            self._load(os.path.join(base_dir, parent), (*stack, path))
+            for parent in _layer_paths(data)
+        ]
+        key = hashlib.sha256(
+            "\n".join([digest, *(parent_key for parent_key, _ in parents)])
+            .encode("utf-8")
+        ).hexdigest()
+
+        with self._lock:
+            resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = _merge_layers([layer for _, layer in parents], data)
+            with self._lock:
+                self._resolved.put(key, resolved)
+        return key, resolved
+
+
+def _layer_paths(data: Mapping[str, Any]) -> List[str]:
+    paths = []
+    for key in LAYER_KEYS:
+        value = data.get(key, [])
+        paths += [value] if isinstance(value, str) else list(value)
+    return paths
+
+
+def _merge_layers(
+    layers: Iterable[Dict[str, Any]],
+    data: Mapping[str, Any],
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    for layer in layers:
+        result = merge(result, layer)
+    own = {key: value for key, value in data.items() if key not in LAYER_KEYS}
+    return merge(result, own)
+
+
+LOADER = SpecificationLoader()
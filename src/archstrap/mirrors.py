@@ -0,0 +1,237 @@
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from archstrap.defaults import user_cache_dir
+
+DEFAULT_RANKING_CACHE = os.path.join(user_cache_dir(), "mirrors.json")
+
+PROBE_CHUNK_SIZE = 64 * 2**10
+
+# The command that ranks mirrors and writes the mirrorlist when the install
+# runs, followed by its options and the servers.
+RANK_COMMAND = ["archstrap", "rank-mirrors"]
+
+
+class ProbeResult:
+    def __init__(
+        self,
+        server: str,
+        latency: Optional[float] = None,
+        throughput: Optional[float] = None,
+        error: Optional[str] = None,
+        timestamp: Optional[float] = None,
+    ):
+        self.server = server
+        self.latency = latency
+        self.throughput = throughput
+        self.error = error
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_json(self) -> Dict:
+        return {
+            "latency": self.latency,
+            "throughput": self.throughput,
+            "error": self.error,
+            "timestamp": self.timestamp,
+        }
+
+    @staticmethod
+    def from_json(server: str, data: Dict) -> "ProbeResult":
+        return ProbeResult(server, **data)
+
+
+def probe_url(server: str, repository: str, architecture: str) -> str:
+    url = server.replace("$repo", repository).replace("$arch", architecture)
+    return f"{url.rstrip('/')}/{repository}.db"
+
+
+def probe(
+    server: str,
+    repository: str = "core",
+    architecture: str = "x86_64",
+    timeout: float = 5.0,
+    max_bytes: int = 2**20,
+) -> ProbeResult:
+    """
+    Measure a mirror by downloading (at most `max_bytes` of) its database for
+    `repository`. Latency is the time until the response headers arrive, and
+    throughput is the rate at which the body was received.
+    """
+    # Only needed when mirrors are actually probed, and slow to import.
+    import http.client
+    import urllib.request
+
+    url = probe_url(server, repository, architecture)
+    try:
+        start = time.monotonic()
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            latency = time.monotonic() - start
+            received = 0
+            while received < max_bytes:
+                chunk = response.read(min(PROBE_CHUNK_SIZE, max_bytes - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = time.monotonic() - start - latency
+    except (OSError, http.client.HTTPException) as e:
+        # A mirror that drops the connection or sends a malformed response
+        # ranks last, like one that cannot be reached.
+        logging.debug("Failed to probe mirror %s: %s", url, e)
+        return ProbeResult(server, error=str(e))
+
+    throughput = received / elapsed if elapsed > 0 else float(received)
+    logging.debug(
+        "Probed mirror %s: latency %.3fs, throughput %.0f B/s",
+        url,
+        latency,
+        throughput,
+    )
+    return ProbeResult(server, latency, throughput)
+
+
+class RankingCache:
+    """
+    Probe results persisted on the host, so that repeated runs within `ttl`
+    seconds do not probe the same mirrors again. Results are kept apart by
+    the repository and architecture that were probed, since a mirror may
+    serve one much better than another.
+    """
+    def __init__(
+        self,
+        path: str = DEFAULT_RANKING_CACHE,
+        ttl: float = 86400,
+        repository: str = "core",
+        architecture: str = "x86_64",
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.scope = f"{repository}/{architecture}"
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self) -> Dict[str, ProbeResult]:
+        now = time.time()
+        results = {
+            server: ProbeResult.from_json(server, result)
+            for server, result in self._load().get(self.scope, {}).items()
+        }
+        return {
+            server: result
+            for server, result in results.items()
+            if now - result.timestamp < self.ttl
+        }
+
+    def save(self, results: Iterable[ProbeResult]):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        data = self._load()
+        scope = self.load()
+        scope.update((result.server, result) for result in results)
+        data[self.scope] = {
+            server: result.to_json()
+            for server, result in scope.items()
+        }
+
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+
+def rank(
+    servers: Iterable[str],
+    cache: Optional[RankingCache] = None,
+    probe: Callable[[str], ProbeResult] = probe,
+    jobs: int = 8,
+) -> List[str]:
+    """
+    Order servers from best to worst: fastest throughput first, then lowest
+    latency. Servers that could not be probed are kept, but placed last.
+    """
+    servers = list(servers)
+    cached = cache.load() if cache else {}
+    stale = [server for server in servers if server not in cached]
+
+    probed = []
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            probed = list(executor.map(probe, stale))
+        if cache:
+            cache.save(probed)
+
+    results = {**cached, **{result.server: result for result in probed}}
+
+    def key(server: str):
+        result = results[server]
+        if not result.ok:
+            return (1, 0.0, 0.0)
+        return (0, -result.throughput, result.latency)
+
+    return sorted(servers, key=key)
+
+
+def write_ranked_mirrorlist(
+    path: str,
+    servers: Iterable[str],
+    repository: str = "core",
+    architecture: str = "x86_64",
+    timeout: float = 5.0,
+    ranking_cache: str = DEFAULT_RANKING_CACHE,
+    ttl: float = 86400,
+):
+    """
+    Rank servers and write them to a mirrorlist, best first.
+    """
+    servers = rank(
+        servers,
+        RankingCache(ranking_cache, ttl, repository, architecture),
+        functools.partial(
+            probe,
+            repository=repository,
+            architecture=architecture,
+            timeout=timeout,
+        ),
+    )
+    with open(path, "w") as f:
+        f.write("".join(f"{line}\n" for line in render_mirrorlist(servers)))
+
+
+def render_mirrorlist(servers: Iterable[str]) -> List[str]:
+    return [
+        "# Generated by archstrap",
+        *(f"Server = {server}" for server in servers),
+    ]
+
+
+def render_pacman_conf(
+    mirrorlist: str,
+    repositories: Iterable[str],
+    parallel_downloads: int,
+) -> List[str]:
+    lines = [
+        "[options]",
+        "HoldPkg = pacman glibc",
+        "Architecture = auto",
+        "CheckSpace",
+        f"ParallelDownloads = {parallel_downloads}",
+        "SigLevel = Required DatabaseOptional",
+        "LocalFileSigLevel = Optional",
+    ]
+    for repository in repositories:
+        lines += ["", f"[{repository}]", f"Include = {mirrorlist}"]
+    return lines
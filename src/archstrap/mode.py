@@ -1,6 +1,34 @@
+import contextlib
+import functools
 import logging
+import os
+import resource
+import shlex
+import stat
 import subprocess
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+from archstrap.command import Command, FileWrite
+from archstrap.journal import Journal, fsync_directory
+from archstrap.profile import Profiler
+from archstrap.scheduler import Scheduler, Step
+from archstrap.trace import Span, Tracer
+
+if TYPE_CHECKING:
+    # Only runs with a history import it, along with sqlite3.
+    from archstrap.history import History, Progress
 
 
 class Mode(ABC):
@@ -12,45 +40,434 @@ class Mode(ABC):
         pass
 
     @abstractmethod
-    def on_command(self, command: str):
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
+        """
+        Handle a single command. `reads` and `writes` name the resources
+        (usually paths) the command depends on and produces; a command that
+        declares neither is ordered after everything before it.
+        """
         pass
 
     def on_end(self):
         pass
 
 
-def make_mode(name: str) -> Mode:
+class ChrootSession:
+    """
+    The API filesystems that commands inside an install root need, mounted
+    once for all of them instead of once per command as `arch-chroot` does.
+    Commands then only need a plain `chroot`.
+    """
+
+    # (type, source, target relative to the root, options)
+    MOUNTS = [
+        ("proc", "proc", "proc", "nosuid,noexec,nodev"),
+        ("sysfs", "sys", "sys", "nosuid,noexec,nodev,ro"),
+        ("devtmpfs", "udev", "dev", "mode=0755,nosuid"),
+        ("devpts", "devpts", "dev/pts", "mode=0620,gid=5,nosuid,noexec"),
+        ("tmpfs", "shm", "dev/shm", "mode=1777,nosuid,nodev"),
+        ("tmpfs", "run", "run", "nosuid,nodev,mode=0755"),
+        ("tmpfs", "tmp", "tmp", "mode=1777,strictatime,nodev,nosuid"),
+    ]
+
+    def __init__(self, root: str):
+        self.root = root
+        self.active = False
+
+    def setup(self) -> List[Command]:
+        return [
+            Command([
+                "mount",
+                "--types",
+                fstype,
+                "--options",
+                options,
+                source,
+                os.path.join(self.root, target),
+            ]) for fstype, source, target, options in self.MOUNTS
+        ]
+
+    def teardown(self) -> List[Command]:
+        return [
+            Command(["umount", os.path.join(self.root, target)])
+            for _, _, target, _ in reversed(self.MOUNTS)
+        ]
+
+    def wrap(self, command: Command) -> Command:
+        return command.in_root(["chroot", self.root])
+
+
+def make_mode(
+    name: str,
+    jobs: int = 1,
+    journal: Optional[str] = None,
+    resume: bool = False,
+    tracer: Optional[Tracer] = None,
+    profiler: Optional[Profiler] = None,
+    history: Optional["History"] = None,
+) -> Mode:
     """
     Instantiate the appropriate Mode based on the specified name.
     """
     if name == "exec":
-        return ExecMode()
+        return ExecMode(
+            jobs=jobs,
+            journal=Journal(journal, resume) if journal else None,
+            tracer=tracer,
+            profiler=profiler,
+            history=history,
+        )
     elif name == "dryrun":
         return DryrunMode()
     elif name == "shell":
         return ShellMode()
+    elif name == "ninja":
+        return NinjaMode()
     else:
         raise ValueError(f"Unknown mode '{name}'")
 
 
+def spawn(
+    command: Command,
+    monitor: Optional[Callable[[int], ContextManager]] = None,
+) -> resource.struct_rusage:
+    """
+    Run a command to completion, without a shell, and return the resources
+    used by it and its descendants. Raises CalledProcessError if it fails.
+
+    `monitor`, if given, is called with the process ID once the process has
+    started, and its context lasts until the process has exited but before it
+    is reaped, while its final state can still be read from /proc.
+    """
+    if command.chroot is not None:
+        command = command.in_root(["arch-chroot", command.chroot])
+
+    stdout = None
+    if command.stdout is not None:
+        stdout = open(command.stdout, "a" if command.append else "w")
+    try:
+        process = subprocess.Popen(
+            command.argv,
+            env={**os.environ, **command.env} if command.env else None,
+            stdin=subprocess.PIPE if command.stdin is not None else None,
+            stdout=stdout,
+        )
+    finally:
+        if stdout:
+            stdout.close()
+
+    with monitor(process.pid) if monitor else contextlib.nullcontext():
+        if command.stdin is not None:
+            try:
+                process.stdin.write(command.stdin.encode("utf-8"))
+            except BrokenPipeError:
+                pass
+            process.stdin.close()
+        if monitor:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command.argv)
+    return rusage
+
+
+def write_file(write: FileWrite) -> bool:
+    """
+    Write a file without starting a process. The new content is written to a
+    temporary file next to it, flushed to disk and renamed into place, so the
+    file is never seen half-written. Returns False, without touching the file,
+    if it already had the resulting content.
+    """
+    content = write.content.encode("utf-8")
+    try:
+        with open(write.path, "rb") as f:
+            info: Optional[os.stat_result] = os.fstat(f.fileno())
+            existing: Optional[bytes] = f.read()
+    except FileNotFoundError:
+        existing = None
+        info = None
+
+    if write.append:
+        content = (existing or b"") + content
+    if content == existing:
+        return False
+
+    directory = os.path.dirname(write.path) or "."
+    fd, temp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(write.path)}.",
+        dir=directory,
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            if info:
+                os.fchmod(f.fileno(), stat.S_IMODE(info.st_mode))
+                os.fchown(f.fileno(), info.st_uid, info.st_gid)
+            else:
+                os.fchmod(f.fileno(), 0o644)
+            os.fsync(f.fileno())
+        os.replace(temp_path, write.path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+    return True
+
+
 class ExecMode(Mode):
+    def __init__(
+        self,
+        jobs: int = 1,
+        journal: Optional[Journal] = None,
+        tracer: Optional[Tracer] = None,
+        profiler: Optional[Profiler] = None,
+        history: Optional["History"] = None,
+    ):
+        self.jobs = jobs
+        self.journal = journal
+        self.tracer = tracer
+        self.profiler = profiler
+        self.history = history
+        self.progress: Optional["Progress"] = None
+        # Progress needs every step up front, so with a history even a
+        # single job runs the steps from the scheduler, in their order.
+        self.scheduler = Scheduler(jobs) if jobs > 1 or history else None
+        self.section: Optional[str] = None
+        self.sessions: Dict[str, ChrootSession] = {}
+        self._sessions_lock = threading.Lock()
+
+    def on_begin(self):
+        if self.tracer:
+            self.tracer.begin()
+        if self.journal:
+            self.journal.open()
+
     def on_section(self, section: str):
         logging.info("SECTION %s", section)
+        self.section = section
+
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
+        step = Step(command, reads, writes, self.section)
+        if self.scheduler:
+            self.scheduler.add(step)
+            return
+        try:
+            self.execute(step)
+        except BaseException:
+            self._finish(succeeded=False)
+            raise
+
+    def on_end(self):
+        succeeded = False
+        try:
+            if self.scheduler:
+                self._run_scheduler()
+            succeeded = True
+        finally:
+            self._finish(succeeded)
+
+    def _finish(self, succeeded: bool):
+        try:
+            self.end_sessions()
+        finally:
+            if self.journal:
+                # Kept after a failure, so that --resume can skip the
+                # commands that completed.
+                self.journal.close(remove=succeeded)
+
+    def session(
+        self,
+        root: str,
+        section: Optional[str] = None,
+    ) -> ChrootSession:
+        with self._sessions_lock:
+            session = self.sessions.get(root)
+            if not session:
+                # Registered before mounting, so that a partial setup is
+                # still torn down.
+                session = ChrootSession(root)
+                self.sessions[root] = session
+                with self._session_span(root, section) as span:
+                    for command in session.setup():
+                        logging.info("COMMAND %s", command)
+                        spawn(command)
+                    span.status = 0
+                session.active = True
+            return session
+
+    def end_sessions(self):
+        with self._sessions_lock:
+            for session in self.sessions.values():
+                for command in session.teardown():
+                    logging.info("COMMAND %s", command)
+                    try:
+                        spawn(command)
+                    except subprocess.CalledProcessError as e:
+                        logging.warning("Failed to unmount: %s", e)
+                session.active = False
+            self.sessions = {}
+
+    def _run_scheduler(self):
+        if not self.history:
+            self.scheduler.run(self.execute)
+            return
+
+        from archstrap.history import Progress
 
-    def on_command(self, command: str):
+        expected = [
+            self.history.expected(step.command)
+            for step in self.scheduler.steps
+        ]
+        critical_paths = self.scheduler.critical_paths([
+            cost or 0.0 for cost in expected
+        ])
+        self.progress = Progress(
+            self.scheduler.steps,
+            expected,
+            critical_paths,
+            self.jobs,
+        )
+        self.progress.begin()
+        try:
+            self.scheduler.run(
+                self.execute,
+                critical_paths if self.jobs > 1 else None,
+            )
+        finally:
+            self.progress.end()
+            self.progress = None
+
+    def execute(self, step: Step):
+        if not self.progress:
+            self._execute(step)
+            return
+        self.progress.start(step)
+        try:
+            self._execute(step)
+        finally:
+            self.progress.finish(step)
+
+    def _execute(self, step: Step):
+        rendered = step.command.render()
+        skip = self.journal is not None and self.journal.done(rendered)
+        if step.command.chroot is not None and not skip:
+            # Mounted before the step starts, so that its span, profile and
+            # history do not include the mounts.
+            self.session(step.command.chroot, step.section)
+        start = time.monotonic()
+        with self._span(step) as span:
+            if skip:
+                logging.info("SKIP %s", step.command)
+                span.status = "skipped"
+                return
+            command = step.command
+            if isinstance(command, FileWrite):
+                logging.info("WRITE %s", command.path)
+                if not write_file(command):
+                    logging.info("UNCHANGED %s", command.path)
+                span.status = 0
+            else:
+                self._spawn(command, span, step.section)
+        if self.journal:
+            self.journal.record(rendered)
+        if self.history:
+            self.history.record(step.command, time.monotonic() - start)
+
+    def _spawn(
+        self,
+        command: Command,
+        span: Span,
+        section: Optional[str] = None,
+    ):
+        profile = None
+        if self.profiler:
+            profile = self.profiler.profile(
+                span.name,
+                section,
+                os.path.basename(command.argv[0]),
+            )
+        if command.chroot is not None:
+            command = self.session(command.chroot).wrap(command)
         logging.info("COMMAND %s", command)
-        subprocess.check_call(command, shell=True)
+        try:
+            if profile:
+                rusage = spawn(
+                    command,
+                    functools.partial(self.profiler.monitor, profile),
+                )
+            else:
+                rusage = spawn(command)
+        except subprocess.CalledProcessError as e:
+            span.status = e.returncode
+            if profile:
+                profile.status = e.returncode
+            raise
+        span.cpu = rusage.ru_utime + rusage.ru_stime
+        span.status = 0
+        if profile:
+            profile.finish(rusage)
+
+    def _span(self, step: Step):
+        name = step.command.render()
+        if not self.tracer:
+            return contextlib.nullcontext(Span(name, "command"))
+        return self.tracer.span(name, section=step.section)
+
+    def _session_span(self, root: str, section: Optional[str]):
+        name = f"mount {root}"
+        if not self.tracer:
+            return contextlib.nullcontext(Span(name, "session"))
+        return self.tracer.span(name, "session", section)
 
 
 class DryrunMode(Mode):
+    def __init__(self):
+        self.sessions: Dict[str, ChrootSession] = {}
+
     def on_section(self, section: str):
         logging.info("SECTION %s", section)
 
-    def on_command(self, command: str):
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
+        if command.chroot is not None:
+            session = self.sessions.get(command.chroot)
+            if not session:
+                session = ChrootSession(command.chroot)
+                for setup in session.setup():
+                    logging.info("COMMAND %s", setup)
+                self.sessions[command.chroot] = session
+            command = session.wrap(command)
         logging.info("COMMAND %s", command)
 
+    def on_end(self):
+        for session in self.sessions.values():
+            for command in session.teardown():
+                logging.info("COMMAND %s", command)
+        self.sessions = {}
+
 
 class ShellMode(Mode):
+    def __init__(self):
+        self.sessions: Dict[str, ChrootSession] = {}
+
     def on_begin(self):
         print("#!/usr/bin/bash")
         print("set -xeuo pipefail")
@@ -60,6 +477,149 @@ class ShellMode(Mode):
         print()
         print("#", section)
 
-    def on_command(self, command: str):
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
+        logging.info("COMMAND %s", command)
+        if command.chroot is not None:
+            command = self._session(command.chroot).wrap(command)
+        print(command.render())
+
+    def _session(self, root: str) -> ChrootSession:
+        session = self.sessions.get(root)
+        if session:
+            return session
+
+        session = ChrootSession(root)
+        self.sessions[root] = session
+        for command in session.setup():
+            print(command.render())
+        # Unmount everything when the script exits, whether or not it failed.
+        # A failed step may have left a mount busy or already unmounted it,
+        # so the trap carries on past failures (`set -e` would stop it at the
+        # first one) and falls back to a lazy unmount.
+        trap = ["set +e"]
+        for session in self.sessions.values():
+            for command in session.teardown():
+                lazy = Command([command.argv[0], "--lazy", *command.argv[1:]])
+                trap.append(f"{command.render()} || {lazy.render()}")
+        print("trap", shlex.quote("; ".join(trap)), "EXIT")
+        return session
+
+
+class NinjaMode(Mode):
+    """
+    Outputs a Ninja build file instead of a script. Every command is a build
+    edge that depends on the edges that the scheduler would make it wait for,
+    so `ninja -j N` runs independent commands in parallel, and running it
+    again only reruns commands whose inputs changed or that failed.
+
+    Each edge's only output is a stamp file in `stamp_dir`, touched once the
+    command succeeds. The files a command writes are not outputs, since some
+    commands (like `systemd-firstboot`) leave a file's mtime alone, which
+    would make its edge dirty on every run. Commands inside the install root
+    run through `arch-chroot`, since edges cannot share mounts. Interactive
+    commands run in the `console` pool, which gives them the terminal.
+    """
+    def __init__(self, stamp_dir: str = "archstrap.stamps"):
+        self.stamp_dir = stamp_dir
+        self.scheduler = Scheduler()
+        self.section: Optional[str] = None
+
+    def on_section(self, section: str):
+        logging.info("SECTION %s", section)
+        self.section = section
+
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
         logging.info("COMMAND %s", command)
-        print(command)
+        self.scheduler.add(Step(command, reads, writes, self.section))
+
+    def on_end(self):
+        for line in self.render():
+            print(line)
+        self.scheduler = Scheduler()
+
+    def render(self) -> List[str]:
+        lines = [
+            "# Generated by archstrap. Run with `ninja -f FILE`.",
+            "ninja_required_version = 1.3",
+            "",
+            "rule run",
+            "  command = $cmd",
+            "  description = $desc",
+        ]
+        stamps: List[str] = []
+        for index, step in enumerate(self.scheduler.steps):
+            stamp = os.path.join(self.stamp_dir, f"{index:04d}.stamp")
+            stamps.append(stamp)
+            command = _single_line(step.command)
+            command = f"{command} && touch {shlex.quote(stamp)}"
+
+            inputs = [
+                stamps[dependency]
+                for dependency in sorted(self.scheduler.dependencies[index])
+            ]
+            description = _describe(step.command)
+            if step.section:
+                description = f"[{step.section}] {description}"
+            lines += [
+                "",
+                "build {}: run{}".format(
+                    _ninja_path(stamp),
+                    "".join(f" {_ninja_path(path)}" for path in inputs),
+                ),
+                f"  cmd = {_ninja_escape(command)}",
+                f"  desc = {_ninja_escape(description)}",
+            ]
+            if step.command.interactive:
+                lines.append("  pool = console")
+
+        lines += [
+            "",
+            "build all: phony{}".format(
+                "".join(f" {_ninja_path(path)}" for path in stamps)
+            ),
+            "default all",
+        ]
+        return lines
+
+
+def _single_line(command: Command) -> str:
+    """
+    The shell syntax of a command on a single line, as Ninja requires.
+    Commands that span several lines (with a heredoc, or a multi-line script)
+    are passed to `sh -c` through printf instead.
+    """
+    rendered = command.render()
+    if "\n" not in rendered:
+        return rendered
+    escaped = rendered.replace("\\", "\\\\").replace("\n", "\\n")
+    return f'sh -c "$(printf %b {shlex.quote(escaped)})"'
+
+
+def _describe(command: Command) -> str:
+    if command.stdin is not None:
+        command = Command(
+            command.argv,
+            command.env,
+            stdout=command.stdout,
+            append=command.append,
+            chroot=command.chroot,
+        )
+    return command.render().splitlines()[0]
+
+
+def _ninja_escape(text: str) -> str:
+    return text.replace("$", "$$")
+
+
+def _ninja_path(path: str) -> str:
+    return _ninja_escape(path).replace(" ", "$ ").replace(":", "$:")
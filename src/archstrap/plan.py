@@ -0,0 +1,221 @@
+import logging
+from typing import Callable, Iterable, List, Optional
+
+from archstrap.command import Command, FileWrite
+from archstrap.mode import Mode
+from archstrap.scheduler import Step
+
+
+class Plan(Mode):
+    """
+    The sections and commands of a specification, recorded in order instead
+    of being run, so that the whole command stream can be optimized before it
+    is replayed into another mode.
+
+    The optimization passes rely on the resources each command declares, just
+    as the scheduler does: steps that share no resource may be reordered.
+    """
+    def __init__(self, steps: Iterable[Step] = ()):
+        self.steps = list(steps)
+        self.section: Optional[str] = None
+
+    def on_section(self, section: str):
+        self.section = section
+
+    def on_command(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+    ):
+        self.steps.append(Step(command, reads, writes, self.section))
+
+    def optimize(
+        self,
+        passes: Optional[Iterable[Callable[[List[Step]], List[Step]]]] = None,
+    ) -> "Plan":
+        steps = list(self.steps)
+        for optimization in PASSES if passes is None else passes:
+            steps = optimization(steps)
+        logging.debug(
+            "Optimized plan from %d to %d steps",
+            len(self.steps),
+            len(steps),
+        )
+        return Plan(steps)
+
+    def replay(self, mode: Mode):
+        section = None
+        for step in self.steps:
+            if step.section is not None and step.section != section:
+                section = step.section
+                mode.on_section(section)
+            mode.on_command(step.command, reads=step.reads, writes=step.writes)
+
+
+def deduplicate(steps: List[Step]) -> List[Step]:
+    """
+    Drop a step that repeats an earlier one, as long as nothing in between
+    wrote any of its resources. Steps without declared resources, and appends
+    to files, are never dropped.
+    """
+    result: List[Step] = []
+    for step in steps:
+        if step.declared and not step.command.append:
+            resources = [*step.reads, *step.writes]
+            duplicate = False
+            for previous in reversed(result):
+                if _key(previous) == _key(step):
+                    duplicate = True
+                    break
+                if not previous.declared:
+                    break
+                if _overlaps(previous.writes, resources):
+                    break
+            if duplicate:
+                continue
+        result.append(step)
+    return result
+
+
+def merge_writes(steps: List[Step]) -> List[Step]:
+    """
+    Fold an append to a file into an earlier write of the same file in the
+    same section, when no step in between depends on either of them.
+    """
+    result: List[Step] = []
+    for step in steps:
+        if isinstance(step.command, FileWrite) and step.command.append:
+            for index in reversed(range(len(result))):
+                previous = result[index]
+                if (
+                    isinstance(previous.command, FileWrite) and
+                    previous.command.path == step.command.path and
+                    previous.section == step.section
+                ):
+                    result[index] = Step(
+                        FileWrite(
+                            previous.command.path,
+                            previous.command.content + step.command.content,
+                            append=previous.command.append,
+                        ),
+                        _union(previous.reads, step.reads),
+                        _union(previous.writes, step.writes),
+                        previous.section,
+                    )
+                    step = None
+                    break
+                if _conflicts(previous, step):
+                    break
+        if step:
+            result.append(step)
+    return result
+
+
+def drop_overwritten_writes(steps: List[Step]) -> List[Step]:
+    """
+    Drop a write of a file that a later write replaces before any step reads
+    it.
+    """
+    dropped = set()
+    for index, step in enumerate(steps):
+        if not isinstance(step.command, FileWrite) or step.command.append:
+            continue
+        path = [step.command.path]
+        for later in steps[index + 1:]:
+            if (
+                isinstance(later.command, FileWrite) and
+                not later.command.append and
+                later.command.path == step.command.path
+            ):
+                dropped.add(index)
+                break
+            if not later.declared or _overlaps(later.reads, path):
+                break
+    return [step for index, step in enumerate(steps) if index not in dropped]
+
+
+def batch_chroot(steps: List[Step]) -> List[Step]:
+    """
+    Combine adjacent steps that run inside the same root into a single shell
+    invocation in that root. Only steps that would have to run one after the
+    other anyway are combined, so no parallelism is lost.
+    """
+    result: List[Step] = []
+    batch: List[Step] = []
+
+    def flush():
+        if len(batch) == 1:
+            result.append(batch[0])
+        elif batch:
+            result.append(_batch(batch))
+        batch.clear()
+
+    for step in steps:
+        if step.command.chroot is None:
+            flush()
+            result.append(step)
+            continue
+        if batch and not (
+            batch[-1].command.chroot == step.command.chroot and
+            batch[-1].section == step.section and
+            _conflicts(batch[-1], step)
+        ):
+            flush()
+        batch.append(step)
+    flush()
+    return result
+
+
+PASSES = [
+    deduplicate,
+    merge_writes,
+    drop_overwritten_writes,
+    batch_chroot,
+]
+
+
+def _batch(steps: List[Step]) -> Step:
+    script = "\n".join([
+        "set -e",
+        *(step.command.in_root([]).render() for step in steps),
+    ])
+    command = Command(
+        ["sh", "-c", script],
+        chroot=steps[0].command.chroot,
+        interactive=any(step.command.interactive for step in steps),
+    )
+    if not all(step.declared for step in steps):
+        return Step(command, section=steps[0].section)
+    reads: List[str] = []
+    writes: List[str] = []
+    for step in steps:
+        reads = _union(reads, step.reads)
+        writes = _union(writes, step.writes)
+    return Step(command, reads, writes, steps[0].section)
+
+
+def _key(step: Step):
+    return (step.command, tuple(step.reads), tuple(step.writes))
+
+
+def _union(first: Iterable[str], second: Iterable[str]) -> List[str]:
+    result = list(first)
+    result += [resource for resource in second if resource not in result]
+    return result
+
+
+def _overlaps(first: Iterable[str], second: Iterable[str]) -> bool:
+    return not set(first).isdisjoint(second)
+
+
+def _conflicts(first: Step, second: Step) -> bool:
+    """
+    Whether one of the steps must run before the other.
+    """
+    return (
+        not first.declared or
+        not second.declared or
+        _overlaps(first.writes, [*second.reads, *second.writes]) or
+        _overlaps(second.writes, first.reads)
+    )
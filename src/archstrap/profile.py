@@ -0,0 +1,338 @@
+import contextlib
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from archstrap.cache import format_size
+from archstrap.defaults import DEFAULT_PROFILE_INTERVAL
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Counters in /proc/<pid>/io that are summed over a process tree.
+IO_FIELDS = ("read_bytes", "write_bytes", "rchar", "wchar")
+
+
+def read_stat(pid: int, proc: str = "/proc") -> Optional[Dict[str, int]]:
+    """
+    The parent, resident set size and I/O counters of a process, or None if it
+    is gone. The I/O counters are zero where they cannot be read.
+    """
+    try:
+        with open(os.path.join(proc, str(pid), "stat")) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name is in parentheses and may contain spaces.
+    fields = stat[stat.rfind(")") + 2:].split()
+    usage = {"ppid": int(fields[1]), "rss": int(fields[21]) * PAGE_SIZE}
+
+    counters = dict.fromkeys(IO_FIELDS, 0)
+    try:
+        with open(os.path.join(proc, str(pid), "io")) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    usage.update(counters)
+    return usage
+
+
+def _children(proc: str) -> Dict[int, List[int]]:
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir(proc):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, entry, "stat")) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def process_tree(pid: int, proc: str = "/proc") -> List[int]:
+    """
+    A process and all of its descendants. Uses the children lists of the
+    kernel where it has them, and otherwise scans every process.
+    """
+    if os.path.exists(os.path.join(proc, str(pid), "task", str(pid),
+                                   "children")):
+        tree = [pid]
+        for parent in tree:
+            for path in glob.glob(
+                    os.path.join(proc, str(parent), "task", "*", "children")):
+                try:
+                    with open(path) as f:
+                        tree.extend(int(child) for child in f.read().split())
+                except OSError:
+                    pass
+        return tree
+
+    children = _children(proc)
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+class Profile:
+    """
+    The resources used by a command and all of its child processes.
+
+    CPU time and context switches come from the kernel's accounting when the
+    command exits. Memory and I/O are sampled from /proc while it runs: the
+    peak resident set size is the largest sum over the process tree at any one
+    sample, and the I/O counters are the largest sums seen (the kernel adds
+    the counters of an exited child to its parent's, so they only go up).
+    `read_bytes` and `write_bytes` count storage I/O; `rchar` and `wchar`
+    count every read and write, including from the page cache, pipes and
+    sockets.
+    """
+    def __init__(
+        self,
+        name: str,
+        section: Optional[str] = None,
+        program: Optional[str] = None,
+    ):
+        self.name = name
+        self.section = section
+        self.program = program
+        self.count = 1
+        self.wall = 0.0
+        self.user = 0.0
+        self.system = 0.0
+        self.peak_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.rchar = 0
+        self.wchar = 0
+        self.voluntary_switches = 0
+        self.involuntary_switches = 0
+        self.samples = 0
+        self.status: Optional[Union[int, str]] = None
+
+    @property
+    def cpu(self) -> float:
+        return self.user + self.system
+
+    @property
+    def utilization(self) -> float:
+        """
+        CPU time per second of wall time; above 1 when using several cores.
+        """
+        return self.cpu / self.wall if self.wall else 0.0
+
+    def sample(self, usages: Iterable[Dict[str, int]]):
+        usages = list(usages)
+        self.samples += 1
+        self.peak_rss = max(self.peak_rss, sum(u["rss"] for u in usages))
+        for field in IO_FIELDS:
+            total = sum(usage[field] for usage in usages)
+            setattr(self, field, max(getattr(self, field), total))
+
+    def finish(self, rusage: resource.struct_rusage):
+        self.user = rusage.ru_utime
+        self.system = rusage.ru_stime
+        self.voluntary_switches = rusage.ru_nvcsw
+        self.involuntary_switches = rusage.ru_nivcsw
+        self.status = 0
+
+    def add(self, other: "Profile"):
+        """
+        Roll another profile up into this one. Peak memory is the largest of
+        the two; everything else is summed.
+        """
+        self.count += other.count
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+        for field in (
+                "wall",
+                "user",
+                "system",
+                *IO_FIELDS,
+                "voluntary_switches",
+                "involuntary_switches",
+                "samples",
+        ):
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        if other.status not in (0, None):
+            self.status = other.status
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "section": self.section,
+            "program": self.program,
+            "count": self.count,
+            "status": self.status,
+            "wall_s": round(self.wall, 6),
+            "user_s": round(self.user, 6),
+            "system_s": round(self.system, 6),
+            "utilization": round(self.utilization, 3),
+            "peak_rss": self.peak_rss,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "rchar": self.rchar,
+            "wchar": self.wchar,
+            "voluntary_switches": self.voluntary_switches,
+            "involuntary_switches": self.involuntary_switches,
+            "samples": self.samples,
+        }
+
+
+class Profiler:
+    """
+    Samples the process tree of every command run in exec mode from /proc,
+    every `interval` seconds, and rolls the results up by section and by
+    program.
+    """
+    def __init__(
+        self,
+        interval: float = DEFAULT_PROFILE_INTERVAL,
+        proc: str = "/proc",
+    ):
+        self.interval = interval
+        self.proc = proc
+        self.profiles: List[Profile] = []
+        self._lock = threading.Lock()
+
+    def profile(
+        self,
+        name: str,
+        section: Optional[str] = None,
+        program: Optional[str] = None,
+    ) -> Profile:
+        profile = Profile(name, section, program)
+        with self._lock:
+            self.profiles.append(profile)
+        return profile
+
+    @contextlib.contextmanager
+    def monitor(self, profile: Profile, pid: int) -> Iterator[Profile]:
+        """
+        Sample the process tree of `pid` until the context exits. The process
+        should have exited but not yet been reaped by then, so that a final
+        sample includes all of its I/O.
+        """
+        stop = threading.Event()
+
+        def sample():
+            usages = [
+                usage for usage in (
+                    read_stat(process, self.proc)
+                    for process in process_tree(pid, self.proc)
+                ) if usage
+            ]
+            profile.sample(usages)
+
+        def loop():
+            while not stop.wait(self.interval):
+                sample()
+
+        start = time.perf_counter()
+        sample()
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        try:
+            yield profile
+        finally:
+            stop.set()
+            thread.join()
+            sample()
+            profile.wall = time.perf_counter() - start
+
+    def _rollup(self, key: str) -> List[Profile]:
+        rollups: Dict[str, Profile] = {}
+        with self._lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            name = getattr(profile, key) or "-"
+            rollup = rollups.get(name)
+            if not rollup:
+                rollup = Profile(name)
+                rollup.count = 0
+                rollup.status = 0
+                rollups[name] = rollup
+            rollup.add(profile)
+        return list(rollups.values())
+
+    def sections(self) -> List[Profile]:
+        return self._rollup("section")
+
+    def programs(self) -> List[Profile]:
+        return sorted(
+            self._rollup("program"),
+            key=lambda profile: profile.wall,
+            reverse=True,
+        )
+
+    def report(self) -> List[str]:
+        """
+        Tables of the resources used per section and per program.
+        """
+        lines: List[str] = []
+        for title, profiles in [
+            ("SECTION", self.sections()),
+            ("PROGRAM", self.programs()),
+        ]:
+            if lines:
+                lines.append("")
+            rows = [(
+                title,
+                "RUNS",
+                "WALL",
+                "CPU",
+                "CPU/WALL",
+                "PEAK RSS",
+                "DISK READ",
+                "DISK WRITE",
+                "READ",
+                "WRITTEN",
+                "CSW VOL/INVOL",
+            )]
+            for profile in profiles:
+                rows.append((
+                    profile.name,
+                    str(profile.count),
+                    f"{profile.wall:.1f}s",
+                    f"{profile.cpu:.1f}s",
+                    f"{profile.utilization:.2f}",
+                    format_size(profile.peak_rss),
+                    format_size(profile.read_bytes),
+                    format_size(profile.write_bytes),
+                    format_size(profile.rchar),
+                    format_size(profile.wchar),
+                    f"{profile.voluntary_switches}/"
+                    f"{profile.involuntary_switches}",
+                ))
+            widths = [
+                max(len(row[i]) for row in rows) for i in range(len(rows[0]))
+            ]
+            lines.extend(
+                "  ".join([
+                    row[0].ljust(widths[0]),
+                    *(row[i].rjust(widths[i]) for i in range(1, len(row))),
+                ]).rstrip() for row in rows
+            )
+        return lines
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            profiles = list(self.profiles)
+        return {
+            "interval_s": self.interval,
+            "commands": [profile.to_json() for profile in profiles],
+            "sections": [profile.to_json() for profile in self.sections()],
+            "programs": [profile.to_json() for profile in self.programs()],
+        }
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
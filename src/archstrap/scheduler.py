@@ -0,0 +1,149 @@
+import concurrent.futures
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set
+
+from archstrap.command import Command
+
+# Pseudo-resource written by steps that do not declare their dependencies.
+# Every step reads it, so an undeclared step acts as a barrier: it waits for
+# all earlier steps, and all later steps wait for it.
+BARRIER = "<barrier>"
+
+
+class Step:
+    def __init__(
+        self,
+        command: Command,
+        reads: Iterable[str] = (),
+        writes: Iterable[str] = (),
+        section: Optional[str] = None,
+    ):
+        self.command = command
+        self.reads = list(reads)
+        self.writes = list(writes)
+        self.section = section
+
+    @property
+    def declared(self) -> bool:
+        return bool(self.reads or self.writes)
+
+
+class Scheduler:
+    """
+    Run steps concurrently, respecting the ordering implied by the resources
+    each step reads and writes.
+
+    A step depends on the last earlier step that wrote any resource it reads
+    or writes, and on every earlier step that read a resource it writes since
+    that resource was last written.
+    """
+    def __init__(self, jobs: int = 1):
+        if jobs < 1:
+            raise ValueError(f"Invalid job count {jobs}")
+        self.jobs = jobs
+        self.steps: List[Step] = []
+        self.dependencies: List[Set[int]] = []
+        self._last_writer: Dict[str, int] = {}
+        self._readers: Dict[str, Set[int]] = {}
+
+    def add(self, step: Step) -> int:
+        index = len(self.steps)
+
+        reads = set(step.reads) | {BARRIER}
+        writes = set(step.writes) if step.declared else {BARRIER}
+
+        dependencies = set()
+        for resource in reads | writes:
+            if resource in self._last_writer:
+                dependencies.add(self._last_writer[resource])
+        for resource in writes:
+            dependencies |= self._readers.get(resource, set())
+        dependencies.discard(index)
+
+        for resource in reads - writes:
+            self._readers.setdefault(resource, set()).add(index)
+        for resource in writes:
+            self._last_writer[resource] = index
+            self._readers[resource] = set()
+
+        self.steps.append(step)
+        self.dependencies.append(dependencies)
+        return index
+
+    def critical_paths(self, costs: Sequence[float]) -> List[float]:
+        """
+        For each added step, the cost of the longest chain of steps that
+        starts with it and follows its dependents, given the cost of each step.
+        """
+        paths = [0.0] * len(self.steps)
+        longest = [0.0] * len(self.steps)
+        # Dependencies always precede the steps that depend on them.
+        for index in reversed(range(len(self.steps))):
+            paths[index] = costs[index] + longest[index]
+            for dependency in self.dependencies[index]:
+                longest[dependency] = max(longest[dependency], paths[index])
+        return paths
+
+    def run(
+        self,
+        execute: Callable[[Step], None],
+        priorities: Optional[Sequence[float]] = None,
+    ):
+        """
+        Execute every added step, at most `jobs` at a time. If a step fails, no
+        further steps are started and the first failure is re-raised once the
+        steps already running have finished.
+
+        Of the steps that are ready to run, those with the highest priority
+        (e.g. the longest critical path) start first, and otherwise those that
+        were added first.
+        """
+        remaining = {
+            index: set(dependencies)
+            for index, dependencies in enumerate(self.dependencies)
+        }
+        dependents: Dict[int, List[int]] = {index: [] for index in remaining}
+        for index, dependencies in remaining.items():
+            for dependency in dependencies:
+                dependents[dependency].append(index)
+
+        def order(index: int):
+            return (-priorities[index] if priorities else 0.0, index)
+
+        ready = sorted(
+            (index for index, deps in remaining.items() if not deps),
+            key=order,
+        )
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < self.jobs and error is None:
+                    index = ready.pop(0)
+                    future = executor.submit(execute, self.steps[index])
+                    running[future] = index
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    index = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    for dependent in dependents[index]:
+                        remaining[dependent].discard(index)
+                        if not remaining[dependent]:
+                            ready.append(dependent)
+                ready.sort(key=order)
+
+        if error is not None:
+            raise error
+
+        self.steps = []
+        self.dependencies = []
+        self._last_writer = {}
+        self._readers = {}
@@ -0,0 +1,521 @@
+import collections
+import concurrent.futures
+import hmac
+import http.server
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from archstrap.defaults import DEFAULT_KEEP_JOBS
+from archstrap.fleet import Result, Target, apply_target
+from archstrap.specification import load_specification
+
+# Seconds between checks for new log lines while following a job's log.
+FOLLOW_INTERVAL = 0.2
+
+MODES = ("exec", "dryrun", "shell", "ninja")
+
+# Options that a job may set for itself, and their types.
+JOB_OPTIONS = {
+    "jobs": int,
+    "resume": bool,
+    "unsafe_fast_io": bool,
+    "trace": bool,
+}
+
+
+def write_token(path: str) -> str:
+    """
+    Generate a bearer token for the HTTP server, and write it to a file that
+    only its owner can read.
+    """
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        # The file may have existed, with looser permissions.
+        os.fchmod(f.fileno(), 0o600)
+        f.write(f"{token}\n")
+    return token
+
+
+class JobError(Exception):
+    """
+    A request that cannot be carried out, with the HTTP status to report.
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        target: Target,
+        mode_name: str,
+        options: Dict[str, Any],
+    ):
+        self.id = id
+        self.name = name
+        self.target = target
+        self.mode_name = mode_name
+        self.options = options
+        self.submitted = time.time()
+        self.future: Optional[concurrent.futures.Future] = None
+
+    @property
+    def state(self) -> str:
+        if self.future is None:
+            return "queued"
+        if self.future.cancelled():
+            return "cancelled"
+        if not self.future.done():
+            # The pool counts a job as running once it hands the job to a
+            # worker, which may be a moment before the worker starts it.
+            return "running" if self.future.running() else "queued"
+        result = self.result
+        return "succeeded" if result and result.ok else "failed"
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("queued", "running")
+
+    @property
+    def result(self) -> Optional[Result]:
+        if not self.future or not self.future.done():
+            return None
+        if self.future.cancelled():
+            return None
+        try:
+            return self.future.result()
+        except Exception as e:
+            return Result(self.target, False, 0.0, str(e))
+
+    def to_json(self, log_dir: str) -> Dict[str, Any]:
+        result = self.result
+        return {
+            "id": self.id,
+            "name": self.name,
+            "specification": self.target.specification,
+            "install_root": self.target.install_root,
+            "mode": self.mode_name,
+            "options": self.options,
+            "state": self.state,
+            "submitted": self.submitted,
+            "duration": result.duration if result else None,
+            "error": result.error if result else None,
+            "log": self.target.log_path(log_dir),
+            "output": self.target.output_path(log_dir),
+        }
+
+
+class JobQueue:
+    """
+    Jobs that apply a specification to an install root, run in a pool of at
+    most `workers` processes. The processes are reused from job to job, so a
+    job does not pay for starting Python and importing archstrap; they are
+    processes rather than threads because each job has its own log and
+    standard output.
+
+    Only the last `keep_jobs` finished jobs are remembered; older ones are
+    forgotten and their files in `log_dir` removed.
+    """
+    def __init__(
+        self,
+        log_dir: str,
+        workers: int,
+        mode_name: str = "exec",
+        keep_jobs: int = DEFAULT_KEEP_JOBS,
+        **options: Any,
+    ):
+        self.log_dir = log_dir
+        self.mode_name = mode_name
+        self.keep_jobs = keep_jobs
+        self.options = options
+        self.jobs: Dict[str, Job] = {}
+        self._finished_ids: collections.deque = collections.deque()
+        self._lock = threading.Lock()
+        os.makedirs(log_dir, exist_ok=True)
+        self._executor = concurrent.futures.ProcessPoolExecutor(workers)
+        # The pool forks all of its workers for its first job. Do that now,
+        # before the server starts any threads that a fork would copy
+        # mid-operation.
+        self._executor.submit(os.getpid).result()
+
+    def shutdown(self):
+        """
+        Cancel the jobs that have not started, and wait for the rest.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, request: Dict[str, Any]) -> Job:
+        """
+        Queue a job from a request with a `specification` (a path on this
+        host, or the specification itself) and an `install_root`, and
+        optionally a `name`, a `mode` and any of JOB_OPTIONS.
+        """
+        install_root = request.get("install_root")
+        specification = request.get("specification")
+        if not isinstance(install_root, str) or not install_root:
+            raise JobError(400, "Missing install_root")
+        if not isinstance(specification, (str, dict)):
+            raise JobError(400, "Missing specification")
+        mode_name = request.get("mode", self.mode_name)
+        if mode_name not in MODES:
+            raise JobError(400, f"Unknown mode '{mode_name}'")
+        options = dict(self.options)
+        for key, kind in JOB_OPTIONS.items():
+            if key in request:
+                if not isinstance(request[key], kind):
+                    raise JobError(400, f"Invalid {key}")
+                options[key] = request[key]
+
+        id = uuid.uuid4().hex[:12]
+        if isinstance(specification, dict):
+            path = self._inline_path(id)
+            with open(path, "w") as f:
+                json.dump(specification, f)
+            specification = path
+        specification = os.path.abspath(specification)
+        # Catch a broken specification before the job is queued.
+        try:
+            load_specification(specification)
+        except Exception as e:
+            raise JobError(400, f"Invalid specification: {e}")
+
+        job = Job(
+            id,
+            str(request.get("name") or id),
+            Target(id, specification, install_root),
+            mode_name,
+            {key: options[key] for key in JOB_OPTIONS if key in options},
+        )
+        root = os.path.normpath(install_root)
+        with self._lock:
+            for other in self.jobs.values():
+                if (other.active and os.path.normpath(
+                        other.target.install_root) == root):
+                    raise JobError(
+                        409,
+                        f"Job {other.id} is already installing to "
+                        f"{install_root}",
+                    )
+            self.jobs[id] = job
+            job.future = self._executor.submit(
+                apply_target,
+                job.target,
+                mode_name,
+                self.log_dir,
+                **options,
+            )
+        job.future.add_done_callback(lambda _: self._finished(job))
+        logging.info("QUEUED %s %s to %s", job.id, job.name, install_root)
+        return job
+
+    def _finished(self, job: Job):
+        result = job.result
+        logging.info(
+            "%s %s %s%s",
+            job.state.upper(),
+            job.id,
+            job.name,
+            f" in {result.duration:.1f}s" if result else "",
+        )
+        with self._lock:
+            self._finished_ids.append(job.id)
+            expired = []
+            while len(self._finished_ids) > self.keep_jobs:
+                expired.append(self.jobs.pop(self._finished_ids.popleft()))
+        for expired_job in expired:
+            self._remove_files(expired_job)
+
+    def _remove_files(self, job: Job):
+        paths = [
+            job.target.log_path(self.log_dir),
+            job.target.output_path(self.log_dir),
+            job.target.trace_path(self.log_dir),
+        ]
+        if job.target.specification == self._inline_path(job.id):
+            paths.append(job.target.specification)
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _inline_path(self, id: str) -> str:
+        return os.path.abspath(os.path.join(self.log_dir, f"{id}.spec.json"))
+
+    def job(self, id: str) -> Job:
+        with self._lock:
+            job = self.jobs.get(id)
+        if not job:
+            raise JobError(404, f"No job {id}")
+        return job
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def cancel(self, id: str) -> Job:
+        """
+        Cancel a job that has not started yet. Running jobs run to the end.
+        """
+        job = self.job(id)
+        if not job.future.cancel() and job.active:
+            raise JobError(409, f"Job {id} is already running")
+        return job
+
+    def follow(self, id: str) -> Iterator[str]:
+        """
+        The lines of a job's log, as they are written, until the job is done.
+        """
+        job = self.job(id)
+        path = job.target.log_path(self.log_dir)
+        while job.active and not os.path.exists(path):
+            time.sleep(FOLLOW_INTERVAL)
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as f:
+            partial = ""
+            while True:
+                # Check before reading, so that nothing written before the
+                # job finished is missed.
+                done = not job.active
+                chunk = f.read()
+                lines = (partial + chunk).split("\n")
+                partial = lines.pop()
+                for line in lines:
+                    yield f"{line}\n"
+                if done:
+                    break
+                if not chunk:
+                    time.sleep(FOLLOW_INTERVAL)
+            if partial:
+                yield partial
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    The HTTP API of a JobQueue:
+
+        POST   /jobs           submit a job, from a JSON body
+        GET    /jobs           list the jobs
+        GET    /jobs/ID        a job's state
+        GET    /jobs/ID/log    a job's log, streamed until the job is done
+        DELETE /jobs/ID        cancel a job that has not started
+
+    Servers with a token only answer requests that carry it in an
+    `Authorization: Bearer TOKEN` header.
+    """
+    server: "Server"
+
+    def address_string(self) -> str:
+        # Clients of a Unix socket have no address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format: str, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def _route(self) -> Tuple[str, ...]:
+        path = self.path.split("?", 1)[0]
+        parts = tuple(part for part in path.split("/") if part)
+        if not parts or parts[0] != "jobs" or len(parts) > 3:
+            raise JobError(404, f"No such resource {path}")
+        return parts[1:]
+
+    def _authorize(self):
+        token = getattr(self.server, "token", None)
+        if token is None:
+            return
+        header = self.headers.get("Authorization") or ""
+        scheme, _, credentials = header.partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+                credentials.strip().encode("utf-8"), token.encode("utf-8")):
+            raise JobError(401, "Missing or invalid bearer token")
+
+    def _send_json(self, status: int, body: Any):
+        data = json.dumps(body, indent=2).encode("utf-8") + b"\n"
+        self.send_response(status)
+        if status == 401:
+            self.send_header("WWW-Authenticate", "Bearer")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str):
+        queue = self.server.queue
+        try:
+            self._authorize()
+            route = self._route()
+            if method == "POST" and not route:
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"null")
+                except ValueError as e:
+                    raise JobError(400, f"Invalid JSON: {e}")
+                if not isinstance(request, dict):
+                    raise JobError(400, "Expected a JSON object")
+                job = queue.submit(request)
+                self._send_json(201, job.to_json(queue.log_dir))
+            elif method == "GET" and not route:
+                self._send_json(
+                    200,
+                    [job.to_json(queue.log_dir) for job in queue.list()],
+                )
+            elif method == "GET" and len(route) == 1:
+                job = queue.job(route[0])
+                self._send_json(200, job.to_json(queue.log_dir))
+            elif method == "GET" and route[1:] == ("log", ):
+                # Look the job up before the response starts.
+                lines = queue.follow(queue.job(route[0]).id)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.end_headers()
+                for line in lines:
+                    self.wfile.write(line.encode("utf-8"))
+                    self.wfile.flush()
+            elif method == "DELETE" and len(route) == 1:
+                self._send_json(
+                    200,
+                    queue.cancel(route[0]).to_json(queue.log_dir),
+                )
+            else:
+                raise JobError(405, f"Cannot {method} {self.path}")
+        except JobError as e:
+            self._send_json(e.status, {"error": str(e)})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def remove_stale_socket(path: str):
+    """
+    Remove a socket left behind by a server that did not shut down. Anything
+    else at the path, including the socket of a server that is still
+    running, is an error.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise FileExistsError(f"Another server is listening on {path}")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, queue: JobQueue):
+        self.queue = queue
+        remove_stale_socket(path)
+        # Anyone who can connect can run installs, so only the owner may.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+        stat_result = os.lstat(path)
+        self._socket_id = (stat_result.st_dev, stat_result.st_ino)
+
+    def server_close(self):
+        super().server_close()
+        # Only remove the socket if it is still ours.
+        try:
+            stat_result = os.lstat(self.server_address)
+        except FileNotFoundError:
+            return
+        if (stat_result.st_dev, stat_result.st_ino) == self._socket_id:
+            os.unlink(self.server_address)
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    """
+    The API over TCP, which any local user can connect to, so every request
+    must carry the token.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], queue: JobQueue, token: str):
+        self.queue = queue
+        self.token = token
+        super().__init__(address, Handler)
+
+
+def serve(
+    queue: JobQueue,
+    socket_path: str,
+    http_address: Optional[Tuple[str, int]] = None,
+    token_path: Optional[str] = None,
+):
+    """
+    Serve the queue's API on a Unix socket, and optionally over TCP, until
+    interrupted. Jobs that are running then are waited for. The TCP server
+    requires a token, which is written to `token_path`.
+    """
+    if http_address and not token_path:
+        raise ValueError("Serving over TCP requires a token path")
+    servers: List[socketserver.BaseServer] = [Server(socket_path, queue)]
+    logging.info("Listening on %s", socket_path)
+    if http_address:
+        token = write_token(token_path)
+        servers.append(HTTPServer(http_address, queue, token))
+        logging.info(
+            "Listening on http://%s:%d, with the token in %s",
+            *http_address,
+            token_path,
+        )
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    threads = [
+        threading.Thread(target=server.serve_forever, daemon=True)
+        for server in servers
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Shutting down")
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if http_address and os.path.exists(token_path):
+            os.unlink(token_path)
+        queue.shutdown()
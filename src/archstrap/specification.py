@@ -1,8 +1,26 @@
 import copy
+import hashlib
+import inspect
+import math
 import os
-from typing import Any, Iterable, Iterator, Mapping, Optional
+import shlex
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from archstrap import fastio, initrd, layering, mirrors
+from archstrap.cache import LOCK_FILE, touch_command
+from archstrap.command import Command
+from archstrap.journal import STATE_DIR
 from archstrap.mode import Mode
+from archstrap.plan import Plan
 
 DEFAULT_INITRD_HOOKS = [
     "base",
@@ -14,6 +32,144 @@ DEFAULT_INITRD_HOOKS = [
     "fsck",
 ]
 
+# Image name suffix of each mkinitcpio preset. The fallback preset skips the
+# autodetect hook, so that its image boots on any hardware.
+PRESET_SUFFIXES = {
+    "default": "",
+    "fallback": "-fallback",
+}
+
+
+class MirrorSpecification:
+    def __init__(
+        self,
+        servers: Iterable[str],
+        parallel_downloads: int = 5,
+        repositories: Iterable[str] = ["core", "extra"],
+        architecture: str = "x86_64",
+        rank: bool = True,
+        ttl: float = 86400,
+        probe_timeout: float = 5.0,
+        ranking_cache: str = mirrors.DEFAULT_RANKING_CACHE,
+    ):
+        self.servers = list(servers)
+        self.parallel_downloads = parallel_downloads
+        self.repositories = list(repositories)
+        self.architecture = architecture
+        self.rank = rank
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self.ranking_cache = ranking_cache
+        # How the install runs `archstrap rank-mirrors` to rank the servers.
+        self.rank_command = list(mirrors.RANK_COMMAND)
+
+    def rank_argv(self, mirrorlist: str) -> List[str]:
+        """
+        The command that ranks the servers and writes them to `mirrorlist`.
+        Mirrors are probed when the install runs rather than while it is
+        planned, so that modes that do not run commands make no network
+        requests, and scripts rank mirrors from the host they run on.
+        """
+        return [
+            *self.rank_command,
+            f"--output={mirrorlist}",
+            f"--repository={self.repositories[0]}",
+            f"--architecture={self.architecture}",
+            f"--timeout={self.probe_timeout:g}",
+            f"--ttl={self.ttl:g}",
+            f"--ranking-cache={self.ranking_cache}",
+            "--",
+            *self.servers,
+        ]
+
+    def host_pacman_conf(self, install_root: str) -> str:
+        return os.path.join(install_root, STATE_DIR, "pacman.conf")
+
+    def host_mirrorlist(self, install_root: str) -> str:
+        return os.path.join(install_root, STATE_DIR, "mirrorlist")
+
+    def apply(self, install_root: str, mode: Mode):
+        """
+        Write the pacman configuration that pacstrap uses on the host.
+        """
+        mode.on_section("Configure Mirrors")
+
+        state_dir = os.path.join(install_root, STATE_DIR)
+        pacman_conf = self.host_pacman_conf(install_root)
+        mirrorlist = self.host_mirrorlist(install_root)
+
+        mode.on_command(
+            Command(["mkdir", "-p", state_dir]),
+            writes=[state_dir],
+        )
+        if self.rank:
+            write_mirrorlist = Command(self.rank_argv(mirrorlist))
+        else:
+            write_mirrorlist = Command.write(
+                mirrorlist,
+                mirrors.render_mirrorlist(self.servers),
+            )
+        mode.on_command(
+            write_mirrorlist,
+            reads=[state_dir],
+            writes=[mirrorlist],
+        )
+        mode.on_command(
+            Command.write(
+                pacman_conf,
+                mirrors.render_pacman_conf(
+                    mirrorlist,
+                    self.repositories,
+                    self.parallel_downloads,
+                ),
+            ),
+            reads=[state_dir],
+            writes=[pacman_conf],
+        )
+
+    def install(self, install_root: str, mode: Mode):
+        """
+        Install the same configuration into the target system once it exists,
+        then remove the copy used by pacstrap.
+        """
+        pacman_conf = os.path.join(install_root, "etc/pacman.conf")
+        mirrorlist = os.path.join(install_root, "etc/pacman.d/mirrorlist")
+
+        if self.rank:
+            # In the order that ranking produced before pacstrap.
+            host_mirrorlist = self.host_mirrorlist(install_root)
+            mode.on_command(
+                Command(["cp", host_mirrorlist, mirrorlist]),
+                reads=[install_root, host_mirrorlist],
+                writes=[mirrorlist],
+            )
+        else:
+            mode.on_command(
+                Command.write(
+                    mirrorlist,
+                    mirrors.render_mirrorlist(self.servers),
+                ),
+                reads=[install_root],
+                writes=[mirrorlist],
+            )
+        mode.on_command(
+            Command.write(
+                pacman_conf,
+                mirrors.render_pacman_conf(
+                    "/etc/pacman.d/mirrorlist",
+                    self.repositories,
+                    self.parallel_downloads,
+                ),
+            ),
+            reads=[install_root],
+            writes=[pacman_conf],
+        )
+        host_files = [
+            self.host_pacman_conf(install_root),
+            self.host_mirrorlist(install_root),
+        ]
+        mode.on_command(Command(["rm", "-f", *host_files]), writes=host_files)
+
 
 class PackageSpecification:
     def __init__(
@@ -22,30 +178,226 @@ class PackageSpecification:
         kernel: Optional[str] = "linux",
         firmware: Optional[str] = "linux-firmware",
         extra: Iterable[str] = [],
+        cache: Optional[str] = None,
+        cache_size: Optional[Union[int, str]] = None,
+        golden: Optional[str] = None,
+        kernels: Optional[Iterable[str]] = None,
+        bundle: Optional[str] = None,
+        golden_max_age: Optional[float] = 86400,
     ):
         self.base = base
         self.kernel = kernel
         self.firmware = firmware
         self.extra = list(extra)
+        self.cache = cache
+        self.cache_size = cache_size
+        self.golden = golden
+        self.kernels = list(kernels) if kernels is not None else None
+        self.bundle = bundle
+        self.golden_max_age = golden_max_age
+        # How pacman runs `archstrap bundle-fetch` to read from the bundle, if
+        # not as `archstrap` on the PATH.
+        self.bundle_fetch: Optional[List[str]] = None
 
-    @property
-    def kernel_headers(self) -> Optional[str]:
-        return f"{self.kernel}-headers" if self.kernel else None
+    def kernel_packages(self) -> List[str]:
+        """
+        The kernels to install: `kernels` if given, otherwise `kernel`.
+        """
+        if self.kernels is not None:
+            return list(self.kernels)
+        return [self.kernel] if self.kernel else []
 
     def packages(self) -> Iterator[str]:
         if self.base:
             yield self.base
-        if self.kernel:
-            yield self.kernel
-            yield self.kernel_headers
+        for kernel in self.kernel_packages():
+            yield kernel
+            yield f"{kernel}-headers"
         if self.firmware:
             yield self.firmware
         yield from self.extra
 
-    def apply(self, install_root: str, mode: Mode):
+    def golden_image(self) -> str:
+        """
+        Path of the golden root filesystem for this package set. Package
+        specifications that resolve to the same set of packages share it.
+        """
+        packages = "\n".join(sorted(set(self.packages())))
+        key = hashlib.sha256(packages.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.golden, key)
+
+    def bundle_pacman_conf(self, install_root: str) -> str:
+        return os.path.join(install_root, STATE_DIR, "bundle-pacman.conf")
+
+    def apply(
+        self,
+        install_root: str,
+        mode: Mode,
+        mirrors: Optional[MirrorSpecification] = None,
+        fast_io: bool = False,
+    ):
         mode.on_section("Install Packages")
 
-        mode.on_command(f"pacstrap {install_root} {' '.join(self.packages())}")
+        pacstrap = ["pacstrap"]
+        reads = []
+        env = {}
+        if fast_io:
+            env = fastio.environment()
+            reads.append(fastio.library_path(install_root))
+        if self.bundle:
+            # Install from the bundle instead of the mirrors. The bundle module
+            # reads tar archives, which installs without a bundle do not need
+            # to import.
+            from archstrap.bundle import FETCH_COMMAND, render_pacman_conf
+
+            state_dir = os.path.join(install_root, STATE_DIR)
+            pacman_conf = self.bundle_pacman_conf(install_root)
+            mode.on_command(
+                Command(["mkdir", "-p", state_dir]),
+                writes=[state_dir],
+            )
+            mode.on_command(
+                Command.write(
+                    pacman_conf,
+                    render_pacman_conf(
+                        self.bundle,
+                        self.bundle_fetch or FETCH_COMMAND,
+                    ),
+                ),
+                reads=[state_dir],
+                writes=[pacman_conf],
+            )
+            pacstrap += ["-C", pacman_conf]
+            reads += [pacman_conf, self.bundle]
+        elif mirrors:
+            pacman_conf = mirrors.host_pacman_conf(install_root)
+            pacstrap += ["-C", pacman_conf]
+            reads += [pacman_conf, mirrors.host_mirrorlist(install_root)]
+        if mirrors:
+            pacstrap.append("-M")
+
+        if self.cache:
+            mode.on_command(
+                Command(["mkdir", "-p", self.cache]),
+                writes=[self.cache],
+            )
+            reads.append(self.cache)
+
+        if not self.golden:
+            mode.on_command(
+                Command(self._pacstrap(pacstrap, install_root), env),
+                reads=reads,
+                writes=[install_root],
+            )
+        else:
+            # Golden images outlive the install, so they are written safely.
+            self._apply_golden(install_root, mode, pacstrap, reads)
+
+        if self.bundle:
+            pacman_conf = self.bundle_pacman_conf(install_root)
+            mode.on_command(
+                Command(["rm", "-f", pacman_conf]),
+                writes=[pacman_conf],
+            )
+        if mirrors:
+            mirrors.install(install_root, mode)
+
+    def _pacstrap(self, pacstrap: List[str], root: str) -> List[str]:
+        if not self.cache:
+            return [*pacstrap, root, *self.packages()]
+
+        # Use the shared host cache instead of one inside the install root.
+        # Installs share the lock, which only keeps eviction out until they
+        # have recorded the packages they used.
+        lock_file = os.path.join(self.cache, LOCK_FILE)
+        install = [
+            *pacstrap,
+            "-c",
+            root,
+            *self.packages(),
+            f"--cachedir={self.cache}",
+        ]
+        touch = touch_command(self.cache, root)
+        return [
+            "flock",
+            "--shared",
+            lock_file,
+            "sh",
+            "-c",
+            f"{shlex.join(install)} && {shlex.join(touch)}",
+        ]
+
+    def _apply_golden(
+        self,
+        install_root: str,
+        mode: Mode,
+        pacstrap: List[str],
+        reads: List[str],
+    ):
+        # Build the golden image once, under a lock so that concurrent installs
+        # of the same package set wait for the first one instead of building
+        # it again, then clone it into the install root. Images older than
+        # `golden_max_age` are rebuilt, so that installs do not clone stale
+        # packages forever. The image only appears under its final name once
+        # pacstrap has succeeded, and clones hold the lock shared, so that a
+        # rebuild does not replace an image while it is being copied. Checking
+        # for the image inside the lock needs a shell.
+        image = self.golden_image()
+        partial = f"{image}.partial"
+        lock_file = f"{image}.lock"
+        if self.golden_max_age is None:
+            fresh = f"[ -d {shlex.quote(image)} ]"
+        else:
+            minutes = max(math.ceil(self.golden_max_age / 60), 1)
+            find = shlex.join(
+                ["find", image, "-maxdepth", "0", "-mmin", f"-{minutes}"]
+            )
+            fresh = f'[ -n "$({find} 2>/dev/null)" ]'
+        build = " && ".join([
+            shlex.join(["rm", "-rf", partial]),
+            shlex.join(["mkdir", partial]),
+            shlex.join(self._pacstrap(pacstrap, partial)),
+            shlex.join(["touch", partial]),
+            shlex.join(["rm", "-rf", image]),
+            shlex.join(["mv", "-T", partial, image]),
+        ])
+        mode.on_command(
+            Command(["mkdir", "-p", self.golden]),
+            writes=[self.golden],
+        )
+        mode.on_command(
+            Command([
+                "flock",
+                lock_file,
+                "sh",
+                "-c",
+                f"{fresh} || {{ {build}; }}",
+            ]),
+            reads=[*reads, self.golden],
+            writes=[image],
+        )
+        mode.on_command(
+            Command([
+                "flock",
+                "--shared",
+                lock_file,
+                "cp",
+                "-a",
+                "--reflink=auto",
+                f"{image}/.",
+                install_root,
+            ]),
+            reads=[image],
+            writes=[install_root],
+        )
+        # Package install scripts may have given the image a machine ID, which
+        # systemd-firstboot would then keep in every clone.
+        machine_id = os.path.join(install_root, "etc/machine-id")
+        mode.on_command(
+            Command(["rm", "-f", machine_id]),
+            reads=[install_root],
+            writes=[machine_id],
+        )
 
 
 class SystemSpecification:
@@ -69,6 +421,16 @@ class SystemSpecification:
         mode.on_section("Configure System")
 
         # Systemd
+        firstboot_files = [
+            os.path.join(install_root, path) for path in (
+                "etc/machine-id",
+                "etc/localtime",
+                "etc/locale.conf",
+                "etc/vconsole.conf",
+                "etc/hostname",
+            )
+        ]
+        shadow_file = os.path.join(install_root, "etc/shadow")
         systemd_firstboot = [
             "systemd-firstboot",
             "--setup-machine-id",
@@ -80,30 +442,54 @@ class SystemSpecification:
         ]
         if self.root_password:
             systemd_firstboot.append(f"--root-password={self.root_password}")
+            firstboot_files.append(shadow_file)
         else:
-            mode.on_command(f"arch-chroot {install_root} passwd")
-        mode.on_command(" ".join(systemd_firstboot))
+            mode.on_command(
+                Command(["passwd"], chroot=install_root, interactive=True),
+                reads=[install_root],
+                writes=[shadow_file],
+            )
+        mode.on_command(
+            Command(systemd_firstboot),
+            reads=[install_root],
+            writes=firstboot_files,
+        )
 
         # Timezone
-        mode.on_command(f"arch-chroot {install_root} hwclock --systohc")
+        mode.on_command(
+            Command(["hwclock", "--systohc"], chroot=install_root),
+            reads=[install_root],
+            writes=[os.path.join(install_root, "etc/adjtime")],
+        )
 
         # Locale
         locale_gen_file = os.path.join(install_root, "etc/locale.gen")
         mode.on_command(
-            f"echo {self.locale} {self.charset} > {locale_gen_file}"
+            Command.write(locale_gen_file, [f"{self.locale} {self.charset}"]),
+            reads=[install_root],
+            writes=[locale_gen_file],
+        )
+        mode.on_command(
+            Command(["locale-gen"], chroot=install_root),
+            reads=[install_root, locale_gen_file],
+            writes=[
+                os.path.join(install_root, "usr/lib/locale/locale-archive")
+            ],
         )
-        mode.on_command(f"arch-chroot {install_root} locale-gen")
 
         # Network
         hosts_file = os.path.join(install_root, "etc/hosts")
         mode.on_command(
-            "\n".join([
-                f"cat > {hosts_file} <<EOF",
-                "127.0.0.1 localhost",
-                "::1       localhost",
-                f"127.0.1.1 {self.hostname}.localdomain {self.hostname}",
-                "EOF",
-            ])
+            Command.write(
+                hosts_file,
+                [
+                    "127.0.0.1 localhost",
+                    "::1       localhost",
+                    f"127.0.1.1 {self.hostname}.localdomain {self.hostname}",
+                ],
+            ),
+            reads=[install_root],
+            writes=[hosts_file],
         )
 
 
@@ -116,36 +502,109 @@ class InitrdSpecification:
         hooks: Iterable[str] = DEFAULT_INITRD_HOOKS,
         compression: str = "xz",
         compression_options: Iterable[str] = [],
+        compression_goal: str = "boot",
+        benchmark_cache: str = initrd.DEFAULT_BENCHMARK_CACHE,
+        presets: Iterable[str] = ["fallback"],
     ):
+        if compression_goal not in initrd.GOALS:
+            raise ValueError(f"Unknown compression goal '{compression_goal}'")
+        for preset in presets:
+            if preset not in PRESET_SUFFIXES:
+                raise ValueError(f"Unknown initramfs preset '{preset}'")
         self.modules = list(modules)
         self.binaries = list(binaries)
         self.files = list(files)
         self.hooks = list(hooks)
         self.compression = compression
         self.compression_options = compression_options
+        self.compression_goal = compression_goal
+        self.benchmark_cache = benchmark_cache
+        self.presets = list(presets)
 
-    def apply(self, install_root: str, mode: Mode):
+    def resolved_compression(
+        self,
+        kernels: Iterable[str] = ["linux"],
+    ) -> Tuple[str, List[str]]:
+        """
+        The compressor and its options. For "auto", this is the best one for
+        `compression_goal` according to `archstrap bench-initrd`, for the
+        first of the kernel packages that has been benchmarked or else the
+        last kernel benchmarked. It only depends on the specification, not on
+        what is installed yet, so that resumed installs resolve it the same.
+        """
+        if self.compression != "auto":
+            return self.compression, list(self.compression_options)
+
+        cache = initrd.BenchmarkCache(self.benchmark_cache)
+        results: List[initrd.BenchResult] = []
+        for kernel in kernels:
+            results = cache.load(package=kernel)
+            if results:
+                break
+        results = results or cache.load()
+        if not results:
+            compression, options = initrd.DEFAULT_CHOICES[self.compression_goal]
+            return compression, list(options)
+        best = initrd.choose(results, self.compression_goal)
+        return best.compression, best.options
+
+    def config(self, kernels: Iterable[str] = ["linux"]) -> List[str]:
+        compression, compression_options = self.resolved_compression(kernels)
+        return [
+            f"MODULES=({' '.join(self.modules)})",
+            f"BINARIES=({' '.join(self.binaries)})",
+            f"FILES=({' '.join(self.files)})",
+            f"HOOKS=({' '.join(self.hooks)})",
+            f"COMPRESSION=\"{compression}\"",
+            f"COMPRESSION_OPTIONS=({' '.join(compression_options)})",
+        ]
+
+    def apply(
+        self,
+        install_root: str,
+        mode: Mode,
+        kernels: Iterable[str] = ["linux"],
+        fast_io: bool = False,
+    ):
         mode.on_section("Create Initramfs")
+        kernels = list(kernels)
 
         mkinitcpio_conf_file = os.path.join(install_root, "etc/mkinitcpio.conf")
         mode.on_command(
-            "\n".join([
-                f"cat > {mkinitcpio_conf_file} <<EOF",
-                f"MODULES=({' '.join(self.modules)})",
-                f"BINARIES=({' '.join(self.binaries)})",
-                f"FILES=({' '.join(self.files)})",
-                f"HOOKS=({' '.join(self.hooks)})",
-                f"COMPRESSION=\"{self.compression}\"",
-                f"COMPRESSION_OPTIONS=({' '.join(self.compression_options)})",
-                "EOF",
-            ])
-        )
-        mode.on_command(
-            f"kernel=\"$(find {install_root}/lib/modules -mindepth 1 -maxdepth 1 -type d | xargs basename)\""
-        )
-        mode.on_command(
-            f"arch-chroot {install_root} mkinitcpio −−allpresets --kernel=\"$kernel\" --generate /boot/initramfs-linux-fallback.img"
+            Command.write(mkinitcpio_conf_file, self.config(kernels)),
+            reads=[install_root],
+            writes=[mkinitcpio_conf_file],
         )
+        # One image per kernel and preset, each its own step, so that they are
+        # generated in parallel.
+        for kernel in kernels:
+            kernel_image = os.path.join(install_root, f"boot/vmlinuz-{kernel}")
+            for preset in self.presets:
+                image = f"/boot/initramfs-{kernel}{PRESET_SUFFIXES[preset]}.img"
+                mkinitcpio = [
+                    "mkinitcpio",
+                    "--kernel",
+                    f"/boot/vmlinuz-{kernel}",
+                    "--generate",
+                    image,
+                ]
+                if preset == "fallback":
+                    mkinitcpio += ["--skiphooks", "autodetect"]
+                reads = [
+                    install_root,
+                    kernel_image,
+                    mkinitcpio_conf_file,
+                    os.path.join(install_root, "etc/vconsole.conf"),
+                ]
+                env = {}
+                if fast_io:
+                    env = fastio.environment()
+                    reads.append(fastio.library_path(install_root))
+                mode.on_command(
+                    Command(mkinitcpio, env, chroot=install_root),
+                    reads=reads,
+                    writes=[os.path.join(install_root, image.lstrip("/"))],
+                )
 
 
 class Specification:
@@ -154,22 +613,103 @@ class Specification:
         packages: PackageSpecification,
         system: SystemSpecification,
         initrd: InitrdSpecification,
+        mirrors: Optional[MirrorSpecification] = None,
     ):
         self.packages = packages
         self.system = system
         self.initrd = initrd
+        self.mirrors = mirrors
+        # Set by the caller rather than the specification file: skip the
+        # fsync calls of pacstrap and mkinitcpio, and sync the install root's
+        # filesystem once at the end instead. An install that is interrupted
+        # by a crash or power loss must then be started over.
+        self.unsafe_fast_io = False
 
-    def apply(self, install_root: str, mode: Mode):
+    def use_command(self, command: Iterable[str]):
+        """
+        Run archstrap's helper commands, which installs run to rank mirrors
+        and to read from bundles, with `command` rather than with `archstrap`
+        on the PATH.
+        """
+        command = list(command)
+        self.packages.bundle_fetch = [*command, "bundle-fetch"]
+        if self.mirrors:
+            self.mirrors.rank_command = [*command, "rank-mirrors"]
+
+    def plan(self, install_root: str) -> Plan:
+        plan = Plan()
+        if self.mirrors:
+            self.mirrors.apply(install_root, plan)
+        if self.unsafe_fast_io:
+            fastio.setup(install_root, plan)
+        self.packages.apply(
+            install_root,
+            plan,
+            self.mirrors,
+            fast_io=self.unsafe_fast_io,
+        )
+        self.system.apply(install_root, plan)
+        self.initrd.apply(
+            install_root,
+            plan,
+            self.packages.kernel_packages(),
+            fast_io=self.unsafe_fast_io,
+        )
+        if self.unsafe_fast_io:
+            fastio.finish(install_root, plan)
+        if self.mirrors or self.packages.bundle or self.unsafe_fast_io:
+            # Only ExecMode's journal is meant to outlive the steps above,
+            # and it removes the directory itself.
+            plan.on_section("Clean Up")
+            plan.on_command(
+                Command(
+                    [
+                        "rmdir",
+                        "--ignore-fail-on-non-empty",
+                        os.path.join(install_root, STATE_DIR),
+                    ]
+                )
+            )
+        return plan
+
+    def apply(self, install_root: str, mode: Mode, optimize: bool = True):
+        plan = self.plan(install_root)
+        if optimize:
+            plan = plan.optimize()
         mode.on_begin()
-        self.packages.apply(install_root, mode)
-        self.system.apply(install_root, mode)
-        self.initrd.apply(install_root, mode)
+        plan.replay(mode)
         mode.on_end()
 
 
 def make_specification(spec: Mapping[str, Any]) -> Specification:
     spec = copy.deepcopy(dict(spec))
-    spec["packages"] = PackageSpecification(**spec.get("packages", {}))
-    spec["system"] = SystemSpecification(**spec["system"])
-    spec["initrd"] = InitrdSpecification(**spec.get("initrd", {}))
+    spec["packages"] = _construct(
+        PackageSpecification,
+        spec.get("packages", {}),
+    )
+    spec["system"] = _construct(SystemSpecification, spec["system"])
+    spec["initrd"] = _construct(InitrdSpecification, spec.get("initrd", {}))
+    if "mirrors" in spec:
+        spec["mirrors"] = _construct(MirrorSpecification, spec["mirrors"])
     return Specification(**spec)
+
+
+def _construct(cls, params: Mapping[str, Any]):
+    # List operations that no layer had a list to apply to modify the
+    # parameter's default.
+    parameters = inspect.signature(cls).parameters
+    params = dict(params)
+    for name, value in params.items():
+        if isinstance(value, layering.ListOps):
+            default = parameters[name].default if name in parameters else None
+            if default is inspect.Parameter.empty:
+                default = None
+            params[name] = value.apply(default)
+    return cls(**params)
+
+
+def load_specification(path: str) -> Specification:
+    """
+    Load a specification file, along with the files it extends and includes.
+    """
+    return make_specification(layering.LOADER.load(path))
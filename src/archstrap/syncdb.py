@@ -0,0 +1,416 @@
+import collections
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import tarfile
+import tempfile
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from archstrap.cache import format_size
+from archstrap.defaults import DEFAULT_SYNC_DIR, user_cache_dir
+
+DEFAULT_INDEX_DIR = os.path.join(user_cache_dir(), "syncdb")
+
+INDEX_MAGIC = b"ASDBIDX1"
+
+# Magic, fingerprint of the databases the index was built from, number of keys.
+HEADER = struct.Struct("<8s32sI")
+
+# Key offset, key length, key kind, record offset, record length. Offsets are
+# into the data that follows the key table, which is sorted by key and kind.
+KEY = struct.Struct("<IHBxII")
+
+# Kinds of key: the name of a package, a name that a package provides, or a
+# group that a package belongs to.
+PACKAGE, PROVIDES, GROUP = 0, 1, 2
+
+DEPENDENCY_PATTERN = re.compile(r"^[^<>=:]+")
+
+
+def dependency_name(dependency: str) -> str:
+    """
+    The name in a dependency, without any version constraint or description,
+    e.g. "glibc" for "glibc>=2.38".
+    """
+    match = DEPENDENCY_PATTERN.match(dependency)
+    return match.group(0).strip() if match else dependency
+
+
+class SyncPackage:
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        repository: str,
+        download_size: int,
+        installed_size: int,
+        depends: Iterable[str] = (),
+        provides: Iterable[str] = (),
+        groups: Iterable[str] = (),
+    ):
+        self.name = name
+        self.version = version
+        self.repository = repository
+        self.download_size = download_size
+        self.installed_size = installed_size
+        self.depends = list(depends)
+        self.provides = list(provides)
+        self.groups = list(groups)
+
+    def encode(self) -> bytes:
+        return "\t".join([
+            self.name,
+            self.version,
+            self.repository,
+            str(self.download_size),
+            str(self.installed_size),
+            " ".join(self.depends),
+            " ".join(self.provides),
+            " ".join(self.groups),
+        ]).encode("utf-8")
+
+    @staticmethod
+    def decode(record: bytes) -> "SyncPackage":
+        fields = record.decode("utf-8").split("\t")
+        return SyncPackage(
+            fields[0],
+            fields[1],
+            fields[2],
+            int(fields[3]),
+            int(fields[4]),
+            fields[5].split(),
+            fields[6].split(),
+            fields[7].split(),
+        )
+
+
+def _parse_fields(text: str) -> Dict[str, List[str]]:
+    fields: Dict[str, List[str]] = {}
+    values: Optional[List[str]] = None
+    for line in text.splitlines():
+        if len(line) > 2 and line.startswith("%") and line.endswith("%"):
+            values = fields.setdefault(line[1:-1], [])
+        elif line and values is not None:
+            values.append(line)
+    return fields
+
+
+def read_entries(path: str) -> Dict[str, Dict[str, bytes]]:
+    """
+    The raw entries of a pacman sync database: a tarball with a directory per
+    package, holding a `desc` file (and, in older databases, a `depends`
+    file). Returns the contents of those files by directory and file name.
+    """
+    entries: Dict[str, Dict[str, bytes]] = {}
+    try:
+        with tarfile.open(path) as tar:
+            for member in tar:
+                directory, _, filename = member.name.partition("/")
+                if filename not in ("desc", "depends") or not member.isfile():
+                    continue
+                content = tar.extractfile(member).read()
+                entries.setdefault(directory, {})[filename] = content
+    except tarfile.TarError as e:
+        raise ValueError(f"Cannot read sync database {path}: {e}")
+    return entries
+
+
+def parse_entry(entry: Dict[str, bytes]) -> Dict[str, List[str]]:
+    fields: Dict[str, List[str]] = {}
+    for content in entry.values():
+        fields.update(_parse_fields(content.decode("utf-8")))
+    return fields
+
+
+def read_database(path: str, repository: str) -> List[SyncPackage]:
+    """
+    The packages in a pacman sync database.
+    """
+    packages = []
+    for entry in read_entries(path).values():
+        fields = parse_entry(entry)
+        if "NAME" not in fields:
+            continue
+        packages.append(
+            SyncPackage(
+                fields["NAME"][0],
+                fields.get("VERSION", [""])[0],
+                repository,
+                int(fields.get("CSIZE", ["0"])[0]),
+                int(fields.get("ISIZE", ["0"])[0]),
+                fields.get("DEPENDS", []),
+                fields.get("PROVIDES", []),
+                fields.get("GROUPS", []),
+            )
+        )
+    return packages
+
+
+def find_databases(
+    sync_dir: str = DEFAULT_SYNC_DIR,
+    repositories: Optional[Iterable[str]] = None,
+) -> List[Tuple[str, str]]:
+    """
+    The repository names and paths of the sync databases to resolve packages
+    against, in priority order. Without a list of repositories, every database
+    in `sync_dir` is used.
+    """
+    if repositories is None:
+        return [
+            (os.path.basename(path)[:-len(".db")], path)
+            for path in sorted(glob.glob(os.path.join(sync_dir, "*.db")))
+        ]
+    databases = []
+    for repository in repositories:
+        path = os.path.join(sync_dir, f"{repository}.db")
+        if not os.path.isfile(path):
+            raise ValueError(
+                f"No sync database for repository '{repository}' in "
+                f"{sync_dir} (run `pacman -Sy`)"
+            )
+        databases.append((repository, path))
+    return databases
+
+
+def fingerprint(databases: Iterable[Tuple[str, str]]) -> bytes:
+    digest = hashlib.sha256()
+    for repository, path in databases:
+        stat = os.stat(path)
+        digest.update(
+            f"{repository}\0{os.path.abspath(path)}\0{stat.st_size}\0"
+            f"{stat.st_mtime_ns}\n".encode("utf-8")
+        )
+    return digest.digest()
+
+
+def build_index(databases: Iterable[Tuple[str, str]], path: str):
+    """
+    Write an index of the packages in `databases` that SyncIndex can look
+    names up in without reading or parsing all of it.
+    """
+    databases = list(databases)
+    keys: List[Tuple[bytes, int, int, int]] = []
+    data = bytearray()
+    for repository, db_path in databases:
+        for package in read_database(db_path, repository):
+            record = package.encode()
+            offset = len(data)
+            data += record
+            names = [(package.name, PACKAGE)]
+            names += [
+                (dependency_name(provided), PROVIDES)
+                for provided in package.provides
+            ]
+            names += [(group, GROUP) for group in package.groups]
+            for name, kind in names:
+                keys.append((name.encode("utf-8"), kind, offset, len(record)))
+
+    # A stable sort keeps packages from earlier repositories first.
+    keys.sort(key=lambda key: (key[0], key[1]))
+    table = bytearray()
+    for name, kind, offset, length in keys:
+        table += KEY.pack(len(data), len(name), kind, offset, length)
+        data += name
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(HEADER.pack(INDEX_MAGIC, fingerprint(databases), len(keys)))
+        f.write(table)
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class SyncIndex:
+    """
+    A memory-mapped index written by build_index. Lookups are binary searches
+    over the key table, so only the pages they touch are read.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.fingerprint, self._count = HEADER.unpack_from(
+                self._map
+            )
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{path} is not a sync database index")
+        except (struct.error, ValueError):
+            self._map.close()
+            raise
+        self._data = HEADER.size + self._count * KEY.size
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _key(self, index: int) -> Tuple[bytes, int, int, int]:
+        key_offset, key_length, kind, offset, length = KEY.unpack_from(
+            self._map, HEADER.size + index * KEY.size
+        )
+        start = self._data + key_offset
+        return self._map[start:start + key_length], kind, offset, length
+
+    def _find(self, name: str, kind: int) -> List[SyncPackage]:
+        target = (name.encode("utf-8"), kind)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[:2] < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        packages = []
+        for index in range(low, self._count):
+            key, key_kind, offset, length = self._key(index)
+            if (key, key_kind) != target:
+                break
+            start = self._data + offset
+            packages.append(
+                SyncPackage.decode(self._map[start:start + length])
+            )
+        return packages
+
+    def package(self, name: str) -> Optional[SyncPackage]:
+        packages = self._find(name, PACKAGE)
+        return packages[0] if packages else None
+
+    def providers(self, name: str) -> List[SyncPackage]:
+        return self._find(name, PROVIDES)
+
+    def group(self, name: str) -> List[SyncPackage]:
+        return self._find(name, GROUP)
+
+
+def open_index(
+    databases: Iterable[Tuple[str, str]],
+    index_dir: str = DEFAULT_INDEX_DIR,
+) -> SyncIndex:
+    """
+    Open the index of `databases`, building it first if it does not exist or
+    if any of the databases changed since it was built.
+    """
+    databases = list(databases)
+    key = hashlib.sha256(
+        "\n".join(os.path.abspath(path) for _, path in databases)
+        .encode("utf-8")
+    ).hexdigest()[:16]
+    path = os.path.join(index_dir, f"{key}.idx")
+
+    try:
+        index = SyncIndex(path)
+        if index.fingerprint == fingerprint(databases):
+            return index
+        index.close()
+    except (OSError, ValueError, struct.error):
+        pass
+
+    start = time.monotonic()
+    build_index(databases, path)
+    logging.debug(
+        "Indexed %d sync databases in %.3fs",
+        len(databases),
+        time.monotonic() - start,
+    )
+    return SyncIndex(path)
+
+
+class Resolution:
+    def __init__(self):
+        self.packages: Dict[str, SyncPackage] = {}
+        # Names that no package or group matched, and the package that
+        # depends on each one (None for a requested package).
+        self.missing: List[Tuple[str, Optional[str]]] = []
+
+    @property
+    def download_size(self) -> int:
+        return sum(package.download_size for package in self.packages.values())
+
+    @property
+    def installed_size(self) -> int:
+        return sum(
+            package.installed_size for package in self.packages.values()
+        )
+
+    def summary(self) -> str:
+        return (
+            f"Resolved {len(self.packages)} packages: "
+            f"{format_size(self.download_size)} to download, "
+            f"{format_size(self.installed_size)} installed"
+        )
+
+    def errors(self) -> List[str]:
+        return [
+            f"Package '{name}' not found" if required_by is None else
+            f"Package '{name}' required by '{required_by}' not found"
+            for name, required_by in self.missing
+        ]
+
+
+def resolve(index: SyncIndex, names: Iterable[str]) -> Resolution:
+    """
+    The dependency closure of the requested package (or group) names, as
+    pacman would install it. Version constraints are not checked.
+    """
+    resolution = Resolution()
+    queue = collections.deque((name, None) for name in names)
+    satisfied: Set[str] = set()
+    while queue:
+        name, required_by = queue.popleft()
+        if name in satisfied:
+            continue
+        satisfied.add(name)
+
+        package = index.package(name)
+        if package:
+            targets = [package]
+        elif required_by is None and index.group(name):
+            targets = index.group(name)
+        else:
+            targets = index.providers(name)[:1]
+        if not targets:
+            resolution.missing.append((name, required_by))
+            continue
+
+        for package in targets:
+            if package.name in resolution.packages:
+                continue
+            resolution.packages[package.name] = package
+            satisfied.add(package.name)
+            satisfied.update(
+                dependency_name(provided) for provided in package.provides
+            )
+            queue.extend(
+                (dependency_name(dependency), package.name)
+                for dependency in package.depends
+            )
+    return resolution
+
+
+def preflight(
+    packages: Iterable[str],
+    sync_dir: str = DEFAULT_SYNC_DIR,
+    repositories: Optional[Iterable[str]] = None,
+    index_dir: str = DEFAULT_INDEX_DIR,
+) -> Resolution:
+    """
+    Resolve the packages to install against the host's sync databases, so
+    that missing packages are found before anything is installed.
+    """
+    start = time.monotonic()
+    with open_index(find_databases(sync_dir, repositories), index_dir) as index:
+        resolution = resolve(index, packages)
+    logging.debug("Preflight took %.3fs", time.monotonic() - start)
+    return resolution
@@ -0,0 +1,135 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        category: str,
+        section: Optional[str] = None,
+        thread: Optional[int] = None,
+    ):
+        self.name = name
+        self.category = category
+        self.section = section
+        self.thread = thread
+        self.start = 0.0
+        self.end = 0.0
+        self.cpu = 0.0
+        self.status: Optional[Union[int, str]] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    """
+    Records the commands of a run as spans, nested as run, section and
+    command, and writes them in the Chrome trace event format understood by
+    chrome://tracing and Perfetto.
+
+    Command spans are recorded on the thread that executed them, so commands
+    that ran concurrently appear in separate lanes. Section spans cover the
+    commands of that section.
+    """
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.run = Span("run", "run")
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def begin(self):
+        self.run.thread = threading.get_ident()
+        self.run.start = self.now()
+
+    def end(self, status: Union[int, str] = 0):
+        self.run.end = self.now()
+        self.run.status = status
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        category: str = "command",
+        section: Optional[str] = None,
+    ) -> Iterator[Span]:
+        span = Span(name, category, section, threading.get_ident())
+        span.start = self.now()
+        try:
+            yield span
+        except BaseException:
+            if span.status is None:
+                span.status = "error"
+            raise
+        finally:
+            span.end = self.now()
+            with self._lock:
+                self.spans.append(span)
+
+    def sections(self) -> List[Span]:
+        sections: Dict[str, Span] = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            if span.section is None:
+                continue
+            section = sections.get(span.section)
+            if not section:
+                section = Span(span.section, "section", thread=self.run.thread)
+                section.start = span.start
+                section.end = span.end
+                section.status = 0
+                sections[span.section] = section
+            section.start = min(section.start, span.start)
+            section.end = max(section.end, span.end)
+            section.cpu += span.cpu
+            if span.status not in (0, "skipped"):
+                section.status = span.status
+        return list(sections.values())
+
+    def events(self) -> List[Dict[str, Any]]:
+        pid = os.getpid()
+        lanes = {self.run.thread: 0}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            lanes.setdefault(span.thread, len(lanes))
+
+        self.run.cpu = sum(span.cpu for span in self.spans)
+        events = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": lane,
+            "args": {
+                "name": "archstrap" if lane == 0 else f"worker {lane}"
+            },
+        } for lane in sorted(lanes.values())]
+        for span in [self.run, *self.sections(), *self.spans]:
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": round(span.start * 1e6),
+                "dur": round(span.duration * 1e6),
+                "pid": pid,
+                "tid": lanes[span.thread],
+                "args": {
+                    "wall_s": round(span.duration, 6),
+                    "cpu_s": round(span.cpu, 6),
+                    "status": span.status,
+                },
+            })
+        return events
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": self.events(),
+                "displayTimeUnit": "ms",
+            }, f)
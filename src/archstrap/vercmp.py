@@ -0,0 +1,85 @@
+import functools
+from typing import Optional, Tuple
+
+
+def _split(version: str) -> Tuple[str, str, Optional[str]]:
+    """
+    Split `[epoch:]version[-release]` the way pacman does.
+    """
+    digits = 0
+    while digits < len(version) and version[digits].isdigit():
+        digits += 1
+    epoch = "0"
+    if version[digits:digits + 1] == ":":
+        epoch = version[:digits] or "0"
+        version = version[digits + 1:]
+    release = None
+    if "-" in version:
+        version, release = version.rsplit("-", 1)
+    return epoch, version, release
+
+
+def _rpmvercmp(a: str, b: str) -> int:
+    if a == b:
+        return 0
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        # Skip the separators, which must be the same length in both.
+        start_a, start_b = i, j
+        while i < len(a) and not a[i].isalnum():
+            i += 1
+        while j < len(b) and not b[j].isalnum():
+            j += 1
+        if i == len(a) or j == len(b):
+            break
+        if i - start_a != j - start_b:
+            return -1 if i - start_a < j - start_b else 1
+
+        # Compare the next segment of digits or of letters.
+        numeric = a[i].isdigit()
+        same = str.isdigit if numeric else str.isalpha
+        end_a, end_b = i, j
+        while end_a < len(a) and same(a[end_a]):
+            end_a += 1
+        while end_b < len(b) and same(b[end_b]):
+            end_b += 1
+        segment_a, segment_b = a[i:end_a], b[j:end_b]
+        if not segment_b:
+            # Numeric segments are newer than alphabetic ones.
+            return 1 if numeric else -1
+        if numeric:
+            segment_a = segment_a.lstrip("0")
+            segment_b = segment_b.lstrip("0")
+            if len(segment_a) != len(segment_b):
+                return -1 if len(segment_a) < len(segment_b) else 1
+        if segment_a != segment_b:
+            return -1 if segment_a < segment_b else 1
+        i, j = end_a, end_b
+
+    if i == len(a) and j == len(b):
+        return 0
+    # A trailing alphabetic segment, like the "alpha" of "1.0alpha", is older
+    # than nothing at all; anything else is newer.
+    if (i == len(a) and not b[j].isalpha()) or (i < len(a) and a[i].isalpha()):
+        return -1
+    return 1
+
+
+def vercmp(a: str, b: str) -> int:
+    """
+    Compare two package versions like `vercmp` from pacman: negative if `a` is
+    older than `b`, zero if they are equal and positive if it is newer.
+    """
+    epoch_a, version_a, release_a = _split(a)
+    epoch_b, version_b, release_b = _split(b)
+    result = _rpmvercmp(epoch_a, epoch_b)
+    if not result:
+        result = _rpmvercmp(version_a, version_b)
+    if not result and release_a is not None and release_b is not None:
+        result = _rpmvercmp(release_a, release_b)
+    return result
+
+
+# Sorts versions from oldest to newest, e.g. as `key=version_key`.
+version_key = functools.cmp_to_key(vercmp)
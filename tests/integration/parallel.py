@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Run the integration cases concurrently and write a single report.
+
+Every case gets its own install root: a new filesystem in its own loop device,
+or with --rootless, a tmpfs in its own user and mount namespace. The number of
+concurrent cases is capped by the number of CPUs and by how many case
+filesystems fit in the free disk (or, with --rootless, memory).
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+from typing import Dict, List
+
+import test_rootless
+from test_runner import (
+    ARCHSTRAP_ROOT,
+    CASE_SIZE,
+    TEST_CASES_ROOT,
+    TestCase,
+    generate_test_cases,
+    run_case,
+)
+
+DEFAULT_REPORT_DIR = os.path.join(ARCHSTRAP_ROOT, "build", "integration")
+
+
+def default_jobs(rootless: bool) -> int:
+    cpus = os.cpu_count() or 1
+    if rootless:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        fits = available // test_rootless.TMPFS_SIZE
+    else:
+        fits = shutil.disk_usage("/mnt").free // CASE_SIZE
+    return max(1, min(cpus, fits))
+
+
+def run(case: TestCase, rootless: bool, report_dir: str) -> Dict:
+    stem = os.path.splitext(case.name)[0]
+    log_path = os.path.join(report_dir, f"{stem}.log")
+    result = {"name": case.name, "log": log_path, "error": None}
+    start = time.monotonic()
+    with open(log_path, "w") as log:
+        try:
+            if rootless:
+                files = test_rootless.run_case(case.path, log)
+                missing = test_rootless.missing_files(files)
+                if missing:
+                    raise AssertionError(f"Missing files: {missing}")
+            else:
+                run_case(case.path, log)
+        except Exception as e:
+            log.write(traceback.format_exc())
+            result["error"] = str(e)
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def render_report(results: List[Dict], wall_time: float) -> List[str]:
+    width = max([len("CASE"), *(len(result["name"]) for result in results)])
+    lines = [f"{'CASE'.ljust(width)}  STATUS  TIME"]
+    for result in results:
+        status = "FAIL" if result["error"] else "ok"
+        lines.append(
+            f"{result['name'].ljust(width)}  {status.ljust(6)}  "
+            f"{result['seconds']:.1f}s"
+        )
+    total = sum(result["seconds"] for result in results)
+    lines.append(
+        f"{len(results)} cases in {wall_time:.1f}s ({total:.1f}s sequential)"
+    )
+    for result in results:
+        if result["error"]:
+            lines.append(
+                f"{result['name']}: {result['error']} ({result['log']})"
+            )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rootless",
+        action="store_true",
+        help="Run every case in an unprivileged namespace with stub tools.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Maximum number of concurrent cases (default: by CPU and disk).",
+    )
+    parser.add_argument(
+        "--report-dir",
+        default=DEFAULT_REPORT_DIR,
+        help=
+        f"Directory for logs and report.json (default: {DEFAULT_REPORT_DIR}).",
+    )
+    parser.add_argument(
+        "cases",
+        nargs="*",
+        help="Case names to run (default: all).",
+    )
+    args = parser.parse_args()
+
+    cases = sorted(
+        generate_test_cases(TEST_CASES_ROOT),
+        key=lambda case: case.name,
+    )
+    if args.cases:
+        cases = [
+            case for case in cases
+            if case.name in args.cases or
+            os.path.splitext(case.name)[0] in args.cases
+        ]
+    jobs = args.jobs or default_jobs(args.rootless)
+    os.makedirs(args.report_dir, exist_ok=True)
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = list(
+            executor.map(
+                lambda case: run(case, args.rootless, args.report_dir),
+                cases,
+            )
+        )
+    wall_time = time.monotonic() - start
+
+    with open(os.path.join(args.report_dir, "report.json"), "w") as f:
+        json.dump(
+            {"jobs": jobs, "wall_time": wall_time, "cases": results},
+            f,
+            indent=2,
+        )
+    for line in render_report(results, wall_time):
+        print(line)
+    return 1 if any(result["error"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import os
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import IO, List, Optional, Set
+
+from test_runner import (
+    ARCHSTRAP_ROOT,
+    SRC_DIR,
+    TEST_CASES_ROOT,
+    archstrap_command,
+    generate_test_cases,
+)
+
+STUBS_DIR = os.path.join(ARCHSTRAP_ROOT, "tests", "stubs")
+STUBS_BIN_DIR = os.path.join(STUBS_DIR, "bin")
+STUB_REPO = os.path.join(STUBS_DIR, "repo.json")
+
+# The size of the tmpfs each case is installed onto.
+TMPFS_SIZE = 256 * 2**20
+
+# Files every case must produce in its install root.
+EXPECTED_FILES = [
+    "etc/hosts",
+    "etc/locale.gen",
+    "etc/mkinitcpio.conf",
+    "usr/lib/locale/locale-archive",
+    "boot/vmlinuz-linux",
+    "boot/initramfs-linux-fallback.img",
+]
+
+# Run inside a new user and mount namespace, where the calling user is root:
+# mount a tmpfs over the install root, run the script with the stubs in front
+# of PATH, and list the files it created. The tmpfs disappears along with the
+# namespace, so nothing is left behind on the host.
+NAMESPACE_SCRIPT = """\
+set -e
+mount -t tmpfs -o size="$4",mode=0755 archstrap "$1"
+PATH="$2:$PATH" bash "$3" >&2
+cd "$1"
+find . -type f
+"""
+
+
+def namespace_command(argv: List[str]) -> List[str]:
+    return ["unshare", "--user", "--map-root-user", "--mount", *argv]
+
+
+def namespaces_available() -> bool:
+    if not shutil.which("unshare"):
+        return False
+    return subprocess.call(
+        namespace_command(["true"]),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    ) == 0
+
+
+def run_case(path: str, log: Optional[IO] = None) -> Set[str]:
+    """
+    Install the specification at `path` onto a tmpfs in a new namespace,
+    writing the output of the generated script to `log`, and return the paths
+    of the files it created, relative to the install root.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        install_root = os.path.join(temp_dir, "root")
+        os.mkdir(install_root)
+        script = os.path.join(temp_dir, "install.sh")
+
+        argv = archstrap_command(SRC_DIR, install_root, "shell", path)
+        with open(script, "wb") as f:
+            subprocess.check_call(
+                [sys.executable, *argv[1:]],
+                stdout=f,
+                stderr=log,
+            )
+
+        env = dict(os.environ)
+        env["ARCHSTRAP_STUB_SCALE"] = "0"
+        env["ARCHSTRAP_STUB_REPO"] = STUB_REPO
+        output = subprocess.check_output(
+            namespace_command([
+                "sh",
+                "-c",
+                NAMESPACE_SCRIPT,
+                "sh",
+                install_root,
+                STUBS_BIN_DIR,
+                script,
+                str(TMPFS_SIZE),
+            ]),
+            env=env,
+            stderr=log,
+        ).decode("utf-8")
+
+    return {line[len("./"):] for line in output.splitlines()}
+
+
+def missing_files(files: Set[str]) -> List[str]:
+    logging.debug("Install root contains %d files", len(files))
+    return [path for path in EXPECTED_FILES if path not in files]
+
+
+def make_test_fn():
+    def test_fn(self):
+        self.assertEqual(missing_files(run_case(self._test_case.path)), [])
+
+    return test_fn
+
+
+for case in generate_test_cases(TEST_CASES_ROOT):
+    classname = f"TestRootless_{case.name}"
+    globals()[classname] = unittest.skipUnless(
+        namespaces_available(),
+        "unprivileged user namespaces are not available",
+    )(
+        type(
+            classname,
+            (unittest.TestCase, ),
+            {
+                f"test_{case.name}": make_test_fn(),
+                "_test_case": case,
+            },
+        )
+    )
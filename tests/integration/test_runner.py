@@ -3,7 +3,7 @@ import logging
 import subprocess
 import tempfile
 import unittest
-from typing import Iterable
+from typing import IO, Iterable, Optional
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -15,18 +15,27 @@ TEST_CASES_ROOT = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "cases")
 )
 
+# The size of the filesystem each case is installed onto.
+CASE_SIZE = 2 * 2**30
+
+# Each case's filesystem is thrown away afterwards, so cases are installed
+# with --unsafe-fast-io wherever the host has the library that needs.
+EATMYDATA_LIBRARY = "/usr/lib/libeatmydata.so"
+
 
 def archstrap_command(
     archstrap: str,
     install_root: str,
     mode: str,
     spec: str,
+    options: Iterable[str] = (),
 ) -> Iterable[str]:
     return [
         "python",
         archstrap,
         f"--install-root={install_root}",
         f"--mode={mode}",
+        *options,
         spec,
     ]
 
@@ -46,7 +55,6 @@ class TempFile:
 
     def __del__(self):
         logging.debug("Deleting temporary file %s", self.path)
-        subprocess.call(["sync"])
         os.unlink(self.path)
 
 
@@ -79,12 +87,10 @@ class TempLoopDevice:
         logging.debug("TempLoopDevice.close")
         if self.loop:
             logging.debug("Detaching loop device %s", self.loop)
-            subprocess.call(["sync"])
             subprocess.check_call(["losetup", "--detach", self.loop])
             self.loop = None
         if self.path:
             logging.debug("Removing tempfile %s", self.path)
-            subprocess.call(["sync"])
             subprocess.check_call(["rm", "--force", self.path])
             self.path = None
 
@@ -103,30 +109,59 @@ class Mount:
         self.dest = dest
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         if self.dest:
+            # Unmounting writes back everything on this filesystem, and no
+            # other, unlike a global sync.
             logging.debug("Unmounting filesystem from %s", self.src)
-            subprocess.call(["sync"])
             subprocess.call(["umount", self.src])
-
-
-def make_test_fn():
-    def test_fn(self):
-        temp_loop = TempLoopDevice(str(2 * 2**30), dir="/mnt")
-        install_root = tempfile.TemporaryDirectory(dir="/mnt")
+            self.dest = None
+
+
+def run_case(path: str, log: Optional[IO] = None):
+    """
+    Install the specification at `path` onto a new filesystem in its own loop
+    device, writing the output of the generated script to `log`. Everything
+    is torn down before returning, so cases can run concurrently.
+    """
+    temp_loop = TempLoopDevice(str(CASE_SIZE), dir="/mnt")
+    install_root = tempfile.TemporaryDirectory(dir="/mnt")
+    try:
         mount = Mount(temp_loop.loop, install_root.name)
-
-        content = subprocess.check_output(
-            archstrap_command(
-                SRC_DIR,
-                install_root.name,
-                "shell",
-                self._test_case.path,
+        try:
+            options = []
+            if os.path.exists(EATMYDATA_LIBRARY):
+                options.append("--unsafe-fast-io")
+            content = subprocess.check_output(
+                archstrap_command(
+                    SRC_DIR,
+                    install_root.name,
+                    "shell",
+                    path,
+                    options,
+                ),
+                stderr=log,
+            ).decode("utf-8")
+
+            output_file = TempFile(content)
+
+            subprocess.check_call(
+                ["bash", output_file.path],
+                stdout=log,
+                stderr=log,
             )
-        ).decode("utf-8")
+        finally:
+            mount.close()
+    finally:
+        install_root.cleanup()
+        temp_loop.close()
 
-        output_file = TempFile(content)
 
-        subprocess.check_call(["bash", output_file.path])
+def make_test_fn():
+    def test_fn(self):
+        run_case(self._test_case.path)
 
     return test_fn
 
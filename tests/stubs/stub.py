@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the tools that archstrap runs (pacstrap, arch-chroot, chroot,
+mkinitcpio, systemd-firstboot, mount and umount). Each is a symlink to this
+script in the `bin` directory next to it; put that directory first on PATH.
+
+Every stub sleeps for a latency like that of the real tool, scaled by
+ARCHSTRAP_STUB_SCALE (default: 1), and creates the files later steps expect,
+so that an exec mode run completes without root, a network or an Arch
+Linux host. Commands run by chroot and arch-chroot are simulated as well,
+rather than run.
+
+If ARCHSTRAP_STUB_REPO names a JSON file mapping package names to the files
+(and, ending in a slash, directories) they contain, pacstrap installs
+packages from it, and fails like pacman does for a package it lacks.
+"""
+
+import json
+import os
+import sys
+import time
+from typing import List
+
+KERNEL_VERSION = "6.6.6-arch1-1"
+
+# Latency in seconds of each tool: a fixed part, plus a part per package for
+# pacstrap.
+LATENCIES = {
+    "pacstrap": 5.0,
+    "pacstrap-package": 0.5,
+    "mkinitcpio": 4.0,
+    "locale-gen": 1.5,
+    "systemd-firstboot": 0.1,
+    "hwclock": 0.05,
+    "passwd": 0.05,
+    "mount": 0.005,
+    "umount": 0.005,
+    "chroot": 0.01,
+    "arch-chroot": 0.2,
+}
+
+
+def sleep(seconds: float):
+    time.sleep(seconds * float(os.environ.get("ARCHSTRAP_STUB_SCALE", "1")))
+
+
+def touch(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+
+def pacstrap(argv: List[str]):
+    args = [arg for arg in argv if not arg.startswith("-")]
+    if "-C" in argv:
+        args.remove(argv[argv.index("-C") + 1])
+    root, packages = args[0], args[1:]
+    sleep(LATENCIES["pacstrap"] + LATENCIES["pacstrap-package"] * len(packages))
+
+    for directory in (
+        "etc/pacman.d",
+        "boot",
+        "usr/lib/locale",
+        f"usr/lib/modules/{KERNEL_VERSION}",
+        "proc",
+        "sys",
+        "dev/pts",
+        "dev/shm",
+        "run",
+        "tmp",
+    ):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    repo_path = os.environ.get("ARCHSTRAP_STUB_REPO")
+    if not repo_path:
+        for package in packages:
+            if package.startswith("linux") and not package.endswith(
+                    ("-headers", "-firmware")):
+                touch(os.path.join(root, "boot", f"vmlinuz-{package}"))
+        return
+
+    with open(repo_path, "r") as f:
+        repo = json.load(f)
+    missing = [package for package in packages if package not in repo]
+    if missing:
+        for package in missing:
+            print(f"error: target not found: {package}", file=sys.stderr)
+        sys.exit(1)
+    for package in packages:
+        for path in repo[package]:
+            if path.endswith("/"):
+                os.makedirs(os.path.join(root, path), exist_ok=True)
+            else:
+                touch(os.path.join(root, path))
+
+
+def in_root(root: str, argv: List[str]):
+    name = os.path.basename(argv[0])
+    if name == "sh":
+        # e.g. a batch of commands from the plan: simulate each line.
+        for line in argv[-1].splitlines():
+            words = line.split()
+            if words and words[0] in LATENCIES:
+                in_root(root, words)
+        return
+    sleep(LATENCIES.get(name, 0.0))
+    if name == "mkinitcpio" and "--generate" in argv:
+        image = argv[argv.index("--generate") + 1]
+        touch(os.path.join(root, image.lstrip("/")))
+    elif name == "locale-gen":
+        touch(os.path.join(root, "usr/lib/locale/locale-archive"))
+    elif name == "hwclock":
+        touch(os.path.join(root, "etc/adjtime"))
+
+
+def systemd_firstboot(argv: List[str]):
+    sleep(LATENCIES["systemd-firstboot"])
+    roots = [arg[len("--root="):] for arg in argv if arg.startswith("--root=")]
+    if not roots:
+        return
+    files = [
+        "machine-id",
+        "localtime",
+        "locale.conf",
+        "vconsole.conf",
+        "hostname",
+    ]
+    if any(arg.startswith("--root-password=") for arg in argv):
+        files.append("shadow")
+    for path in files:
+        touch(os.path.join(roots[0], "etc", path))
+
+
+def main(argv: List[str]):
+    name = os.path.basename(argv[0])
+    if name == "pacstrap":
+        pacstrap(argv[1:])
+    elif name in ("chroot", "arch-chroot"):
+        sleep(LATENCIES[name])
+        in_root(argv[1], argv[2:])
+    elif name == "systemd-firstboot":
+        systemd_firstboot(argv[1:])
+    else:
+        # Never touches the host's files.
+        sleep(LATENCIES.get(name, 0.0))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,202 @@
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap import syncdb
+from archstrap.bundle import (
+    DATABASE,
+    REPOSITORY,
+    Bundle,
+    BundleWriter,
+    create_bundle,
+    fetch,
+    render_pacman_conf,
+)
+
+
+def make_database(path, packages):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, (content, depends) in packages.items():
+            filename = f"{name}-1-1-x86_64.pkg.tar.zst"
+            desc = "".join([
+                f"%FILENAME%\n{filename}\n\n",
+                f"%NAME%\n{name}\n\n",
+                "%VERSION%\n1-1\n\n",
+                f"%CSIZE%\n{len(content)}\n\n",
+                f"%SHA256SUM%\n{hashlib.sha256(content).hexdigest()}\n\n",
+                "%DEPENDS%\n" + "".join(f"{dep}\n" for dep in depends) + "\n",
+            ]).encode("utf-8")
+            info = tarfile.TarInfo(f"{name}-1-1/desc")
+            info.size = len(desc)
+            tar.addfile(info, io.BytesIO(desc))
+
+
+def write_file(directory, name, content):
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(content)
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.path = os.path.join(self.temp_dir, "packages.bundle")
+        self.index_dir = os.path.join(self.temp_dir, "index")
+
+    def test_round_trip(self):
+        with BundleWriter(self.path) as writer:
+            writer.add("a", io.BytesIO(b"first"))
+            writer.add("b", io.BytesIO(b""))
+            writer.add("c", io.BytesIO(b"third" * 100000))
+
+        with Bundle(self.path) as bundle:
+            self.assertListEqual(["a", "b", "c"], bundle.names())
+            self.assertEqual(b"first", bundle.read("a"))
+            self.assertEqual(b"", bundle.read("b"))
+            self.assertEqual(b"third" * 100000, bundle.read("c"))
+            with self.assertRaises(KeyError):
+                bundle.read("d")
+
+            output = os.path.join(self.temp_dir, "output")
+            with open(output, "wb") as f:
+                f.write(b"header")
+                bundle.copy("a", f)
+            with open(output, "rb") as f:
+                self.assertEqual(b"headerfirst", f.read())
+
+    def test_failed_write_leaves_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with BundleWriter(self.path) as writer:
+                writer.add("a", io.BytesIO(b"first"))
+                raise RuntimeError()
+
+        self.assertListEqual([], os.listdir(self.temp_dir))
+
+    def test_invalid_bundle(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a bundle" * 10)
+        with self.assertRaises(ValueError):
+            Bundle(self.path)
+
+    def test_fetch(self):
+        with BundleWriter(self.path) as writer:
+            writer.add("a-1-1-any.pkg.tar.zst", io.BytesIO(b"package"))
+
+        output = os.path.join(self.temp_dir, "a-1-1-any.pkg.tar.zst.part")
+        fetch(
+            self.path,
+            output,
+            "https://archstrap-bundle.invalid/a-1-1-any.pkg.tar.zst",
+        )
+        with open(output, "rb") as f:
+            self.assertEqual(b"package", f.read())
+
+        with self.assertRaises(FileNotFoundError):
+            fetch(self.path, output, "https://archstrap-bundle.invalid/b")
+
+    def test_render_pacman_conf(self):
+        lines = render_pacman_conf("/bundle", ["archstrap", "bundle-fetch"])
+
+        self.assertIn(
+            "XferCommand = archstrap bundle-fetch /bundle %o %u",
+            lines,
+        )
+        self.assertListEqual(
+            [f"[{REPOSITORY}]", "Server = https://archstrap-bundle.invalid"],
+            lines[-2:],
+        )
+
+    def make_repository(self):
+        sync_dir = os.path.join(self.temp_dir, "sync")
+        cache_dir = os.path.join(self.temp_dir, "cache")
+        mirror_dir = os.path.join(self.temp_dir, "mirror", "core", "x86_64")
+        for directory in (sync_dir, cache_dir, mirror_dir):
+            os.makedirs(directory)
+        make_database(
+            os.path.join(sync_dir, "core.db"),
+            {
+                "base": (b"base package", ["glibc>=2"]),
+                "glibc": (b"glibc package", []),
+                "vim": (b"vim package", []),
+            },
+        )
+        write_file(cache_dir, "base-1-1-x86_64.pkg.tar.zst", b"base package")
+        write_file(mirror_dir, "glibc-1-1-x86_64.pkg.tar.zst", b"glibc package")
+        server = f"file://{self.temp_dir}/mirror/$repo/$arch"
+        return sync_dir, cache_dir, server
+
+    def test_create_bundle(self):
+        sync_dir, cache_dir, server = self.make_repository()
+
+        resolution = create_bundle(
+            ["base"],
+            self.path,
+            sync_dir,
+            cache_dirs=[cache_dir],
+            servers=[server],
+            index_dir=self.index_dir,
+        )
+
+        self.assertListEqual(["base", "glibc"], list(resolution.packages))
+        with Bundle(self.path) as bundle:
+            self.assertListEqual(
+                [
+                    DATABASE,
+                    "base-1-1-x86_64.pkg.tar.zst",
+                    "glibc-1-1-x86_64.pkg.tar.zst",
+                ],
+                bundle.names(),
+            )
+            self.assertEqual(
+                b"glibc package",
+                bundle.read("glibc-1-1-x86_64.pkg.tar.zst"),
+            )
+            database = os.path.join(self.temp_dir, DATABASE)
+            with open(database, "wb") as f:
+                bundle.copy(DATABASE, f)
+        self.assertListEqual(
+            ["base", "glibc"],
+            sorted(
+                package.name
+                for package in syncdb.read_database(database, REPOSITORY)
+            ),
+        )
+
+    def test_create_bundle_missing_package(self):
+        sync_dir, cache_dir, server = self.make_repository()
+
+        with self.assertRaises(ValueError):
+            create_bundle(
+                ["emacs"],
+                self.path,
+                sync_dir,
+                index_dir=self.index_dir,
+            )
+        with self.assertRaises(FileNotFoundError):
+            create_bundle(
+                ["vim"],
+                self.path,
+                sync_dir,
+                cache_dirs=[cache_dir],
+                index_dir=self.index_dir,
+            )
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_create_bundle_checksum_mismatch(self):
+        sync_dir, cache_dir, server = self.make_repository()
+        write_file(cache_dir, "vim-1-1-x86_64.pkg.tar.zst", b"corrupt")
+
+        with self.assertRaises(ValueError):
+            create_bundle(
+                ["vim"],
+                self.path,
+                sync_dir,
+                cache_dirs=[cache_dir],
+                index_dir=self.index_dir,
+            )
@@ -0,0 +1,136 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap.cache import (
+    PackageCache,
+    format_size,
+    parse_size,
+    touch_command,
+)
+
+
+def make_package(directory, name, size, mtime, sig=False):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(path, (mtime, mtime))
+    if sig:
+        with open(f"{path}.sig", "wb") as f:
+            f.write(b"\0")
+    return path
+
+
+class ParseSizeTest(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(10, parse_size(10))
+        self.assertEqual(10, parse_size("10"))
+        self.assertEqual(2 * 2**10, parse_size("2K"))
+        self.assertEqual(3 * 2**30, parse_size("3GiB"))
+        with self.assertRaises(ValueError):
+            parse_size("lots")
+
+    def test_format_size(self):
+        self.assertEqual("512", format_size(512))
+        self.assertEqual("2.0K", format_size(2 * 2**10))
+        self.assertEqual("1.5G", format_size(3 * 2**29))
+
+
+class PackageCacheTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = temp_dir.name
+
+    def test_entries(self):
+        make_package(self.path, "linux-api-headers-6.4-1-x86_64.pkg.tar.zst", 4, 1)
+        make_package(self.path, "not-a-package.txt", 4, 1)
+
+        entries = PackageCache(self.path).entries()
+
+        self.assertEqual(1, len(entries))
+        self.assertEqual("linux-api-headers", entries[0].name)
+        self.assertEqual("6.4-1", entries[0].version)
+
+    def test_evict_unlimited(self):
+        make_package(self.path, "a-1-1-any.pkg.tar.zst", 4, 1)
+
+        self.assertListEqual([], PackageCache(self.path).evict())
+
+    def test_evict_old_versions_first(self):
+        old = make_package(self.path, "a-1-1-any.pkg.tar.zst", 4, 1, sig=True)
+        new = make_package(self.path, "a-2-1-any.pkg.tar.zst", 4, 3)
+        other = make_package(self.path, "b-1-1-any.pkg.tar.zst", 4, 2)
+
+        cache = PackageCache(self.path, max_size=8)
+        evicted = cache.evict()
+
+        self.assertListEqual([old], [entry.path for entry in evicted])
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(f"{old}.sig"))
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(other))
+
+    def test_evict_old_versions_by_version(self):
+        # Downloaded after the newer version, e.g. by a downgrade.
+        old = make_package(self.path, "a-1.10-1-any.pkg.tar.zst", 4, 3)
+        new = make_package(self.path, "a-1:1.9-1-any.pkg.tar.zst", 4, 1)
+        other = make_package(self.path, "b-1-1-any.pkg.tar.zst", 4, 4)
+        newest = make_package(self.path, "c-1.10-1-any.pkg.tar.zst", 4, 1)
+        older = make_package(self.path, "c-1.9-1-any.pkg.tar.zst", 4, 2)
+
+        cache = PackageCache(self.path, max_size=12)
+        evicted = cache.evict()
+
+        self.assertListEqual(
+            [older, old],
+            [entry.path for entry in evicted],
+        )
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(newest))
+        self.assertTrue(os.path.exists(other))
+
+    def test_evict_least_recently_used(self):
+        first = make_package(self.path, "a-1-1-any.pkg.tar.zst", 4, 2)
+        second = make_package(self.path, "b-1-1-any.pkg.tar.zst", 4, 1)
+        third = make_package(self.path, "c-1-1-any.pkg.tar.zst", 4, 3)
+
+        cache = PackageCache(self.path, max_size="5")
+        evicted = cache.evict()
+
+        self.assertListEqual(
+            [second, first],
+            [entry.path for entry in evicted],
+        )
+        self.assertEqual(4, cache.size())
+        self.assertTrue(os.path.exists(third))
+
+    def test_touch_command(self):
+        used = make_package(self.path, "a-1-1-any.pkg.tar.zst", 4, 1, sig=True)
+        unused = make_package(self.path, "b-1-1-any.pkg.tar.zst", 4, 1)
+        root = os.path.join(self.path, "root")
+        os.makedirs(os.path.join(root, "var/lib/pacman/local/a-1-1"))
+        os.makedirs(os.path.join(root, "var/lib/pacman/local/c-1-1"))
+
+        subprocess.run(touch_command(self.path, root), check=True)
+
+        entries = {
+            entry.path: entry
+            for entry in PackageCache(self.path).entries()
+        }
+        self.assertGreater(entries[used].last_used, 1)
+        self.assertEqual(1, os.stat(used).st_mtime)
+        self.assertEqual(1, entries[unused].last_used)
+        # Packages that are not cached are not created.
+        self.assertEqual(
+            {
+                "root",
+                os.path.basename(used),
+                f"{os.path.basename(used)}.sig",
+                os.path.basename(unused),
+            },
+            set(os.listdir(self.path)),
+        )
@@ -0,0 +1,87 @@
+import unittest
+
+from context import archstrap
+
+from archstrap.command import Command, FileWrite
+
+
+class CommandTest(unittest.TestCase):
+    def test_render(self):
+        self.assertEqual("ls -l", Command(["ls", "-l"]).render())
+        self.assertEqual(
+            "passwd 'it'\"'\"'s a secret'",
+            Command(["passwd", "it's a secret"]).render(),
+        )
+
+    def test_render_env(self):
+        self.assertEqual(
+            "A=1 B='two words' env",
+            Command(["env"], env={"B": "two words", "A": "1"}).render(),
+        )
+
+    def test_render_redirect(self):
+        self.assertEqual(
+            "echo hi > '/tmp/some file'",
+            Command(["echo", "hi"], stdout="/tmp/some file").render(),
+        )
+        self.assertEqual(
+            "echo hi >> file",
+            Command(["echo", "hi"], stdout="file", append=True).render(),
+        )
+
+    def test_render_write(self):
+        self.assertEqual(
+            "cat > file <<'EOF'\nServer = $repo\nEOF",
+            Command.write("file", ["Server = $repo"]).render(),
+        )
+
+    def test_render_heredoc_delimiter(self):
+        self.assertEqual(
+            "cat > file <<'EOF_1'\nEOF\nEOF_1",
+            Command.write("file", ["EOF"]).render(),
+        )
+
+    def test_render_stdin_without_newline(self):
+        self.assertEqual(
+            "cat <<'EOF'\ntext\nEOF",
+            Command(["cat"], stdin="text").render(),
+        )
+
+    def test_equality(self):
+        self.assertEqual(Command(["a", "b"]), Command(["a", "b"]))
+        self.assertNotEqual(Command(["a", "b"]), Command(["a b"]))
+        self.assertNotEqual(
+            Command.write("file", ["a"]),
+            Command.write("file", ["a"], append=True),
+        )
+        self.assertEqual(
+            hash(Command(["a"], env={"X": "1"})),
+            hash(Command(["a"], env={"X": "1"})),
+        )
+
+    def test_render_chroot(self):
+        self.assertEqual(
+            "arch-chroot /mnt locale-gen",
+            Command(["locale-gen"], chroot="/mnt").render(),
+        )
+        self.assertNotEqual(
+            Command(["locale-gen"]),
+            Command(["locale-gen"], chroot="/mnt"),
+        )
+
+    def test_in_root(self):
+        command = Command(["passwd"], env={"X": "1"}, chroot="/mnt")
+        self.assertEqual(
+            Command(["chroot", "/mnt", "passwd"], env={"X": "1"}),
+            command.in_root(["chroot", "/mnt"]),
+        )
+
+    def test_file_write(self):
+        write = Command.write("file", ["a", "b"], append=True)
+        self.assertIsInstance(write, FileWrite)
+        self.assertEqual("file", write.path)
+        self.assertEqual("a\nb\n", write.content)
+        self.assertEqual(
+            Command(["cat"], stdin="a\nb\n", stdout="file", append=True),
+            write,
+        )
@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import MagicMock, call
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.fastio import environment, finish, library_path, setup
+
+
+class FastIoTest(unittest.TestCase):
+    def test_environment(self):
+        self.assertDictEqual(
+            {
+                "LD_PRELOAD": "libeatmydata.so",
+                "LD_LIBRARY_PATH": "/.archstrap/eatmydata",
+            },
+            environment(),
+        )
+
+    def test_setup(self):
+        mode = MagicMock()
+
+        setup("root", mode, "/host/libeatmydata.so")
+
+        mode.on_section.assert_called_once_with("Disable Fsync")
+        self.assertEqual(
+            "root/.archstrap/eatmydata/libeatmydata.so",
+            library_path("root"),
+        )
+        mode.on_command.assert_has_calls([
+            call(
+                Command(["mkdir", "-p", "root/.archstrap/eatmydata"]),
+                writes=["root/.archstrap/eatmydata"],
+            ),
+            call(
+                Command([
+                    "cp",
+                    "/host/libeatmydata.so",
+                    "root/.archstrap/eatmydata/libeatmydata.so",
+                ]),
+                reads=["root/.archstrap/eatmydata"],
+                writes=["root/.archstrap/eatmydata/libeatmydata.so"],
+            ),
+        ])
+
+    def test_finish(self):
+        mode = MagicMock()
+
+        finish("root", mode)
+
+        mode.on_section.assert_called_once_with("Sync")
+        self.assertListEqual(
+            [
+                call(Command(["rm", "-rf", "root/.archstrap/eatmydata"])),
+                call(Command(["sync", "--file-system", "root"])),
+            ],
+            mode.on_command.call_args_list,
+        )
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.fleet import (
+    Result,
+    Target,
+    apply_target,
+    load_manifest,
+    run_fleet,
+    summarize,
+)
+from archstrap.mode import spawn
+
+SPECIFICATION = {
+    "system": {
+        "timezone": "UTC",
+        "locale": "en_US.UTF-8",
+        "charset": "UTF-8",
+        "keymap": "us",
+        "hostname": "host",
+        "root_password": "password",
+    },
+}
+
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.log_dir = os.path.join(self.dir, "logs")
+        os.makedirs(self.log_dir)
+
+        self.spec_path = os.path.join(self.dir, "spec.json")
+        with open(self.spec_path, "w") as f:
+            json.dump(SPECIFICATION, f)
+
+    def write_manifest(self, manifest):
+        path = os.path.join(self.dir, "manifest.json")
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        return path
+
+    def test_load_manifest(self):
+        path = self.write_manifest({
+            "targets": [
+                {"specification": "spec.json", "install_root": "/mnt/a"},
+                {
+                    "specification": "spec.json",
+                    "install_root": "/mnt/b",
+                    "name": "b",
+                },
+            ],
+        })
+
+        targets = load_manifest(path)
+
+        self.assertListEqual(["mnt_a", "b"], [t.name for t in targets])
+        self.assertEqual(self.spec_path, targets[0].specification)
+        self.assertEqual("/mnt/b", targets[1].install_root)
+
+    def test_load_manifest_duplicate_names(self):
+        path = self.write_manifest([
+            {"specification": "spec.json", "install_root": "/mnt/a"},
+            {"specification": "spec.json", "install_root": "/mnt/a/"},
+        ])
+
+        with self.assertRaises(ValueError):
+            load_manifest(path)
+
+    def test_apply_target(self):
+        target = Target("a", self.spec_path, "/mnt/a")
+
+        result = apply_target(target, "shell", self.log_dir)
+
+        self.assertTrue(result.ok)
+        with open(target.output_path(self.log_dir), "r") as f:
+            self.assertTrue(f.read().startswith("#!/usr/bin/bash\n"))
+        with open(target.log_path(self.log_dir), "r") as f:
+            self.assertIn("SECTION Install Packages", f.read())
+
+    def test_apply_target_self_command(self):
+        spec = dict(SPECIFICATION, mirrors={"servers": ["server"]})
+        with open(self.spec_path, "w") as f:
+            json.dump(spec, f)
+        target = Target("a", self.spec_path, "/mnt/a")
+
+        result = apply_target(
+            target,
+            "shell",
+            self.log_dir,
+            self_command=["/host/python3", "/host/archstrap"],
+        )
+
+        self.assertTrue(result.ok)
+        with open(target.output_path(self.log_dir), "r") as f:
+            script = f.read()
+        self.assertIn("\narchstrap rank-mirrors ", script)
+        self.assertNotIn("/host/", script)
+        self.assertTrue(
+            script.rstrip().endswith(
+                "rmdir --ignore-fail-on-non-empty /mnt/a/.archstrap"
+            )
+        )
+
+    def test_apply_target_command_output(self):
+        target = Target("a", self.spec_path, "/mnt/a")
+
+        def run(*args, **kwargs):
+            logging.info("before")
+            spawn(Command(["sh", "-c", "echo printed; echo failed >&2"]))
+            logging.info("after")
+
+        with patch("archstrap.fleet.run", run):
+            result = apply_target(target, "exec", self.log_dir)
+
+        self.assertTrue(result.ok)
+        with open(target.log_path(self.log_dir), "r") as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0].endswith("before"))
+        self.assertListEqual(["printed", "failed"], lines[1:3])
+        self.assertTrue(lines[3].endswith("after"))
+        with open(target.output_path(self.log_dir), "r") as f:
+            self.assertEqual("", f.read())
+
+    def test_apply_target_failure(self):
+        target = Target("a", os.path.join(self.dir, "missing.json"), "/mnt")
+
+        result = apply_target(target, "dryrun", self.log_dir)
+
+        self.assertFalse(result.ok)
+        with open(target.log_path(self.log_dir), "r") as f:
+            self.assertIn("missing.json", f.read())
+
+    def test_run_fleet(self):
+        targets = [
+            Target("a", self.spec_path, "/mnt/a"),
+            Target("b", os.path.join(self.dir, "missing.json"), "/mnt/b"),
+            Target("c", self.spec_path, "/mnt/c"),
+        ]
+
+        results = run_fleet(targets, "dryrun", 2, self.log_dir)
+
+        self.assertListEqual(
+            [("a", True), ("b", False), ("c", True)],
+            [(result.target.name, result.ok) for result in results],
+        )
+
+    def test_summarize(self):
+        results = [
+            Result(Target("a", "spec", "/mnt/a"), True, 1.0),
+            Result(Target("bb", "spec", "/mnt/b"), False, 2.5, "error"),
+        ]
+
+        self.assertListEqual(
+            [
+                "TARGET  STATUS  DURATION  LOG",
+                "a       ok      1.0s      logs/a.log",
+                "bb      FAILED  2.5s      logs/bb.log",
+                "1 succeeded, 1 failed, 3.5s total, 2.5s longest",
+                "bb: error",
+            ],
+            summarize(results, "logs"),
+        )
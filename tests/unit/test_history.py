@@ -0,0 +1,142 @@
+import os
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.history import KEEP, History, Progress, format_duration
+from archstrap.scheduler import Scheduler, Step
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "cache", "history.sqlite")
+
+    def open(self, root="/mnt"):
+        history = History(self.path, root)
+        self.addCleanup(history.close)
+        return history
+
+    def test_format_duration(self):
+        self.assertEqual("5s", format_duration(4.6))
+        self.assertEqual("1m05s", format_duration(65))
+        self.assertEqual("2h03m", format_duration(2 * 3600 + 3 * 60 + 10))
+
+    def test_expected(self):
+        history = self.open()
+        command = Command(["pacstrap", "/mnt", "base"])
+        self.assertIsNone(history.expected(command))
+
+        for duration in (3.0, 1.0, 100.0):
+            history.record(command, duration)
+        self.assertEqual(3.0, history.expected(command))
+
+        history.record(command, 5.0)
+        self.assertEqual(4.0, history.expected(command))
+        self.assertIsNone(history.expected(Command(["pacstrap", "/mnt"])))
+
+    def test_shared_between_roots(self):
+        self.open("/mnt").record(Command(["pacstrap", "/mnt", "base"]), 2.0)
+
+        history = self.open("/srv/target/")
+        self.assertEqual(
+            "pacstrap <root> base",
+            history.normalize(Command(["pacstrap", "/srv/target", "base"])),
+        )
+        self.assertEqual(
+            2.0,
+            history.expected(Command(["pacstrap", "/srv/target", "base"])),
+        )
+
+    def test_normalize_root_prefix(self):
+        history = self.open("/mnt")
+        self.assertEqual(
+            "cp -a '<root>/a b' /mnt2/etc /srv/mnt --root=<root> <root>",
+            history.normalize(
+                Command([
+                    "cp",
+                    "-a",
+                    "/mnt/a b",
+                    "/mnt2/etc",
+                    "/srv/mnt",
+                    "--root=/mnt",
+                    "/mnt",
+                ])
+            ),
+        )
+
+    def test_keeps_recent_durations(self):
+        history = self.open()
+        command = Command(["locale-gen"])
+        for duration in range(KEEP + 5):
+            history.record(command, 100.0 + duration)
+        history.record(command, 1.0)
+
+        rows = history._db.execute("SELECT COUNT(*) FROM durations")
+        self.assertEqual(KEEP, rows.fetchone()[0])
+        self.assertEqual(109.5, history.expected(command))
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        scheduler = Scheduler(2)
+        self.steps = [
+            Step("pacstrap", writes=["root"]),
+            Step("locale-gen", reads=["root"], writes=["locale"]),
+            Step("mkinitcpio", reads=["root"], writes=["initramfs"]),
+            Step("new", reads=["root"], writes=["new"]),
+        ]
+        for step in self.steps:
+            scheduler.add(step)
+        expected = [60.0, 10.0, 30.0, None]
+        self.progress = Progress(
+            self.steps,
+            expected,
+            scheduler.critical_paths([cost or 0.0 for cost in expected]),
+            jobs=2,
+            clock=self.clock,
+        )
+
+    def test_remaining(self):
+        self.assertEqual((90.0, 1), self.progress.remaining())
+
+        self.progress.start(self.steps[0])
+        self.clock.now = 20.0
+        self.assertEqual((70.0, 1), self.progress.remaining())
+
+        self.clock.now = 60.0
+        self.progress.finish(self.steps[0])
+        self.progress.start(self.steps[1])
+        self.progress.start(self.steps[2])
+        self.clock.now = 65.0
+        # 5s of locale-gen and 25s of mkinitcpio left, on two jobs.
+        self.assertEqual((25.0, 1), self.progress.remaining())
+
+        # An overdue step is expected to finish any moment.
+        self.clock.now = 200.0
+        self.assertEqual((0.0, 1), self.progress.remaining())
+
+    def test_status(self):
+        self.progress.start(self.steps[0])
+        self.clock.now = 90.0
+
+        self.assertListEqual(
+            [
+                "PROGRESS 0/4 steps, 1m30s elapsed, about 30s left, plus 1 "
+                "never timed before",
+                "RUNNING pacstrap for 1m30s (usually 1m00s)",
+            ],
+            self.progress.status(running=True),
+        )
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.initrd import (
+    BenchmarkCache,
+    BenchResult,
+    benchmark,
+    choose,
+    kernel_package,
+    kernel_version,
+    render_results,
+)
+
+RESULTS = [
+    BenchResult("zstd", ["-T0", "-1"], 1.0, 300, 0.2),
+    BenchResult("xz", ["-T0", "-9"], 9.0, 100, 0.9),
+    BenchResult("lz4", [], 2.0, 400, 0.1),
+]
+
+
+class ChooseTest(unittest.TestCase):
+    def test_choose(self):
+        self.assertEqual("zstd", choose(RESULTS, "build").compression)
+        self.assertEqual("xz", choose(RESULTS, "size").compression)
+        self.assertEqual("lz4", choose(RESULTS, "boot").compression)
+
+    def test_unknown_goal(self):
+        with self.assertRaises(ValueError):
+            choose(RESULTS, "fast")
+
+
+class BenchmarkCacheTest(unittest.TestCase):
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = BenchmarkCache(os.path.join(temp_dir, "initrd.json"))
+            self.assertEqual([], cache.load("6.1.1"))
+
+            cache.save("6.1.1", RESULTS[:1])
+            cache.save("6.2.1", RESULTS[1:])
+            self.assertEqual(
+                ["zstd"],
+                [result.compression for result in cache.load("6.1.1")],
+            )
+            self.assertEqual(
+                ["xz", "lz4"],
+                [result.compression for result in cache.load()],
+            )
+
+    def test_load_package(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = BenchmarkCache(os.path.join(temp_dir, "initrd.json"))
+            cache.save("6.1.1-arch1-1", RESULTS[:1], "linux")
+            cache.save("6.1.2-lts1-1", RESULTS[1:2], "linux-lts")
+            cache.save("6.2.1-arch1-1", RESULTS[2:], "linux")
+            self.assertEqual(
+                ["lz4"],
+                [result.compression for result in cache.load(package="linux")],
+            )
+            self.assertEqual(
+                ["xz"],
+                [
+                    result.compression
+                    for result in cache.load(package="linux-lts")
+                ],
+            )
+            self.assertEqual([], cache.load(package="linux-zen"))
+
+
+class KernelVersionTest(unittest.TestCase):
+    def test_kernel_version(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertIsNone(kernel_version(temp_dir))
+            os.makedirs(os.path.join(temp_dir, "usr/lib/modules/6.1.1"))
+            os.makedirs(os.path.join(temp_dir, "usr/lib/modules/6.2.1"))
+            self.assertEqual("6.2.1", kernel_version(temp_dir))
+            os.makedirs(os.path.join(temp_dir, "usr/lib/modules/6.10.1"))
+            self.assertEqual("6.10.1", kernel_version(temp_dir))
+
+    def test_kernel_package(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            modules = os.path.join(temp_dir, "usr/lib/modules/6.1.1-lts1-1")
+            os.makedirs(modules)
+            self.assertIsNone(kernel_package(temp_dir, "6.1.1-lts1-1"))
+            with open(os.path.join(modules, "pkgbase"), "w") as f:
+                f.write("linux-lts\n")
+            self.assertEqual(
+                "linux-lts",
+                kernel_package(temp_dir, "6.1.1-lts1-1"),
+            )
+
+
+class BenchmarkTest(unittest.TestCase):
+    @unittest.skipUnless(shutil.which("gzip"), "requires gzip")
+    @patch("archstrap.initrd.spawn")
+    def test_benchmark(self, spawn):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "usr/lib/modules/6.1.1"))
+
+            def mkinitcpio(command: Command):
+                with open(os.path.join(temp_dir, command.argv[2][1:])) as f:
+                    self.assertIn("COMPRESSION=\"cat\"\n", f.read())
+                image = os.path.join(temp_dir, command.argv[-1][1:])
+                with open(image, "wb") as f:
+                    f.write(b"initramfs" * 1024)
+
+            spawn.side_effect = mkinitcpio
+            kernel, results = benchmark(
+                ["HOOKS=(base)", "COMPRESSION=\"xz\""],
+                temp_dir,
+                compressors=[("gzip", ["-1"])],
+                repeat=1,
+            )
+
+            self.assertEqual("6.1.1", kernel)
+            self.assertEqual("gzip -1", results[0].label)
+            self.assertLess(results[0].size, 9 * 1024)
+            self.assertEqual(["usr"], os.listdir(temp_dir))
+            self.assertEqual(
+                "/.archstrap/bench/mkinitcpio.conf",
+                spawn.call_args[0][0].argv[2],
+            )
+
+
+class RenderResultsTest(unittest.TestCase):
+    def test_render_results(self):
+        lines = render_results(RESULTS[:1])
+        self.assertEqual(["COMPRESSION", "BUILD", "SIZE", "DECOMPRESS"],
+                         lines[0].split())
+        self.assertEqual(
+            ["zstd", "-T0", "-1", "1.00s", "0.0M", "0.200s"],
+            lines[1].split(),
+        )
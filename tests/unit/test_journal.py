@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap.journal import Journal, fingerprint, journal_path
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = journal_path(temp_dir.name)
+
+    def test_journal_path(self):
+        self.assertEqual("root/.archstrap/journal", journal_path("root"))
+
+    def test_record(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.record("first")
+        journal.record("second")
+        journal.close()
+
+        with open(self.path, "r") as f:
+            self.assertEqual(
+                f"{fingerprint('first')}\n{fingerprint('second')}\n",
+                f.read(),
+            )
+
+    def test_done_without_resume(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.record("first")
+        journal.close()
+
+        journal = Journal(self.path)
+        journal.open()
+        self.assertFalse(journal.done("first"))
+        journal.close()
+
+    def test_done_with_resume(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.record("repeated")
+        journal.record("other")
+        journal.close()
+
+        journal = Journal(self.path, resume=True)
+        journal.open()
+        self.assertTrue(journal.done("repeated"))
+        self.assertFalse(journal.done("repeated"))
+        self.assertTrue(journal.done("other"))
+        self.assertFalse(journal.done("missing"))
+        journal.close()
+
+    def test_close_remove(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.close(remove=True)
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
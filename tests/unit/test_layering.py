@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from context import archstrap
+
+from archstrap.layering import ListOps, SpecificationLoader, merge
+from archstrap.specification import DEFAULT_INITRD_HOOKS, make_specification
+
+SYSTEM = {
+    "timezone": "UTC",
+    "locale": "en_US.UTF-8",
+    "charset": "UTF-8",
+    "keymap": "us",
+    "hostname": "base",
+}
+
+
+class MergeTest(unittest.TestCase):
+    def test_objects(self):
+        self.assertEqual(
+            {"a": {"b": 1, "c": 3}, "d": 4},
+            merge({"a": {"b": 1, "c": 2}, "e": 5}, {
+                "a": {"c": 3},
+                "d": 4,
+                "e": None,
+            }),
+        )
+
+    def test_list_replaced(self):
+        self.assertEqual(["c"], merge(["a", "b"], ["c"]))
+
+    def test_list_ops(self):
+        self.assertEqual(
+            ["z", "a", "x", "c", "y"],
+            merge(["a", "b", "c"], {
+                "remove": ["b"],
+                "after": {"a": ["x"]},
+                "prepend": ["z"],
+                "append": ["y"],
+            }),
+        )
+        self.assertEqual(
+            ["a", "encrypt", "fs"],
+            merge(["a", "fs"], {"before": {"fs": ["encrypt"]}}),
+        )
+
+    def test_list_ops_missing_anchor(self):
+        with self.assertRaises(ValueError):
+            merge(["a"], {"before": {"fs": ["encrypt"]}})
+
+    def test_pending_list_ops(self):
+        pending = merge({}, {"hooks": {"append": ["a"]}})["hooks"]
+        self.assertEqual(ListOps([{"append": ["a"]}]), pending)
+        pending = merge(pending, {"prepend": ["b"]})
+        self.assertEqual(["b", "x", "a"], pending.apply(["x"]))
+
+    def test_inputs_unchanged(self):
+        base = {"a": {"b": [1]}}
+        merge(base, {"a": {"b": {"append": [2]}, "c": 3}})
+        self.assertEqual({"a": {"b": [1]}}, base)
+
+
+class SpecificationLoaderTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.loader = SpecificationLoader()
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return path
+
+    def test_extends(self):
+        self.write("base.json", {
+            "system": SYSTEM,
+            "packages": {"extra": ["vim"]},
+        })
+        self.write("fragments/mirrors.json", {
+            "mirrors": {"servers": ["https://mirror"]},
+        })
+        path = self.write("hosts/host.json", {
+            "extends": "../base.json",
+            "include": ["../fragments/mirrors.json"],
+            "system": {"hostname": "host"},
+            "packages": {"extra": {"append": ["git"]}},
+        })
+
+        spec = self.loader.load(path)
+        self.assertEqual("host", spec["system"]["hostname"])
+        self.assertEqual("UTC", spec["system"]["timezone"])
+        self.assertEqual(["vim", "git"], spec["packages"]["extra"])
+        self.assertEqual(["https://mirror"], spec["mirrors"]["servers"])
+        self.assertNotIn("extends", spec)
+        self.assertNotIn("include", spec)
+
+    def test_memoized(self):
+        self.write("base.json", {"system": SYSTEM})
+        first = self.write("first.json", {"extends": "base.json"})
+        second = self.write("second.json", {"extends": ["base.json"]})
+
+        with patch("archstrap.layering.json.loads", wraps=json.loads) as loads:
+            self.loader.load(first)
+            self.loader.load(second)
+            self.loader.load(first)
+            self.assertEqual(3, loads.call_count)
+
+            self.write("base.json", {"system": {**SYSTEM, "keymap": "de"}})
+            self.assertEqual("de", self.loader.load(first)["system"]["keymap"])
+            self.assertEqual(4, loads.call_count)
+
+    def test_memo_size(self):
+        loader = SpecificationLoader(memo_size=2)
+        paths = [
+            self.write(f"{name}.json", {"system": {**SYSTEM, "hostname": name}})
+            for name in ("a", "b", "c")
+        ]
+
+        with patch("archstrap.layering.json.loads", wraps=json.loads) as loads:
+            for path in paths:
+                loader.load(path)
+            self.assertEqual(2, len(loader._parsed))
+            self.assertEqual(2, len(loader._resolved))
+
+            # The least recently used file was forgotten, and is parsed again.
+            loader.load(paths[2])
+            self.assertEqual(3, loads.call_count)
+            self.assertEqual("a", loader.load(paths[0])["system"]["hostname"])
+            self.assertEqual(4, loads.call_count)
+
+    def test_cycle(self):
+        self.write("a.json", {"extends": "b.json"})
+        path = self.write("b.json", {"extends": "a.json"})
+        with self.assertRaises(ValueError):
+            self.loader.load(path)
+
+    def test_resolve(self):
+        self.write("base.json", {"system": SYSTEM})
+        spec = self.loader.resolve({"extends": "base.json"}, self.dir)
+        self.assertEqual(SYSTEM, spec["system"])
+
+
+class MakeSpecificationTest(unittest.TestCase):
+    def test_list_ops_on_default(self):
+        spec = make_specification(
+            merge({}, {
+                "system": SYSTEM,
+                "initrd": {"hooks": {"after": {"block": ["encrypt"]}}},
+            })
+        )
+        index = DEFAULT_INITRD_HOOKS.index("block")
+        self.assertEqual(
+            [
+                *DEFAULT_INITRD_HOOKS[:index + 1],
+                "encrypt",
+                *DEFAULT_INITRD_HOOKS[index + 1:],
+            ],
+            spec.initrd.hooks,
+        )
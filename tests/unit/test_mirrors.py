@@ -0,0 +1,162 @@
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from context import archstrap
+
+from archstrap.mirrors import (
+    ProbeResult,
+    RankingCache,
+    probe,
+    probe_url,
+    rank,
+    render_mirrorlist,
+    write_ranked_mirrorlist,
+)
+
+
+class StubMirrorHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/garbage/core.db":
+            # Not a status line, which is no OSError.
+            self.wfile.write(b"not http\r\n\r\n")
+            self.close_connection = True
+            return
+        if self.path != "/core/os/x86_64/core.db":
+            self.send_error(404)
+            return
+        body = b"\0" * 4096
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            StubMirrorHandler,
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def test_probe_url(self):
+        self.assertEqual(
+            "https://mirror/core/os/x86_64/core.db",
+            probe_url("https://mirror/$repo/os/$arch/", "core", "x86_64"),
+        )
+
+    def test_probe(self):
+        result = probe(f"{self.url}/$repo/os/$arch")
+
+        self.assertTrue(result.ok)
+        self.assertGreater(result.latency, 0)
+        self.assertGreater(result.throughput, 0)
+
+    def test_probe_error(self):
+        result = probe(f"{self.url}/missing")
+
+        self.assertFalse(result.ok)
+        self.assertIsNone(result.throughput)
+
+    def test_probe_bad_response(self):
+        result = probe(f"{self.url}/garbage")
+
+        self.assertFalse(result.ok)
+        self.assertIsNone(result.throughput)
+
+    def test_write_ranked_mirrorlist(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "mirrorlist")
+            missing = f"{self.url}/missing/$repo"
+            working = f"{self.url}/$repo/os/$arch"
+
+            write_ranked_mirrorlist(
+                path,
+                [missing, working],
+                ranking_cache=os.path.join(temp_dir, "mirrors.json"),
+            )
+
+            with open(path) as f:
+                self.assertEqual(
+                    "".join(
+                        f"{line}\n"
+                        for line in render_mirrorlist([working, missing])
+                    ),
+                    f.read(),
+                )
+
+
+class RankTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_path = os.path.join(temp_dir.name, "mirrors.json")
+
+    def test_rank(self):
+        results = {
+            "slow": ProbeResult("slow", 0.1, 10),
+            "fast": ProbeResult("fast", 0.2, 100),
+            "fast_low_latency": ProbeResult("fast_low_latency", 0.1, 100),
+            "broken": ProbeResult("broken", error="unreachable"),
+        }
+
+        self.assertListEqual(
+            ["fast_low_latency", "fast", "slow", "broken"],
+            rank(
+                ["broken", "slow", "fast", "fast_low_latency"],
+                probe=results.get,
+            ),
+        )
+
+    def test_rank_cached(self):
+        cache = RankingCache(self.cache_path, ttl=60)
+        stub_probe = MagicMock(side_effect=lambda s: ProbeResult(s, 0.1, 1))
+
+        rank(["a", "b"], cache, stub_probe)
+        rank(["a", "b", "c"], cache, stub_probe)
+
+        self.assertListEqual(
+            ["a", "b", "c"],
+            [args[0] for args, _ in stub_probe.call_args_list],
+        )
+
+    def test_rank_cache_expired(self):
+        cache = RankingCache(self.cache_path, ttl=60)
+        cache.save([ProbeResult("a", 0.1, 1, timestamp=time.time() - 120)])
+
+        self.assertDictEqual({}, cache.load())
+
+    def test_rank_cache_scope(self):
+        RankingCache(self.cache_path, 60, "core", "x86_64").save([
+            ProbeResult("a", 0.1, 1),
+        ])
+        cache = RankingCache(self.cache_path, 60, "extra", "x86_64")
+        self.assertDictEqual({}, cache.load())
+
+        cache.save([ProbeResult("a", 0.2, 2)])
+        self.assertEqual(
+            1,
+            RankingCache(self.cache_path, 60).load()["a"].throughput,
+        )
+        self.assertEqual(2, cache.load()["a"].throughput)
+
+
+class RenderTest(unittest.TestCase):
+    def test_render_mirrorlist(self):
+        self.assertListEqual(
+            ["# Generated by archstrap", "Server = a", "Server = b"],
+            render_mirrorlist(["a", "b"]),
+        )
@@ -1,9 +1,26 @@
+import os
+import subprocess
+import tempfile
 import unittest
-from unittest.mock import patch
+from subprocess import CalledProcessError
+from unittest.mock import MagicMock, call, patch
 
 from context import archstrap
 
-from archstrap.mode import make_mode, ExecMode, DryrunMode, ShellMode
+from archstrap.command import Command, FileWrite
+from archstrap.mode import (
+    make_mode,
+    spawn,
+    write_file,
+    ChrootSession,
+    ExecMode,
+    DryrunMode,
+    NinjaMode,
+    ShellMode,
+)
+from archstrap.history import History
+from archstrap.profile import Profiler
+from archstrap.trace import Tracer
 
 
 class MockPrint:
@@ -20,17 +37,22 @@ class ModeTest(unittest.TestCase):
         self.mock_print = MockPrint()
 
         logging_info = patch("archstrap.mode.logging.info")
-        subprocess_check_call = patch("archstrap.mode.subprocess.check_call")
+        spawn = patch("archstrap.mode.spawn")
         print = patch("archstrap.mode.print")
 
         self.logging_info = logging_info.start()
-        self.subprocess_check_call = subprocess_check_call.start()
+        write_file = patch("archstrap.mode.write_file")
+
+        self.spawn = spawn.start()
+        self.spawn.return_value = MagicMock(ru_utime=0.0, ru_stime=0.0)
+        self.write_file = write_file.start()
         self.print = print.start()
 
         self.print.side_effect = self.mock_print
 
         self.addCleanup(logging_info.stop)
-        self.addCleanup(subprocess_check_call.stop)
+        self.addCleanup(spawn.stop)
+        self.addCleanup(write_file.stop)
         self.addCleanup(print.stop)
 
 
@@ -42,29 +64,303 @@ class ExecModeTest(ModeTest):
     def test_on_begin(self):
         self.mode.on_begin()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
     def test_on_section(self):
         self.mode.on_section("section")
         self.logging_info.assert_called_once_with("SECTION %s", "section")
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
     def test_on_command(self):
-        self.mode.on_command("command")
-        self.logging_info.assert_called_once_with("COMMAND %s", "command")
-        self.subprocess_check_call.assert_called_once_with(
-            "command", shell=True
-        )
+        command = Command(["command"])
+        self.mode.on_command(command)
+        self.logging_info.assert_called_once_with("COMMAND %s", command)
+        self.spawn.assert_called_once_with(command)
         self.print.assert_not_called()
 
     def test_on_end(self):
         self.mode.on_end()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
+    def test_file_write(self):
+        command = FileWrite("file", "content\n")
+        self.write_file.return_value = False
+        self.mode.on_command(command)
+        self.write_file.assert_called_once_with(command)
+        self.logging_info.assert_has_calls([
+            call("WRITE %s", "file"),
+            call("UNCHANGED %s", "file"),
+        ])
+        self.spawn.assert_not_called()
+
+    def test_jobs(self):
+        mode = ExecMode(jobs=2)
+        mode.on_section("section")
+        mode.on_command(Command(["first"]), writes=["a"])
+        mode.on_command(Command(["second"]), reads=["a"])
+        self.spawn.assert_not_called()
+
+        mode.on_end()
+        self.spawn.assert_has_calls([
+            call(Command(["first"])),
+            call(Command(["second"])),
+        ])
+
+    def test_journal(self):
+        journal = MagicMock()
+        journal.done.side_effect = lambda command: command == "done"
+        mode = ExecMode(journal=journal)
+
+        mode.on_begin()
+        journal.open.assert_called_once_with()
+
+        mode.on_command(Command(["done"]))
+        mode.on_command(Command(["command"]))
+        self.spawn.assert_called_once_with(Command(["command"]))
+        journal.record.assert_called_once_with("command")
+
+        mode.on_end()
+        journal.close.assert_called_once_with(remove=True)
+
+    def test_journal_failure(self):
+        self.spawn.side_effect = CalledProcessError(1, "cmd")
+        for jobs in (1, 2):
+            journal = MagicMock()
+            journal.done.return_value = False
+            mode = ExecMode(jobs, journal=journal)
+
+            mode.on_begin()
+            with self.assertRaises(CalledProcessError):
+                mode.on_command(Command(["command"]))
+                mode.on_end()
+            journal.close.assert_called_once_with(remove=False)
+
+    def test_tracer(self):
+        tracer = Tracer()
+        self.spawn.return_value.ru_utime = 1.0
+        self.spawn.return_value.ru_stime = 0.5
+        mode = ExecMode(tracer=tracer)
+
+        mode.on_begin()
+        mode.on_section("section")
+        mode.on_command(Command(["command"]))
+
+        self.assertEqual(1, len(tracer.spans))
+        self.assertEqual("command", tracer.spans[0].name)
+        self.assertEqual("section", tracer.spans[0].section)
+        self.assertEqual(1.5, tracer.spans[0].cpu)
+        self.assertEqual(0, tracer.spans[0].status)
+
+    def test_tracer_failure(self):
+        tracer = Tracer()
+        self.spawn.side_effect = CalledProcessError(2, "cmd")
+        mode = ExecMode(tracer=tracer)
+
+        with self.assertRaises(CalledProcessError):
+            mode.on_command(Command(["command"]))
+        self.assertEqual(2, tracer.spans[0].status)
+
+    def test_tracer_session(self):
+        tracer = Tracer()
+        mode = ExecMode(tracer=tracer)
+
+        mode.on_section("section")
+        mode.on_command(Command(["command"], chroot="root"))
+
+        self.assertEqual(
+            [
+                ("mount root", "session", 0),
+                ("arch-chroot root command", "command", 0),
+            ],
+            [(span.name, span.category, span.status) for span in tracer.spans],
+        )
+        self.assertEqual("section", tracer.spans[0].section)
+        self.assertLessEqual(tracer.spans[0].end, tracer.spans[1].start)
+
+    def test_profiler(self):
+        profiler = Profiler()
+        self.spawn.return_value = MagicMock(
+            ru_utime=1.0,
+            ru_stime=0.5,
+            ru_nvcsw=3,
+            ru_nivcsw=4,
+        )
+        mode = ExecMode(profiler=profiler)
+
+        mode.on_section("section")
+        mode.on_command(Command(["/usr/bin/command", "argument"]))
+
+        self.assertEqual(1, len(profiler.profiles))
+        profile = profiler.profiles[0]
+        self.assertEqual("/usr/bin/command argument", profile.name)
+        self.assertEqual("section", profile.section)
+        self.assertEqual("command", profile.program)
+        self.assertEqual(1.5, profile.cpu)
+        self.assertEqual(3, profile.voluntary_switches)
+        self.assertEqual(0, profile.status)
+
+    def test_history(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        history = History(os.path.join(temp_dir.name, "history.sqlite"))
+        self.addCleanup(history.close)
+        mode = ExecMode(history=history)
+
+        mode.on_section("section")
+        mode.on_command(Command(["first"]))
+        mode.on_command(Command(["second"]))
+        self.spawn.assert_not_called()
+        self.assertIsNone(history.expected(Command(["first"])))
+
+        mode.on_end()
+        self.spawn.assert_has_calls([
+            call(Command(["first"])),
+            call(Command(["second"])),
+        ])
+        self.assertIsNotNone(history.expected(Command(["first"])))
+        self.assertIsNotNone(history.expected(Command(["second"])))
+        self.assertIsNone(mode.progress)
+
+    def test_profiler_failure(self):
+        profiler = Profiler()
+        self.spawn.side_effect = CalledProcessError(2, "cmd")
+        mode = ExecMode(profiler=profiler)
+
+        with self.assertRaises(CalledProcessError):
+            mode.on_command(Command(["command"]))
+        self.assertEqual(2, profiler.profiles[0].status)
+
+    def test_chroot_session(self):
+        session = ChrootSession("root")
+        self.mode.on_command(Command(["first"], chroot="root"))
+        self.mode.on_command(Command(["second"], chroot="root"))
+        self.assertEqual(
+            [
+                *(call(command) for command in session.setup()),
+                call(Command(["chroot", "root", "first"])),
+                call(Command(["chroot", "root", "second"])),
+            ],
+            self.spawn.call_args_list,
+        )
+
+        self.spawn.reset_mock()
+        self.mode.on_end()
+        self.assertEqual(
+            [call(command) for command in session.teardown()],
+            self.spawn.call_args_list,
+        )
+
+    def test_chroot_session_failure(self):
+        session = ChrootSession("root")
+        self.spawn.side_effect = [
+            *(MagicMock() for _ in session.setup()),
+            CalledProcessError(1, "cmd"),
+            *(MagicMock() for _ in session.teardown()),
+        ]
+        with self.assertRaises(CalledProcessError):
+            self.mode.on_command(Command(["command"], chroot="root"))
+        self.assertEqual(
+            [call(command) for command in session.teardown()],
+            self.spawn.call_args_list[-len(session.teardown()):],
+        )
+        self.assertEqual({}, self.mode.sessions)
+
+
+class ChrootSessionTest(unittest.TestCase):
+    def test_setup(self):
+        setup = ChrootSession("root").setup()
+        self.assertEqual(
+            Command([
+                "mount",
+                "--types",
+                "proc",
+                "--options",
+                "nosuid,noexec,nodev",
+                "proc",
+                "root/proc",
+            ]),
+            setup[0],
+        )
+        self.assertEqual(len(ChrootSession.MOUNTS), len(setup))
+
+    def test_teardown(self):
+        teardown = ChrootSession("root").teardown()
+        self.assertEqual(Command(["umount", "root/tmp"]), teardown[0])
+        self.assertEqual(Command(["umount", "root/proc"]), teardown[-1])
+
+    def test_wrap(self):
+        self.assertEqual(
+            Command(["chroot", "root", "passwd"]),
+            ChrootSession("root").wrap(Command(["passwd"], chroot="root")),
+        )
+
+
+class SpawnTest(unittest.TestCase):
+    def test_spawn(self):
+        rusage = spawn(Command(["true"]))
+        self.assertGreaterEqual(rusage.ru_utime, 0)
+
+    def test_spawn_failure(self):
+        with self.assertRaises(CalledProcessError) as context:
+            spawn(Command(["false"]))
+        self.assertEqual(1, context.exception.returncode)
+
+    def test_spawn_redirects(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file")
+            spawn(Command.write(path, ["first"]))
+            spawn(Command.write(path, ["second"], append=True))
+            spawn(
+                Command(
+                    ["sh", "-c", "echo \"$VALUE\""],
+                    env={"VALUE": "third"},
+                    stdout=path,
+                    append=True,
+                )
+            )
+            with open(path, "r") as f:
+                self.assertEqual("first\nsecond\nthird\n", f.read())
+
+
+class WriteFileTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "file")
+
+    def read(self):
+        with open(self.path, "r") as f:
+            return f.read()
+
+    def test_write(self):
+        self.assertTrue(write_file(FileWrite(self.path, "first\n")))
+        self.assertEqual("first\n", self.read())
+        self.assertEqual(0o644, os.stat(self.path).st_mode & 0o777)
+        self.assertEqual(["file"], os.listdir(os.path.dirname(self.path)))
+
+    def test_append(self):
+        write_file(FileWrite(self.path, "first\n"))
+        self.assertTrue(write_file(FileWrite(self.path, "second\n", True)))
+        self.assertEqual("first\nsecond\n", self.read())
+
+    def test_unchanged(self):
+        write_file(FileWrite(self.path, "first\n"))
+        os.chmod(self.path, 0o600)
+        inode = os.stat(self.path).st_ino
+        self.assertFalse(write_file(FileWrite(self.path, "first\n")))
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+
+    def test_preserves_mode(self):
+        write_file(FileWrite(self.path, "first\n"))
+        os.chmod(self.path, 0o600)
+        self.assertTrue(write_file(FileWrite(self.path, "second\n")))
+        self.assertEqual("second\n", self.read())
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
 
 class DryrunModeTest(ModeTest):
     def setUp(self):
@@ -74,27 +370,47 @@ class DryrunModeTest(ModeTest):
     def test_on_begin(self):
         self.mode.on_begin()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
     def test_on_section(self):
         self.mode.on_section("section")
         self.logging_info.assert_called_once_with("SECTION %s", "section")
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
     def test_on_command(self):
-        self.mode.on_command("command")
-        self.logging_info.assert_called_once_with("COMMAND %s", "command")
-        self.subprocess_check_call.assert_not_called()
+        command = Command(["command"])
+        self.mode.on_command(command)
+        self.logging_info.assert_called_once_with("COMMAND %s", command)
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
     def test_on_end(self):
         self.mode.on_end()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
+    def test_chroot_session(self):
+        session = ChrootSession("root")
+        self.mode.on_command(Command(["first"], chroot="root"))
+        self.mode.on_command(Command(["second"], chroot="root"))
+        self.mode.on_end()
+        self.assertEqual(
+            [
+                *(call("COMMAND %s", command) for command in session.setup()),
+                call("COMMAND %s", Command(["chroot", "root", "first"])),
+                call("COMMAND %s", Command(["chroot", "root", "second"])),
+                *(
+                    call("COMMAND %s", command)
+                    for command in session.teardown()
+                ),
+            ],
+            self.logging_info.call_args_list,
+        )
+        self.spawn.assert_not_called()
+
 
 class ShellModeTest(ModeTest):
     def setUp(self):
@@ -104,7 +420,7 @@ class ShellModeTest(ModeTest):
     def test_on_begin(self):
         self.mode.on_begin()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_called()
         self.assertEqual(
             f"#!/usr/bin/bash\nset -xeuo pipefail\n",
@@ -114,7 +430,7 @@ class ShellModeTest(ModeTest):
     def test_on_section(self):
         self.mode.on_section("section")
         self.logging_info.assert_called_once_with("SECTION %s", "section")
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_called()
         self.assertEqual(
             f"\n# section\n",
@@ -122,20 +438,180 @@ class ShellModeTest(ModeTest):
         )
 
     def test_on_command(self):
-        self.mode.on_command("command")
-        self.logging_info.assert_called_once_with("COMMAND %s", "command")
-        self.subprocess_check_call.assert_not_called()
-        self.print.assert_called_once_with("command")
+        command = Command(["command", "with argument"])
+        self.mode.on_command(command)
+        self.logging_info.assert_called_once_with("COMMAND %s", command)
+        self.spawn.assert_not_called()
+        self.print.assert_called_once_with("command 'with argument'")
+
+    def test_chroot_session(self):
+        self.mode.on_command(Command(["first"], chroot="root"))
+        self.mode.on_command(Command(["second"], chroot="root"))
+        lines = self.print.side_effect.buffer.splitlines()
+        mounts = len(ChrootSession.MOUNTS)
+        for line in lines[:mounts]:
+            self.assertTrue(line.startswith("mount "))
+        self.assertTrue(
+            lines[mounts].startswith(
+                "trap 'set +e; umount root/tmp || umount --lazy root/tmp; "
+            )
+        )
+        self.assertTrue(
+            lines[mounts].endswith(
+                "umount root/proc || umount --lazy root/proc' EXIT"
+            )
+        )
+        self.assertEqual(
+            ["chroot root first", "chroot root second"],
+            lines[mounts + 1:],
+        )
+
+    def test_chroot_session_teardown_failure(self):
+        self.mode.on_command(Command(["first"], chroot="root"))
+        trap = self.print.side_effect.buffer.splitlines()[
+            len(ChrootSession.MOUNTS)
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # An umount that fails for mounts that are already gone, and
+            # records the rest.
+            log = os.path.join(temp_dir, "log")
+            umount = os.path.join(temp_dir, "umount")
+            with open(umount, "w") as f:
+                f.write("#!/bin/sh\n")
+                f.write('case "$*" in *dev/pts) exit 32;; esac\n')
+                f.write(f'echo "$*" >> {log}\n')
+            os.chmod(umount, 0o755)
+            subprocess.run(
+                ["bash", "-c", f"set -euo pipefail\n{trap}\nfalse"],
+                env={**os.environ, "PATH": f"{temp_dir}:{os.environ['PATH']}"},
+            )
+
+            with open(log) as f:
+                unmounted = f.read().splitlines()
+        self.assertEqual(len(ChrootSession.MOUNTS) - 1, len(unmounted))
+        self.assertEqual("root/proc", unmounted[-1])
 
     def test_on_end(self):
         self.mode.on_end()
         self.logging_info.assert_not_called()
-        self.subprocess_check_call.assert_not_called()
+        self.spawn.assert_not_called()
         self.print.assert_not_called()
 
 
+class NinjaModeTest(ModeTest):
+    def setUp(self):
+        super().setUp()
+        self.mode = NinjaMode(stamp_dir="stamps")
+
+    def build_lines(self):
+        return [
+            line for line in self.mock_print.buffer.splitlines()
+            if line.startswith("build ")
+        ]
+
+    def test_on_section(self):
+        self.mode.on_section("section")
+        self.logging_info.assert_called_once_with("SECTION %s", "section")
+        self.print.assert_not_called()
+
+    def test_on_end(self):
+        self.mode.on_section("section")
+        self.mode.on_command(Command(["pacstrap", "root"]), writes=["root"])
+        self.mode.on_command(
+            Command.write("root/etc/hosts", ["127.0.0.1 localhost"]),
+            reads=["root"],
+            writes=["root/etc/hosts"],
+        )
+        self.mode.on_command(
+            Command(["locale-gen"], chroot="root"),
+            reads=["root", "root/etc/hosts"],
+            writes=["root/a file:1"],
+        )
+        self.mode.on_command(Command(["sync"]))
+        self.mode.on_end()
+
+        self.spawn.assert_not_called()
+        self.assertListEqual(
+            [
+                "build stamps/0000.stamp: run",
+                "build stamps/0001.stamp: run stamps/0000.stamp",
+                "build stamps/0002.stamp: run stamps/0000.stamp "
+                "stamps/0001.stamp",
+                "build stamps/0003.stamp: run stamps/0000.stamp "
+                "stamps/0001.stamp stamps/0002.stamp",
+                "build all: phony stamps/0000.stamp stamps/0001.stamp "
+                "stamps/0002.stamp stamps/0003.stamp",
+            ],
+            self.build_lines(),
+        )
+        lines = self.mock_print.buffer.splitlines()
+        self.assertIn(
+            "  cmd = pacstrap root && touch stamps/0000.stamp",
+            lines,
+        )
+        self.assertIn(
+            "  cmd = arch-chroot root locale-gen && touch stamps/0002.stamp",
+            lines,
+        )
+        self.assertIn("  desc = [section] cat > root/etc/hosts", lines)
+        self.assertEqual("default all", lines[-1])
+
+    def test_written_files_are_not_outputs(self):
+        self.mode.on_command(Command(["a"]), writes=["file"])
+        self.mode.on_command(Command(["b"]), writes=["file"])
+        self.mode.on_end()
+
+        self.assertListEqual(
+            [
+                "build stamps/0000.stamp: run",
+                "build stamps/0001.stamp: run stamps/0000.stamp",
+                "build all: phony stamps/0000.stamp stamps/0001.stamp",
+            ],
+            self.build_lines(),
+        )
+
+    def test_interactive_console_pool(self):
+        self.mode.on_command(
+            Command(["passwd"], chroot="root", interactive=True)
+        )
+        self.mode.on_command(Command(["sync"]))
+        self.mode.on_end()
+
+        lines = self.mock_print.buffer.splitlines()
+        self.assertEqual(1, lines.count("  pool = console"))
+        pool = lines.index("  pool = console")
+        self.assertEqual("build stamps/0000.stamp: run", lines[pool - 3])
+
+    def test_multi_line_commands(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file")
+            content = ["it's \\n $HOME", "%s `x`"]
+            self.mode.on_command(Command.write(path, content), writes=[path])
+            self.mode.on_end()
+
+            cmd = [
+                line for line in self.mock_print.buffer.splitlines()
+                if line.startswith("  cmd = ")
+            ][0]
+            command = cmd[len("  cmd = "):].replace("$$", "$")
+            # Ninja creates the stamp directory itself.
+            os.makedirs(os.path.join(temp_dir, "stamps"))
+            subprocess.check_call(["sh", "-c", command], cwd=temp_dir)
+            self.assertTrue(
+                os.path.exists(os.path.join(temp_dir, "stamps/0000.stamp"))
+            )
+            with open(path, "r") as f:
+                self.assertEqual(
+                    "".join(f"{line}\n" for line in content),
+                    f.read(),
+                )
+
+
 class MakeModeTest(unittest.TestCase):
     def test_make_mode(self):
         self.assertEqual(ExecMode, make_mode("exec").__class__)
+        self.assertEqual(4, make_mode("exec", jobs=4).jobs)
         self.assertEqual(DryrunMode, make_mode("dryrun").__class__)
         self.assertEqual(ShellMode, make_mode("shell").__class__)
+        self.assertEqual(NinjaMode, make_mode("ninja").__class__)
@@ -0,0 +1,173 @@
+import unittest
+from unittest.mock import MagicMock, call
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.plan import (
+    Plan,
+    batch_chroot,
+    deduplicate,
+    drop_overwritten_writes,
+    merge_writes,
+)
+from archstrap.scheduler import Step
+
+
+def commands(steps):
+    return [step.command for step in steps]
+
+
+class PlanTest(unittest.TestCase):
+    def test_record_and_replay(self):
+        plan = Plan()
+        plan.on_section("first")
+        plan.on_command(Command(["a"]), writes=["x"])
+        plan.on_command(Command(["b"]), reads=["x"])
+        plan.on_section("second")
+        plan.on_command(Command(["c"]))
+
+        mode = MagicMock()
+        plan.replay(mode)
+        self.assertEqual(
+            [
+                call.on_section("first"),
+                call.on_command(Command(["a"]), reads=[], writes=["x"]),
+                call.on_command(Command(["b"]), reads=["x"], writes=[]),
+                call.on_section("second"),
+                call.on_command(Command(["c"]), reads=[], writes=[]),
+            ],
+            mode.mock_calls,
+        )
+
+    def test_optimize(self):
+        plan = Plan([
+            Step(Command(["mkdir", "-p", "x"]), writes=["x"]),
+            Step(Command(["mkdir", "-p", "x"]), writes=["x"]),
+        ])
+        self.assertEqual(1, len(plan.optimize().steps))
+        self.assertEqual(2, len(plan.optimize(passes=[]).steps))
+        self.assertEqual(2, len(plan.steps))
+
+
+class DeduplicateTest(unittest.TestCase):
+    def test_duplicate(self):
+        steps = [
+            Step(Command(["mkdir", "-p", "x"]), writes=["x"]),
+            Step(Command.write("x/a", ["a"]), reads=["x"], writes=["x/a"]),
+            Step(Command(["mkdir", "-p", "x"]), writes=["x"]),
+        ]
+        self.assertEqual(steps[:2], deduplicate(steps))
+
+    def test_intervening_write(self):
+        steps = [
+            Step(Command(["locale-gen"]), reads=["conf"], writes=["out"]),
+            Step(Command.write("conf", ["a"]), writes=["conf"]),
+            Step(Command(["locale-gen"]), reads=["conf"], writes=["out"]),
+        ]
+        self.assertEqual(steps, deduplicate(steps))
+
+    def test_undeclared(self):
+        steps = [Step(Command(["passwd"])), Step(Command(["passwd"]))]
+        self.assertEqual(steps, deduplicate(steps))
+
+    def test_append(self):
+        steps = [
+            Step(Command.write("a", ["x"], append=True), writes=["a"]),
+            Step(Command.write("a", ["x"], append=True), writes=["a"]),
+        ]
+        self.assertEqual(steps, deduplicate(steps))
+
+
+class MergeWritesTest(unittest.TestCase):
+    def test_merge(self):
+        steps = [
+            Step(Command.write("a", ["1"]), reads=["root"], writes=["a"]),
+            Step(Command.write("b", ["2"]), writes=["b"]),
+            Step(Command.write("a", ["3"], append=True), writes=["a"]),
+        ]
+        merged = merge_writes(steps)
+        self.assertEqual(
+            [Command.write("a", ["1", "3"]), Command.write("b", ["2"])],
+            commands(merged),
+        )
+        self.assertEqual(["root"], merged[0].reads)
+        self.assertEqual(["a"], merged[0].writes)
+
+    def test_intervening_read(self):
+        steps = [
+            Step(Command.write("a", ["1"]), writes=["a"]),
+            Step(Command(["cp", "a", "b"]), reads=["a"], writes=["b"]),
+            Step(Command.write("a", ["2"], append=True), writes=["a"]),
+        ]
+        self.assertEqual(steps, merge_writes(steps))
+
+
+class DropOverwrittenWritesTest(unittest.TestCase):
+    def test_drop(self):
+        steps = [
+            Step(Command.write("a", ["1"]), writes=["a"]),
+            Step(Command.write("b", ["2"]), writes=["b"]),
+            Step(Command.write("a", ["3"]), writes=["a"]),
+        ]
+        self.assertEqual(steps[1:], drop_overwritten_writes(steps))
+
+    def test_intervening_read(self):
+        steps = [
+            Step(Command.write("a", ["1"]), writes=["a"]),
+            Step(Command(["cp", "a", "b"]), reads=["a"], writes=["b"]),
+            Step(Command.write("a", ["3"]), writes=["a"]),
+        ]
+        self.assertEqual(steps, drop_overwritten_writes(steps))
+
+
+class BatchChrootTest(unittest.TestCase):
+    def test_batch(self):
+        steps = [
+            Step(
+                Command(["locale-gen"], chroot="root"),
+                reads=["root"],
+                writes=["locale"],
+            ),
+            Step(
+                Command(["localedef", "--list"], chroot="root"),
+                reads=["locale"],
+                writes=["list"],
+            ),
+        ]
+        batched = batch_chroot(steps)
+        self.assertEqual(
+            [
+                Command(
+                    ["sh", "-c", "set -e\nlocale-gen\nlocaledef --list"],
+                    chroot="root",
+                )
+            ],
+            commands(batched),
+        )
+        self.assertEqual(["root", "locale"], batched[0].reads)
+        self.assertEqual(["locale", "list"], batched[0].writes)
+
+    def test_batch_interactive(self):
+        steps = [
+            Step(Command(["a"], chroot="root", interactive=True)),
+            Step(Command(["b"], chroot="root")),
+        ]
+        batched = batch_chroot(steps)
+        self.assertEqual(1, len(batched))
+        self.assertTrue(batched[0].command.interactive)
+
+    def test_independent(self):
+        steps = [
+            Step(Command(["a"], chroot="root"), reads=["root"], writes=["a"]),
+            Step(Command(["b"], chroot="root"), reads=["root"], writes=["b"]),
+        ]
+        self.assertEqual(steps, batch_chroot(steps))
+
+    def test_not_adjacent(self):
+        steps = [
+            Step(Command(["a"], chroot="root")),
+            Step(Command(["b"])),
+            Step(Command(["c"], chroot="root")),
+        ]
+        self.assertEqual(steps, batch_chroot(steps))
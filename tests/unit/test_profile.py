@@ -0,0 +1,179 @@
+import functools
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from context import archstrap
+
+from archstrap.command import Command
+from archstrap.mode import spawn
+from archstrap.profile import (
+    PAGE_SIZE,
+    Profile,
+    Profiler,
+    process_tree,
+    read_stat,
+)
+
+
+def make_process(proc, pid, ppid, rss_pages=0, io=None):
+    """
+    Fake the /proc entries of a process.
+    """
+    directory = os.path.join(proc, str(pid))
+    os.makedirs(directory)
+    fields = ["S", str(ppid)] + ["0"] * 19 + [str(rss_pages)] + ["0"] * 30
+    with open(os.path.join(directory, "stat"), "w") as f:
+        f.write(f"{pid} (a (strange) name) {' '.join(fields)}\n")
+    if io is not None:
+        with open(os.path.join(directory, "io"), "w") as f:
+            f.write("".join(f"{key}: {value}\n" for key, value in io.items()))
+
+
+class ProcTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.proc = temp_dir.name
+        make_process(self.proc, 1, 0)
+        make_process(self.proc, 10, 1, 2, {"rchar": 5, "read_bytes": 4096})
+        make_process(self.proc, 11, 10, 1)
+        make_process(self.proc, 12, 11)
+        make_process(self.proc, 20, 1)
+        os.makedirs(os.path.join(self.proc, "self"))
+
+    def test_read_stat(self):
+        usage = read_stat(10, self.proc)
+
+        self.assertEqual(1, usage["ppid"])
+        self.assertEqual(2 * PAGE_SIZE, usage["rss"])
+        self.assertEqual(5, usage["rchar"])
+        self.assertEqual(4096, usage["read_bytes"])
+        self.assertEqual(0, usage["wchar"])
+        self.assertEqual(0, read_stat(11, self.proc)["rchar"])
+        self.assertIsNone(read_stat(13, self.proc))
+
+    def test_process_tree(self):
+        self.assertListEqual([10, 11, 12], process_tree(10, self.proc))
+        self.assertListEqual([12], process_tree(12, self.proc))
+
+    def test_process_tree_children(self):
+        for pid, children in [(10, "11"), (11, "12 "), (12, "")]:
+            task = os.path.join(self.proc, str(pid), "task", str(pid))
+            os.makedirs(task)
+            with open(os.path.join(task, "children"), "w") as f:
+                f.write(children)
+
+        self.assertListEqual([10, 11, 12], process_tree(10, self.proc))
+
+
+class ProfileTest(unittest.TestCase):
+    def test_sample(self):
+        profile = Profile("command")
+        usage = {"rss": 1, "read_bytes": 2, "write_bytes": 0, "rchar": 3}
+        profile.sample([{**usage, "wchar": 4}, {**usage, "wchar": 5}])
+        profile.sample([{**usage, "wchar": 1, "rss": 3}])
+
+        self.assertEqual(2, profile.samples)
+        self.assertEqual(3, profile.peak_rss)
+        self.assertEqual(4, profile.read_bytes)
+        self.assertEqual(9, profile.wchar)
+
+    def test_finish(self):
+        profile = Profile("command")
+        profile.wall = 2.0
+        profile.finish(
+            MagicMock(ru_utime=1.0, ru_stime=0.5, ru_nvcsw=3, ru_nivcsw=4)
+        )
+
+        self.assertEqual(1.5, profile.cpu)
+        self.assertEqual(0.75, profile.utilization)
+        self.assertEqual(4, profile.involuntary_switches)
+        self.assertEqual(0, profile.status)
+
+
+class ProfilerTest(unittest.TestCase):
+    def add(self, profiler, name, section, program, wall, rss, status=0):
+        profile = profiler.profile(name, section, program)
+        profile.wall = wall
+        profile.user = wall / 2
+        profile.peak_rss = rss
+        profile.write_bytes = 1024
+        profile.status = status
+        return profile
+
+    def make_profiler(self):
+        profiler = Profiler()
+        self.add(profiler, "pacstrap a", "packages", "pacstrap", 10.0, 100)
+        self.add(profiler, "pacstrap b", "packages", "pacstrap", 5.0, 300)
+        self.add(profiler, "locale-gen", "locale", "locale-gen", 20.0, 200, 1)
+        return profiler
+
+    def test_rollups(self):
+        profiler = self.make_profiler()
+
+        sections = profiler.sections()
+        self.assertListEqual(["packages", "locale"], [s.name for s in sections])
+        self.assertEqual(2, sections[0].count)
+        self.assertEqual(15.0, sections[0].wall)
+        self.assertEqual(7.5, sections[0].cpu)
+        self.assertEqual(300, sections[0].peak_rss)
+        self.assertEqual(2048, sections[0].write_bytes)
+        self.assertEqual(0, sections[0].status)
+        self.assertEqual(1, sections[1].status)
+
+        programs = profiler.programs()
+        self.assertListEqual(
+            ["locale-gen", "pacstrap"],
+            [program.name for program in programs],
+        )
+
+    def test_report(self):
+        lines = self.make_profiler().report()
+
+        self.assertTrue(lines[0].startswith("SECTION"))
+        self.assertTrue(lines[1].startswith("packages"))
+        self.assertIn("15.0s", lines[1])
+        self.assertIn("7.5s", lines[1])
+        self.assertIn("2.0K", lines[1])
+        self.assertEqual("", lines[3])
+        self.assertTrue(lines[4].startswith("PROGRAM"))
+        self.assertEqual(7, len(lines))
+
+    def test_write(self):
+        profiler = self.make_profiler()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "profile.json")
+            profiler.write(path)
+            with open(path) as f:
+                profile = json.load(f)
+
+        self.assertEqual(3, len(profile["commands"]))
+        self.assertEqual("pacstrap a", profile["commands"][0]["name"])
+        self.assertEqual(0.5, profile["commands"][0]["utilization"])
+        self.assertEqual(
+            ["packages", "locale"],
+            [section["name"] for section in profile["sections"]],
+        )
+
+    def test_monitor(self):
+        profiler = Profiler(interval=0.01)
+        profile = profiler.profile("command")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file")
+            rusage = spawn(
+                Command([
+                    "sh",
+                    "-c",
+                    f"sleep 0.05; head -c 100000 /dev/zero > {path}",
+                ]),
+                functools.partial(profiler.monitor, profile),
+            )
+        profile.finish(rusage)
+
+        self.assertGreaterEqual(profile.samples, 2)
+        self.assertGreater(profile.wall, 0.05)
+        self.assertGreater(profile.peak_rss, 0)
+        self.assertGreaterEqual(profile.wchar, 100000)
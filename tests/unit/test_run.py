@@ -1,3 +1,7 @@
+import os
+import subprocess
+import sys
+import textwrap
 import unittest
 from unittest.mock import MagicMock, call, patch
 
@@ -7,7 +11,7 @@ from archstrap import run
 
 
 class RunTest(unittest.TestCase):
-    @patch("archstrap.make_mode")
+    @patch("archstrap.mode.make_mode")
     def test_run(self, make_mode):
         spec = MagicMock()
         mode = MagicMock()
@@ -18,3 +22,96 @@ class RunTest(unittest.TestCase):
 
         make_mode.assert_called_once_with("mode")
         spec.apply.assert_called_once_with("install_root", mode)
+
+    @patch("archstrap.cache.PackageCache")
+    @patch("archstrap.mode.make_mode")
+    def test_run_evicts_package_cache(self, make_mode, package_cache):
+        spec = MagicMock()
+        spec.packages.cache = "cache"
+        spec.packages.cache_size = "1G"
+
+        run(spec, "exec", "install_root", jobs=2)
+
+        make_mode.assert_called_once_with("exec", jobs=2)
+        package_cache.assert_called_once_with("cache", "1G")
+        package_cache.return_value.evict.assert_called_once_with()
+
+    @patch("archstrap.trace.Tracer")
+    @patch("archstrap.mode.make_mode")
+    def test_run_trace(self, make_mode, tracer):
+        spec = MagicMock()
+        spec.apply.side_effect = RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            run(spec, "exec", "install_root", trace="trace.json")
+
+        make_mode.assert_called_once_with(
+            "exec",
+            tracer=tracer.return_value,
+        )
+        tracer.return_value.end.assert_called_once_with("error")
+        tracer.return_value.write.assert_called_once_with("trace.json")
+
+    @patch("archstrap.history.History")
+    @patch("archstrap.mode.make_mode")
+    def test_run_history(self, make_mode, history):
+        spec = MagicMock()
+        spec.packages.cache = None
+
+        run(spec, "exec", "install_root", history="history.sqlite")
+        run(spec, "shell", "install_root", history="history.sqlite")
+
+        history.assert_called_once_with("history.sqlite", "install_root")
+        make_mode.assert_has_calls([
+            call("exec", history=history.return_value),
+            call("shell"),
+        ])
+        history.return_value.close.assert_called_once_with()
+
+    @patch("archstrap.mode.make_mode")
+    def test_run_unsafe_fast_io(self, make_mode):
+        spec = MagicMock()
+        spec.unsafe_fast_io = False
+        spec.packages.cache = None
+
+        run(spec, "shell", "install_root", unsafe_fast_io=True)
+
+        self.assertTrue(spec.unsafe_fast_io)
+        make_mode.assert_called_once_with("shell")
+
+    def test_run_lazy_imports(self):
+        # Runs that need neither a history nor a bundle must not import them.
+        script = textwrap.dedent("""
+            import sys
+            from archstrap import run
+            from archstrap.specification import make_specification
+            run(
+                make_specification({
+                    "system": {
+                        "timezone": "UTC",
+                        "locale": "en_US.UTF-8",
+                        "charset": "UTF-8",
+                        "keymap": "us",
+                        "hostname": "host",
+                        "root_password": "password",
+                    },
+                }),
+                "dryrun",
+                "/mnt",
+            )
+            print("\\n".join(sys.modules))
+        """)
+        src_dir = os.path.dirname(os.path.dirname(archstrap.__file__))
+        modules = subprocess.check_output(
+            [sys.executable, "-c", script],
+            cwd=src_dir,
+        ).decode("utf-8").splitlines()
+
+        for module in [
+                "archstrap.bundle",
+                "archstrap.history",
+                "sqlite3",
+                "tarfile",
+        ]:
+            self.assertNotIn(module, modules)
+        self.assertIn("archstrap.mode", modules)
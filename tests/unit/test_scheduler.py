@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+from context import archstrap
+
+from archstrap.scheduler import Scheduler, Step
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_invalid_jobs(self):
+        with self.assertRaises(ValueError):
+            Scheduler(0)
+
+    def test_dependencies(self):
+        scheduler = Scheduler(4)
+        scheduler.add(Step("pacstrap", writes=["root"]))
+        scheduler.add(Step("hosts", reads=["root"], writes=["root/etc/hosts"]))
+        scheduler.add(Step("locale", reads=["root"], writes=["root/locale"]))
+        scheduler.add(Step("locale-gen", reads=["root", "root/locale"]))
+        scheduler.add(Step("rewrite", writes=["root/locale"]))
+
+        self.assertListEqual(
+            [set(), {0}, {0}, {0, 2}, {2, 3}],
+            scheduler.dependencies,
+        )
+
+    def test_undeclared_step_is_barrier(self):
+        scheduler = Scheduler(4)
+        scheduler.add(Step("a", writes=["a"]))
+        scheduler.add(Step("b", writes=["b"]))
+        scheduler.add(Step("barrier"))
+        scheduler.add(Step("c", writes=["c"]))
+
+        self.assertListEqual(
+            [set(), set(), {0, 1}, {2}],
+            scheduler.dependencies,
+        )
+
+    def test_run_order(self):
+        order = []
+        lock = threading.Lock()
+
+        def execute(step):
+            with lock:
+                order.append(step.command)
+
+        scheduler = Scheduler(3)
+        scheduler.add(Step("first", writes=["root"]))
+        scheduler.add(Step("second", reads=["root"], writes=["x"]))
+        scheduler.add(Step("third", reads=["root"], writes=["y"]))
+        scheduler.add(Step("fourth", reads=["x", "y"]))
+        scheduler.run(execute)
+
+        self.assertEqual("first", order[0])
+        self.assertSetEqual({"second", "third"}, set(order[1:3]))
+        self.assertEqual("fourth", order[3])
+
+    def test_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        scheduler = Scheduler(2)
+        scheduler.add(Step("a", writes=["a"]))
+        scheduler.add(Step("b", writes=["b"]))
+        # Both steps must be running at once for the barrier to release.
+        scheduler.run(lambda step: barrier.wait())
+
+    def test_run_failure(self):
+        executed = []
+
+        def execute(step):
+            executed.append(step.command)
+            if step.command == "fail":
+                raise RuntimeError(step.command)
+
+        scheduler = Scheduler(1)
+        scheduler.add(Step("fail", writes=["a"]))
+        scheduler.add(Step("after", reads=["a"]))
+
+        with self.assertRaises(RuntimeError):
+            scheduler.run(execute)
+        self.assertListEqual(["fail"], executed)
+
+    def test_critical_paths(self):
+        scheduler = Scheduler(2)
+        scheduler.add(Step("root", writes=["root"]))
+        scheduler.add(Step("short", reads=["root"], writes=["a"]))
+        scheduler.add(Step("long", reads=["root"], writes=["b"]))
+        scheduler.add(Step("after-short", reads=["a"], writes=["c"]))
+
+        self.assertListEqual(
+            [11.0, 3.0, 10.0, 2.0],
+            scheduler.critical_paths([1.0, 1.0, 10.0, 2.0]),
+        )
+
+    def test_run_priorities(self):
+        order = []
+
+        scheduler = Scheduler(1)
+        scheduler.add(Step("a", writes=["a"]))
+        scheduler.add(Step("b", writes=["b"]))
+        scheduler.add(Step("c", writes=["c"]))
+        scheduler.run(lambda step: order.append(step.command), [1.0, 3.0, 2.0])
+
+        self.assertListEqual(["b", "c", "a"], order)
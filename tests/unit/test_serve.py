@@ -0,0 +1,360 @@
+import http.client
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from context import archstrap
+
+from archstrap.serve import (
+    HTTPServer,
+    JobError,
+    JobQueue,
+    Server,
+    write_token,
+)
+
+SPECIFICATION = {
+    "system": {
+        "timezone": "UTC",
+        "locale": "en_US.UTF-8",
+        "charset": "UTF-8",
+        "keymap": "us",
+        "hostname": "host",
+        "root_password": "password",
+    },
+}
+
+
+def request(connection, method, path, body=None, headers={}):
+    try:
+        connection.request(
+            method,
+            path,
+            body=json.dumps(body) if body is not None else None,
+            headers=headers,
+        )
+        response = connection.getresponse()
+        data = response.read().decode("utf-8")
+    finally:
+        connection.close()
+    if response.getheader("Content-Type") == "application/json":
+        data = json.loads(data)
+    return response.status, data
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.log_dir = os.path.join(self.dir, "jobs")
+
+        self.spec_path = os.path.join(self.dir, "spec.json")
+        with open(self.spec_path, "w") as f:
+            json.dump(SPECIFICATION, f)
+
+        self.queue = JobQueue(self.log_dir, 2, "shell")
+        self.addCleanup(self.queue.shutdown)
+
+    def root(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def test_submit(self):
+        job = self.queue.submit({
+            "specification": self.spec_path,
+            "install_root": self.root("a"),
+            "name": "a",
+        })
+        job.future.result()
+
+        self.assertEqual("succeeded", job.state)
+        self.assertIs(job, self.queue.job(job.id))
+        self.assertEqual("a", job.to_json(self.log_dir)["name"])
+        with open(job.target.output_path(self.log_dir)) as f:
+            self.assertIn("pacstrap", f.read())
+
+    def test_submit_inline(self):
+        job = self.queue.submit({
+            "specification": SPECIFICATION,
+            "install_root": self.root("a"),
+            "mode": "dryrun",
+        })
+        job.future.result()
+
+        self.assertEqual("succeeded", job.state)
+        self.assertEqual("dryrun", job.mode_name)
+        with open(job.target.specification) as f:
+            self.assertDictEqual(SPECIFICATION, json.load(f))
+
+    def test_submit_invalid(self):
+        for request in [
+            {"specification": self.spec_path},
+            {"install_root": self.root("a")},
+            {
+                "specification": self.spec_path,
+                "install_root": self.root("a"),
+                "mode": "bogus",
+            },
+            {
+                "specification": self.spec_path,
+                "install_root": self.root("a"),
+                "jobs": "4",
+            },
+            {
+                "specification": {"system": {}},
+                "install_root": self.root("a"),
+            },
+        ]:
+            with self.assertRaises(JobError) as context:
+                self.queue.submit(request)
+            self.assertEqual(400, context.exception.status)
+        self.assertListEqual([], self.queue.list())
+
+    def test_submit_conflict(self):
+        request = {
+            "specification": self.spec_path,
+            "install_root": self.root("a"),
+        }
+        job = self.queue.submit(request)
+        if job.active:
+            with self.assertRaises(JobError) as context:
+                self.queue.submit({
+                    **request,
+                    "install_root": job.target.install_root + "/",
+                })
+            self.assertEqual(409, context.exception.status)
+        job.future.result()
+
+        self.assertTrue(self.queue.submit(request).future.result().ok)
+
+    def test_job_unknown(self):
+        with self.assertRaises(JobError) as context:
+            self.queue.job("unknown")
+        self.assertEqual(404, context.exception.status)
+
+    def test_follow(self):
+        job = self.queue.submit({
+            "specification": self.spec_path,
+            "install_root": self.root("a"),
+        })
+        lines = list(self.queue.follow(job.id))
+
+        self.assertFalse(job.active)
+        self.assertTrue(lines)
+        self.assertTrue(all(line.endswith("\n") for line in lines))
+
+    def test_follow_command_output(self):
+        # A pacstrap that fails the way a missing package does.
+        bin_dir = os.path.join(self.dir, "bin")
+        os.makedirs(bin_dir)
+        pacstrap = os.path.join(bin_dir, "pacstrap")
+        with open(pacstrap, "w") as f:
+            f.write("#!/bin/sh\necho 'error: target not found: bogus' >&2\n")
+            f.write("exit 1\n")
+        os.chmod(pacstrap, 0o755)
+
+        # The workers start with the queue, and inherit its environment.
+        path = f"{bin_dir}:{os.environ.get('PATH', '')}"
+        with patch.dict(os.environ, {"PATH": path}):
+            queue = JobQueue(os.path.join(self.dir, "exec"), 1, "exec")
+        self.addCleanup(queue.shutdown)
+        job = queue.submit({
+            "specification": self.spec_path,
+            "install_root": self.root("a"),
+        })
+        lines = list(queue.follow(job.id))
+
+        self.assertEqual("failed", job.state)
+        self.assertIn("error: target not found: bogus\n", lines)
+
+
+class KeepJobsTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.log_dir = os.path.join(self.dir, "jobs")
+
+        self.queue = JobQueue(self.log_dir, 1, "shell", keep_jobs=2)
+        self.addCleanup(self.queue.shutdown)
+
+    def test_keep_jobs(self):
+        jobs = []
+        for name in ("a", "b", "c"):
+            job = self.queue.submit({
+                "specification": SPECIFICATION,
+                "install_root": os.path.join(self.dir, name),
+            })
+            job.future.result()
+            jobs.append(job)
+        # The callback that forgets jobs may run after result() returns.
+        log_path = jobs[0].target.log_path(self.log_dir)
+        deadline = time.monotonic() + 5
+        while os.path.exists(log_path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(
+            [job.id for job in jobs[1:]],
+            [job.id for job in self.queue.list()],
+        )
+        with self.assertRaises(JobError):
+            self.queue.job(jobs[0].id)
+        self.assertFalse(os.path.exists(log_path))
+        self.assertFalse(os.path.exists(jobs[0].target.specification))
+        self.assertTrue(os.path.exists(jobs[1].target.log_path(self.log_dir)))
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.socket_path = os.path.join(self.dir, "archstrap.sock")
+
+        self.queue = JobQueue(os.path.join(self.dir, "jobs"), 1, "shell")
+        self.addCleanup(self.queue.shutdown)
+        self.server = Server(self.socket_path, self.queue)
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, method, path, body=None):
+        return request(UnixConnection(self.socket_path), method, path, body)
+
+    def test_socket_mode(self):
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+
+    def test_socket_in_use(self):
+        with self.assertRaises(FileExistsError):
+            Server(self.socket_path, self.queue)
+        self.assertTrue(stat.S_ISSOCK(os.lstat(self.socket_path).st_mode))
+
+    def test_socket_stale(self):
+        path = os.path.join(self.dir, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(path)
+        server = Server(path, self.queue)
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_socket_not_a_socket(self):
+        path = os.path.join(self.dir, "file")
+        with open(path, "w") as f:
+            f.write("data")
+        with self.assertRaises(FileExistsError):
+            Server(path, self.queue)
+        with open(path) as f:
+            self.assertEqual("data", f.read())
+
+    def test_jobs(self):
+        status, job = self.request(
+            "POST",
+            "/jobs",
+            {
+                "specification": SPECIFICATION,
+                "install_root": os.path.join(self.dir, "root"),
+                "name": "root",
+            },
+        )
+        self.assertEqual(201, status)
+        self.assertEqual("root", job["name"])
+
+        status, log = self.request("GET", f"/jobs/{job['id']}/log")
+        self.assertEqual(200, status)
+        self.assertTrue(log)
+
+        status, job = self.request("GET", f"/jobs/{job['id']}")
+        self.assertEqual(200, status)
+        self.assertEqual("succeeded", job["state"])
+
+        status, jobs = self.request("GET", "/jobs")
+        self.assertEqual(200, status)
+        self.assertListEqual([job["id"]], [job["id"] for job in jobs])
+
+        status, job = self.request("DELETE", f"/jobs/{job['id']}")
+        self.assertEqual(200, status)
+        self.assertEqual("succeeded", job["state"])
+
+    def test_errors(self):
+        status, error = self.request("POST", "/jobs", ["not", "an", "object"])
+        self.assertEqual(400, status)
+        self.assertIn("error", error)
+
+        status, _ = self.request("GET", "/jobs/unknown")
+        self.assertEqual(404, status)
+
+        status, _ = self.request("GET", "/jobs/unknown/log")
+        self.assertEqual(404, status)
+
+        status, _ = self.request("GET", "/other")
+        self.assertEqual(404, status)
+
+        status, _ = self.request("PUT", "/jobs")
+        self.assertEqual(501, status)
+
+
+class HTTPServerTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+
+        self.queue = JobQueue(os.path.join(self.dir, "jobs"), 1, "shell")
+        self.addCleanup(self.queue.shutdown)
+        self.server = HTTPServer(("127.0.0.1", 0), self.queue, "token")
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, headers):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        return request(connection, "GET", "/jobs", headers=headers)
+
+    def test_token(self):
+        self.assertEqual(
+            (200, []),
+            self.request({"Authorization": "Bearer token"}),
+        )
+
+    def test_token_missing(self):
+        for headers in [
+            {},
+            {"Authorization": "Bearer wrong"},
+            {"Authorization": "Basic token"},
+        ]:
+            status, error = self.request(headers)
+            self.assertEqual(401, status)
+            self.assertIn("error", error)
+
+    def test_write_token(self):
+        path = os.path.join(self.dir, "token")
+        with open(path, "w") as f:
+            f.write("old")
+        os.chmod(path, 0o644)
+
+        token = write_token(path)
+
+        with open(path) as f:
+            self.assertEqual(f"{token}\n", f.read())
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+        self.assertNotEqual(token, write_token(path))
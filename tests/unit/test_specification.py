@@ -1,17 +1,174 @@
+import os
+import shlex
+import subprocess
+import tempfile
+import time
 import unittest
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
 from context import archstrap
 
+from archstrap import fastio
+from archstrap.bundle import render_pacman_conf as render_bundle_pacman_conf
+from archstrap.cache import touch_command
+from archstrap.command import Command
+from archstrap.initrd import BenchmarkCache, BenchResult
 from archstrap.specification import (
     InitrdSpecification,
+    MirrorSpecification,
     PackageSpecification,
     Specification,
     SystemSpecification,
-    make_specification,
 )
 
 
+class MirrorSpecificationTest(unittest.TestCase):
+    def test_rank_argv(self):
+        spec = MirrorSpecification(
+            ["b", "a"],
+            repositories=["extra"],
+            ttl=60,
+            probe_timeout=2.5,
+            ranking_cache="mirrors.json",
+        )
+
+        self.assertListEqual(
+            [
+                "archstrap",
+                "rank-mirrors",
+                "--output=mirrorlist",
+                "--repository=extra",
+                "--architecture=x86_64",
+                "--timeout=2.5",
+                "--ttl=60",
+                "--ranking-cache=mirrors.json",
+                "--",
+                "b",
+                "a",
+            ],
+            spec.rank_argv("mirrorlist"),
+        )
+
+    @patch("archstrap.specification.mirrors.rank")
+    def test_apply_rank(self, rank):
+        mode = MagicMock()
+
+        spec = MirrorSpecification(["server"])
+        spec.apply("install_root", mode)
+        spec.install("install_root", mode)
+
+        # Mirrors are ranked when the install runs, not while it is planned.
+        rank.assert_not_called()
+        self.assertIn(
+            call(
+                Command(spec.rank_argv("install_root/.archstrap/mirrorlist")),
+                reads=["install_root/.archstrap"],
+                writes=["install_root/.archstrap/mirrorlist"],
+            ),
+            mode.on_command.call_args_list,
+        )
+        self.assertIn(
+            call(
+                Command([
+                    "cp",
+                    "install_root/.archstrap/mirrorlist",
+                    "install_root/etc/pacman.d/mirrorlist",
+                ]),
+                reads=["install_root", "install_root/.archstrap/mirrorlist"],
+                writes=["install_root/etc/pacman.d/mirrorlist"],
+            ),
+            mode.on_command.call_args_list,
+        )
+
+    def test_apply(self):
+        mode = MagicMock()
+
+        spec = MirrorSpecification(
+            ["https://mirror/$repo/os/$arch"],
+            parallel_downloads=3,
+            repositories=["core"],
+            rank=False,
+        )
+        spec.apply("install_root", mode)
+
+        mode.on_section.assert_called_once_with("Configure Mirrors")
+        mode.on_command.assert_has_calls([
+            call(
+                Command(["mkdir", "-p", "install_root/.archstrap"]),
+                writes=["install_root/.archstrap"],
+            ),
+            call(
+                Command.write(
+                    "install_root/.archstrap/mirrorlist",
+                    [
+                        "# Generated by archstrap",
+                        "Server = https://mirror/$repo/os/$arch",
+                    ],
+                ),
+                reads=["install_root/.archstrap"],
+                writes=["install_root/.archstrap/mirrorlist"],
+            ),
+            call(
+                Command.write("install_root/.archstrap/pacman.conf", [
+                    "[options]",
+                    "HoldPkg = pacman glibc",
+                    "Architecture = auto",
+                    "CheckSpace",
+                    "ParallelDownloads = 3",
+                    "SigLevel = Required DatabaseOptional",
+                    "LocalFileSigLevel = Optional",
+                    "",
+                    "[core]",
+                    "Include = install_root/.archstrap/mirrorlist",
+                ]),
+                reads=["install_root/.archstrap"],
+                writes=["install_root/.archstrap/pacman.conf"],
+            ),
+        ])
+
+    def test_install(self):
+        mode = MagicMock()
+
+        spec = MirrorSpecification(["server"], repositories=[], rank=False)
+        spec.install("install_root", mode)
+
+        mode.on_command.assert_has_calls([
+            call(
+                Command.write(
+                    "install_root/etc/pacman.d/mirrorlist",
+                    ["# Generated by archstrap", "Server = server"],
+                ),
+                reads=["install_root"],
+                writes=["install_root/etc/pacman.d/mirrorlist"],
+            ),
+            call(
+                Command.write("install_root/etc/pacman.conf", [
+                    "[options]",
+                    "HoldPkg = pacman glibc",
+                    "Architecture = auto",
+                    "CheckSpace",
+                    "ParallelDownloads = 5",
+                    "SigLevel = Required DatabaseOptional",
+                    "LocalFileSigLevel = Optional",
+                ]),
+                reads=["install_root"],
+                writes=["install_root/etc/pacman.conf"],
+            ),
+            call(
+                Command([
+                    "rm",
+                    "-f",
+                    "install_root/.archstrap/pacman.conf",
+                    "install_root/.archstrap/mirrorlist",
+                ]),
+                writes=[
+                    "install_root/.archstrap/pacman.conf",
+                    "install_root/.archstrap/mirrorlist",
+                ],
+            ),
+        ])
+
+
 class PackageSpecificationTest(unittest.TestCase):
     def test_package_list(self):
         self.assertListEqual(
@@ -40,6 +197,27 @@ class PackageSpecificationTest(unittest.TestCase):
             ["base", "linux", "linux-headers", "linux-firmware"],
             list(PackageSpecification().packages()),
         )
+        self.assertListEqual(
+            ["linux", "linux-headers", "linux-lts", "linux-lts-headers"],
+            list(
+                PackageSpecification(
+                    base=None,
+                    firmware=None,
+                    kernels=["linux", "linux-lts"],
+                ).packages()
+            ),
+        )
+
+    def test_kernel_packages(self):
+        self.assertListEqual(["linux"], PackageSpecification().kernel_packages())
+        self.assertListEqual(
+            [],
+            PackageSpecification(kernel=None).kernel_packages(),
+        )
+        self.assertListEqual(
+            ["linux-lts"],
+            PackageSpecification(kernels=["linux-lts"]).kernel_packages(),
+        )
 
     def test_apply(self):
         mode = MagicMock()
@@ -50,7 +228,245 @@ class PackageSpecificationTest(unittest.TestCase):
         mode.on_section.assert_called_once_with("Install Packages")
         mode.on_command.assert_has_calls([
             call(
-                "pacstrap install_root base kernel kernel-headers firmware extra"
+                Command([
+                    "pacstrap",
+                    "install_root",
+                    "base",
+                    "kernel",
+                    "kernel-headers",
+                    "firmware",
+                    "extra",
+                ]),
+                reads=[],
+                writes=["install_root"],
+            ),
+        ])
+
+    def test_apply_fast_io(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification("base", None, None)
+        spec.apply("install_root", mode, fast_io=True)
+
+        mode.on_command.assert_called_once_with(
+            Command(["pacstrap", "install_root", "base"], fastio.environment()),
+            reads=["install_root/.archstrap/eatmydata/libeatmydata.so"],
+            writes=["install_root"],
+        )
+
+    def test_apply_cache(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification(
+            "base",
+            "kernel",
+            "firmware",
+            ["extra"],
+            cache="cache",
+        )
+        spec.apply("install_root", mode)
+
+        mode.on_command.assert_has_calls([
+            call(Command(["mkdir", "-p", "cache"]), writes=["cache"]),
+            call(
+                Command([
+                    "flock",
+                    "--shared",
+                    "cache/.archstrap.lock",
+                    "sh",
+                    "-c",
+                    " ".join([
+                        "pacstrap -c install_root base kernel kernel-headers",
+                        "firmware extra --cachedir=cache &&",
+                        shlex.join(touch_command("cache", "install_root")),
+                    ]),
+                ]),
+                reads=["cache"],
+                writes=["install_root"],
+            ),
+        ])
+
+    def test_apply_bundle(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification(
+            "base",
+            None,
+            None,
+            bundle="/packages.bundle",
+        )
+        spec.apply("install_root", mode)
+
+        pacman_conf = "install_root/.archstrap/bundle-pacman.conf"
+        mode.on_command.assert_has_calls([
+            call(
+                Command(["mkdir", "-p", "install_root/.archstrap"]),
+                writes=["install_root/.archstrap"],
+            ),
+            call(
+                Command.write(
+                    pacman_conf,
+                    render_bundle_pacman_conf(
+                        "/packages.bundle",
+                        ["archstrap", "bundle-fetch"],
+                    ),
+                ),
+                reads=["install_root/.archstrap"],
+                writes=[pacman_conf],
+            ),
+            call(
+                Command([
+                    "pacstrap",
+                    "-C",
+                    pacman_conf,
+                    "install_root",
+                    "base",
+                ]),
+                reads=[pacman_conf, "/packages.bundle"],
+                writes=["install_root"],
+            ),
+            call(Command(["rm", "-f", pacman_conf]), writes=[pacman_conf]),
+        ])
+
+    def test_apply_bundle_fetch(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification(bundle="/packages.bundle")
+        spec.bundle_fetch = ["/usr/bin/python3", "archstrap", "bundle-fetch"]
+        spec.apply("install_root", mode)
+
+        self.assertEqual(
+            Command.write(
+                "install_root/.archstrap/bundle-pacman.conf",
+                render_bundle_pacman_conf(
+                    "/packages.bundle",
+                    ["/usr/bin/python3", "archstrap", "bundle-fetch"],
+                ),
+            ),
+            mode.on_command.call_args_list[1][0][0],
+        )
+
+    def test_golden_image(self):
+        first = PackageSpecification(extra=["a", "b"], golden="golden")
+        second = PackageSpecification(extra=["b", "a"], golden="golden")
+        third = PackageSpecification(extra=["c"], golden="golden")
+
+        self.assertEqual(first.golden_image(), second.golden_image())
+        self.assertNotEqual(first.golden_image(), third.golden_image())
+        self.assertEqual("golden", os.path.dirname(first.golden_image()))
+
+    def test_apply_golden(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification(
+            "base",
+            None,
+            None,
+            golden="golden",
+        )
+        image = spec.golden_image()
+        spec.apply("install_root", mode)
+
+        mode.on_command.assert_has_calls([
+            call(Command(["mkdir", "-p", "golden"]), writes=["golden"]),
+            call(
+                Command([
+                    "flock",
+                    f"{image}.lock",
+                    "sh",
+                    "-c",
+                    " ".join([
+                        f'[ -n "$(find {image} -maxdepth 0 -mmin -1440',
+                        '2>/dev/null)" ] || {',
+                        f"rm -rf {image}.partial &&",
+                        f"mkdir {image}.partial &&",
+                        f"pacstrap {image}.partial base &&",
+                        f"touch {image}.partial &&",
+                        f"rm -rf {image} &&",
+                        f"mv -T {image}.partial {image}; }}",
+                    ]),
+                ]),
+                reads=["golden"],
+                writes=[image],
+            ),
+            call(
+                Command([
+                    "flock",
+                    "--shared",
+                    f"{image}.lock",
+                    "cp",
+                    "-a",
+                    "--reflink=auto",
+                    f"{image}/.",
+                    "install_root",
+                ]),
+                reads=[image],
+                writes=["install_root"],
+            ),
+            call(
+                Command(["rm", "-f", "install_root/etc/machine-id"]),
+                reads=["install_root"],
+                writes=["install_root/etc/machine-id"],
+            ),
+        ])
+
+    def test_apply_golden_no_max_age(self):
+        mode = MagicMock()
+
+        spec = PackageSpecification(golden="golden", golden_max_age=None)
+        image = spec.golden_image()
+        spec.apply("install_root", mode)
+
+        script = mode.on_command.call_args_list[1][0][0].argv[-1]
+        self.assertTrue(script.startswith(f"[ -d {image} ] || {{"))
+
+    def test_golden_image_rebuild(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spec = PackageSpecification(
+                golden=temp_dir,
+                golden_max_age=120,
+            )
+            image = spec.golden_image()
+            os.makedirs(os.path.join(image, "old"))
+            mode = MagicMock()
+            spec.apply("install_root", mode, fast_io=False)
+            argv = mode.on_command.call_args_list[1][0][0].argv
+            # Stand in for pacstrap.
+            script = argv[-1].replace("pacstrap", "true")
+
+            subprocess.run(["sh", "-c", script], check=True)
+            self.assertTrue(os.path.exists(os.path.join(image, "old")))
+
+            stale = time.time() - 300
+            os.utime(image, (stale, stale))
+            subprocess.run(["sh", "-c", script], check=True)
+            self.assertFalse(os.path.exists(os.path.join(image, "old")))
+            self.assertTrue(os.path.isdir(image))
+
+    def test_apply_mirrors(self):
+        mode = MagicMock()
+        mirrors = MirrorSpecification(["server"], rank=False)
+
+        spec = PackageSpecification(firmware=None)
+        spec.apply("install_root", mode, mirrors)
+
+        mode.on_command.assert_has_calls([
+            call(
+                Command([
+                    "pacstrap",
+                    "-C",
+                    "install_root/.archstrap/pacman.conf",
+                    "-M",
+                    "install_root",
+                    "base",
+                    "linux",
+                    "linux-headers",
+                ]),
+                reads=[
+                    "install_root/.archstrap/pacman.conf",
+                    "install_root/.archstrap/mirrorlist",
+                ],
+                writes=["install_root"],
             ),
         ])
 
@@ -72,7 +488,7 @@ class SystemSpecificationTest(unittest.TestCase):
         mode.on_section.assert_called_once_with("Configure System")
         mode.on_command.assert_has_calls([
             call(
-                " ".join([
+                Command([
                     "systemd-firstboot",
                     "--setup-machine-id",
                     "--timezone=timezone",
@@ -81,19 +497,40 @@ class SystemSpecificationTest(unittest.TestCase):
                     "--hostname=hostname",
                     "--root=install_root",
                     "--root-password=root_password",
-                ])
+                ]),
+                reads=["install_root"],
+                writes=[
+                    "install_root/etc/machine-id",
+                    "install_root/etc/localtime",
+                    "install_root/etc/locale.conf",
+                    "install_root/etc/vconsole.conf",
+                    "install_root/etc/hostname",
+                    "install_root/etc/shadow",
+                ],
+            ),
+            call(
+                Command(["hwclock", "--systohc"], chroot="install_root"),
+                reads=["install_root"],
+                writes=["install_root/etc/adjtime"],
+            ),
+            call(
+                Command.write("install_root/etc/locale.gen", ["locale charset"]),
+                reads=["install_root"],
+                writes=["install_root/etc/locale.gen"],
+            ),
+            call(
+                Command(["locale-gen"], chroot="install_root"),
+                reads=["install_root", "install_root/etc/locale.gen"],
+                writes=["install_root/usr/lib/locale/locale-archive"],
             ),
-            call("arch-chroot install_root hwclock --systohc"),
-            call("echo locale charset > install_root/etc/locale.gen"),
-            call("arch-chroot install_root locale-gen"),
             call(
-                "\n".join([
-                    "cat > install_root/etc/hosts <<EOF",
+                Command.write("install_root/etc/hosts", [
                     "127.0.0.1 localhost",
                     "::1       localhost",
                     "127.0.1.1 hostname.localdomain hostname",
-                    "EOF",
                 ]),
+                reads=["install_root"],
+                writes=["install_root/etc/hosts"],
             ),
         ])
 
@@ -110,7 +547,11 @@ class SystemSpecificationTest(unittest.TestCase):
         spec.apply("install_root", mode)
 
         mode.on_command.assert_has_calls([
-            call("arch-chroot install_root passwd")
+            call(
+                Command(["passwd"], chroot="install_root", interactive=True),
+                reads=["install_root"],
+                writes=["install_root/etc/shadow"],
+            )
         ])
 
 
@@ -131,29 +572,134 @@ class InitrdSpecificationTest(unittest.TestCase):
         mode.on_section.assert_called_once_with("Create Initramfs")
         mode.on_command.assert_has_calls([
             call(
-                "\n".join([
-                    "cat > install_root/etc/mkinitcpio.conf <<EOF",
+                Command.write("install_root/etc/mkinitcpio.conf", [
                     "MODULES=(modules)",
                     "BINARIES=(binaries)",
                     "FILES=(files)",
                     "HOOKS=(hooks)",
                     "COMPRESSION=\"compression\"",
                     "COMPRESSION_OPTIONS=(compression_options)",
-                    "EOF",
                 ]),
+                reads=["install_root"],
+                writes=["install_root/etc/mkinitcpio.conf"],
             ),
             call(
-                "kernel=\"$(find install_root/lib/modules -mindepth 1 -maxdepth 1 -type d | xargs basename)\""
-            ),
-            call(
-                "arch-chroot install_root mkinitcpio −−allpresets --kernel=\"$kernel\" --generate /boot/initramfs-linux-fallback.img"
+                Command(
+                    [
+                        "mkinitcpio",
+                        "--kernel",
+                        "/boot/vmlinuz-linux",
+                        "--generate",
+                        "/boot/initramfs-linux-fallback.img",
+                        "--skiphooks",
+                        "autodetect",
+                    ],
+                    chroot="install_root",
+                ),
+                reads=[
+                    "install_root",
+                    "install_root/boot/vmlinuz-linux",
+                    "install_root/etc/mkinitcpio.conf",
+                    "install_root/etc/vconsole.conf",
+                ],
+                writes=["install_root/boot/initramfs-linux-fallback.img"],
             ),
         ])
 
+    def test_apply_fast_io(self):
+        mode = MagicMock()
+
+        spec = InitrdSpecification()
+        spec.apply("install_root", mode, fast_io=True)
+
+        mkinitcpio = mode.on_command.call_args_list[1]
+        self.assertEqual(fastio.environment(), mkinitcpio.args[0].env)
+        self.assertIn(
+            "install_root/.archstrap/eatmydata/libeatmydata.so",
+            mkinitcpio.kwargs["reads"],
+        )
+
+    def test_apply_kernels(self):
+        mode = MagicMock()
+
+        spec = InitrdSpecification(presets=["default", "fallback"])
+        spec.apply("install_root", mode, ["linux", "linux-lts"])
+
+        images = [
+            command.args[0].argv[4]
+            for command in mode.on_command.call_args_list[1:]
+        ]
+        self.assertEqual(
+            [
+                "/boot/initramfs-linux.img",
+                "/boot/initramfs-linux-fallback.img",
+                "/boot/initramfs-linux-lts.img",
+                "/boot/initramfs-linux-lts-fallback.img",
+            ],
+            images,
+        )
+        self.assertEqual(
+            ["install_root/boot/initramfs-linux-lts.img"],
+            mode.on_command.call_args_list[3].kwargs["writes"],
+        )
+
+    def test_presets(self):
+        with self.assertRaises(ValueError):
+            InitrdSpecification(presets=["custom"])
+
+    def test_compression_auto(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, "initrd.json")
+            spec = InitrdSpecification(
+                compression="auto",
+                compression_goal="size",
+                benchmark_cache=cache_path,
+            )
+            self.assertEqual(
+                ("xz", ["-T0", "-9"]),
+                spec.resolved_compression(),
+            )
+
+            cache = BenchmarkCache(cache_path)
+            cache.save(
+                "6.1.1-arch1-1",
+                [
+                    BenchResult("zstd", ["-T0", "-19"], 9.0, 100, 0.2),
+                    BenchResult("lz4", [], 1.0, 200, 0.1),
+                ],
+                "linux",
+            )
+            cache.save(
+                "6.1.2-lts1-1",
+                [BenchResult("gzip", ["-9"], 1.0, 300, 0.3)],
+                "linux-lts",
+            )
+            self.assertEqual(
+                ("zstd", ["-T0", "-19"]),
+                spec.resolved_compression(["linux", "linux-lts"]),
+            )
+            self.assertEqual(
+                ("gzip", ["-9"]),
+                spec.resolved_compression(["linux-lts", "linux"]),
+            )
+            # Kernels that were never benchmarked use the latest results.
+            self.assertEqual(
+                ("gzip", ["-9"]),
+                spec.resolved_compression(["linux-zen"]),
+            )
+            self.assertIn(
+                "COMPRESSION_OPTIONS=(-T0 -19)",
+                spec.config(["linux"]),
+            )
+
+    def test_compression_goal(self):
+        with self.assertRaises(ValueError):
+            InitrdSpecification(compression_goal="fast")
+
 
 class SpecificationTest(unittest.TestCase):
     def test_apply(self):
-        packages = MagicMock()
+        packages = MagicMock(bundle=None)
         system = MagicMock()
         initrd = MagicMock()
         mode = MagicMock()
@@ -162,7 +708,102 @@ class SpecificationTest(unittest.TestCase):
         spec.apply("install_root", mode)
 
         mode.on_begin.assert_called_once_with()
-        packages.apply.assert_called_once_with("install_root", mode)
-        system.apply.assert_called_once_with("install_root", mode)
-        initrd.apply.assert_called_once_with("install_root", mode)
+        packages.apply.assert_called_once_with(
+            "install_root",
+            ANY,
+            None,
+            fast_io=False,
+        )
+        system.apply.assert_called_once_with("install_root", ANY)
+        initrd.apply.assert_called_once_with(
+            "install_root",
+            ANY,
+            packages.kernel_packages.return_value,
+            fast_io=False,
+        )
         mode.on_end.assert_called_once_with()
+        mode.on_section.assert_not_called()
+        mode.on_command.assert_not_called()
+
+    def test_apply_unsafe_fast_io(self):
+        packages = MagicMock()
+        initrd = MagicMock()
+        mode = MagicMock()
+
+        spec = Specification(packages, MagicMock(), initrd)
+        spec.unsafe_fast_io = True
+        spec.apply("install_root", mode)
+
+        packages.apply.assert_called_once_with(
+            "install_root",
+            ANY,
+            None,
+            fast_io=True,
+        )
+        self.assertTrue(initrd.apply.call_args.kwargs["fast_io"])
+        self.assertListEqual(
+            [call("Disable Fsync"), call("Sync"), call("Clean Up")],
+            mode.on_section.call_args_list,
+        )
+        self.assertListEqual(
+            [
+                call(
+                    Command(["sync", "--file-system", "install_root"]),
+                    reads=[],
+                    writes=[],
+                ),
+                call(
+                    Command(
+                        [
+                            "rmdir",
+                            "--ignore-fail-on-non-empty",
+                            "install_root/.archstrap",
+                        ]
+                    ),
+                    reads=[],
+                    writes=[],
+                ),
+            ],
+            mode.on_command.call_args_list[-2:],
+        )
+
+    def test_apply_plan(self):
+        packages = MagicMock(bundle=None)
+        mkdir = Command(["mkdir", "-p", "cache"])
+        packages.apply.side_effect = lambda root, mode, mirrors, fast_io: (
+            mode.on_section("packages"),
+            mode.on_command(mkdir, writes=["cache"]),
+            mode.on_command(mkdir, writes=["cache"]),
+        )
+        mode = MagicMock()
+
+        spec = Specification(packages, MagicMock(), MagicMock())
+        spec.apply("install_root", mode)
+        mode.on_section.assert_called_once_with("packages")
+        mode.on_command.assert_called_once_with(
+            mkdir,
+            reads=[],
+            writes=["cache"],
+        )
+
+        mode.reset_mock()
+        spec.apply("install_root", mode, optimize=False)
+        self.assertEqual(2, mode.on_command.call_count)
+
+    def test_use_command(self):
+        spec = Specification(
+            PackageSpecification(),
+            MagicMock(),
+            MagicMock(),
+            MirrorSpecification(["server"]),
+        )
+        spec.use_command(["python3", "archstrap.pyz"])
+
+        self.assertListEqual(
+            ["python3", "archstrap.pyz", "bundle-fetch"],
+            spec.packages.bundle_fetch,
+        )
+        self.assertListEqual(
+            ["python3", "archstrap.pyz", "rank-mirrors"],
+            spec.mirrors.rank_command,
+        )
@@ -0,0 +1,196 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap.syncdb import (
+    SyncIndex,
+    build_index,
+    dependency_name,
+    find_databases,
+    open_index,
+    preflight,
+    read_database,
+    resolve,
+)
+
+
+def make_database(path, packages):
+    """
+    Write a sync database of {name: fields} packages, where fields maps desc
+    field names (e.g. "DEPENDS") to lists of values.
+    """
+    with tarfile.open(path, "w:gz") as tar:
+        for name, fields in packages.items():
+            fields = {"NAME": [name], "VERSION": ["1-1"], **fields}
+            content = "".join(
+                f"%{key}%\n" + "".join(f"{value}\n" for value in values) + "\n"
+                for key, values in fields.items()
+            ).encode("utf-8")
+            info = tarfile.TarInfo(f"{name}-1-1/desc")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+CORE = {
+    "base": {
+        "DEPENDS": ["bash", "glibc>=2.38"],
+        "CSIZE": ["2048"],
+        "ISIZE": ["4096"],
+    },
+    "bash": {
+        "DEPENDS": ["glibc", "readline"],
+        "PROVIDES": ["sh"],
+        "CSIZE": ["1024"],
+        "ISIZE": ["8192"],
+    },
+    "glibc": {
+        "CSIZE": ["4096"],
+        "ISIZE": ["16384"],
+    },
+    "readline": {
+        "DEPENDS": ["ncurses"],
+        "GROUPS": ["libs"],
+    },
+}
+
+EXTRA = {
+    "vim": {
+        "DEPENDS": ["glibc", "gpm"],
+        "GROUPS": ["editors"],
+    },
+    "nano": {
+        "DEPENDS": ["sh"],
+        "GROUPS": ["editors"],
+    },
+    "glibc": {
+        "CSIZE": ["1"],
+    },
+}
+
+
+class SyncDbTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.sync_dir = os.path.join(temp_dir.name, "sync")
+        self.index_dir = os.path.join(temp_dir.name, "index")
+        os.mkdir(self.sync_dir)
+        make_database(os.path.join(self.sync_dir, "core.db"), CORE)
+        make_database(os.path.join(self.sync_dir, "extra.db"), EXTRA)
+
+    def open_index(self):
+        index = open_index(find_databases(self.sync_dir), self.index_dir)
+        self.addCleanup(index.close)
+        return index
+
+    def test_dependency_name(self):
+        self.assertEqual("glibc", dependency_name("glibc>=2.38"))
+        self.assertEqual("sh", dependency_name("sh"))
+        self.assertEqual("python", dependency_name("python: for scripts"))
+
+    def test_read_database(self):
+        packages = read_database(os.path.join(self.sync_dir, "core.db"), "core")
+
+        bash = [package for package in packages if package.name == "bash"][0]
+        self.assertEqual("1-1", bash.version)
+        self.assertEqual("core", bash.repository)
+        self.assertEqual(1024, bash.download_size)
+        self.assertListEqual(["glibc", "readline"], bash.depends)
+        self.assertListEqual(["sh"], bash.provides)
+
+    def test_find_databases(self):
+        self.assertListEqual(
+            [
+                ("core", os.path.join(self.sync_dir, "core.db")),
+                ("extra", os.path.join(self.sync_dir, "extra.db")),
+            ],
+            find_databases(self.sync_dir),
+        )
+        with self.assertRaises(ValueError):
+            find_databases(self.sync_dir, ["core", "multilib"])
+
+    def test_lookup(self):
+        index = self.open_index()
+
+        self.assertEqual("core", index.package("glibc").repository)
+        self.assertIsNone(index.package("sh"))
+        self.assertListEqual(
+            ["bash"],
+            [package.name for package in index.providers("sh")],
+        )
+        self.assertListEqual(
+            ["nano", "vim"],
+            sorted(package.name for package in index.group("editors")),
+        )
+
+    def test_index_reused_until_database_changes(self):
+        databases = find_databases(self.sync_dir)
+        self.open_index()
+        index_path = os.path.join(self.index_dir, os.listdir(self.index_dir)[0])
+        mtime = os.stat(index_path).st_mtime_ns
+
+        self.open_index()
+        self.assertEqual(mtime, os.stat(index_path).st_mtime_ns)
+
+        make_database(databases[1][1], {"emacs": {}})
+        stat = os.stat(databases[1][1])
+        os.utime(databases[1][1], ns=(stat.st_atime_ns, mtime + 10**9))
+        index = self.open_index()
+        self.assertIsNotNone(index.package("emacs"))
+        self.assertIsNone(index.package("vim"))
+
+    def test_resolve(self):
+        resolution = resolve(self.open_index(), ["base", "editors"])
+
+        self.assertListEqual(
+            ["base", "vim", "nano", "bash", "glibc", "readline"],
+            list(resolution.packages),
+        )
+        self.assertListEqual(
+            [("gpm", "vim"), ("ncurses", "readline")],
+            resolution.missing,
+        )
+        self.assertEqual(2048 + 1024 + 4096, resolution.download_size)
+        self.assertEqual(4096 + 8192 + 16384, resolution.installed_size)
+
+    def test_resolve_missing(self):
+        resolution = resolve(self.open_index(), ["glibc", "vmi"])
+
+        self.assertListEqual(["glibc"], list(resolution.packages))
+        self.assertListEqual(
+            ["Package 'vmi' not found"],
+            resolution.errors(),
+        )
+
+    def test_preflight(self):
+        resolution = preflight(
+            ["bash"],
+            self.sync_dir,
+            ["core"],
+            self.index_dir,
+        )
+
+        self.assertListEqual(
+            ["bash", "glibc", "readline"],
+            list(resolution.packages),
+        )
+        self.assertListEqual(
+            ["Package 'ncurses' required by 'readline' not found"],
+            resolution.errors(),
+        )
+
+    def test_invalid_index(self):
+        path = os.path.join(self.index_dir, "invalid.idx")
+        os.makedirs(self.index_dir)
+        with open(path, "wb") as f:
+            f.write(b"not an index, but long enough to have a header" * 2)
+        with self.assertRaises(ValueError):
+            SyncIndex(path)
+
+        build_index(find_databases(self.sync_dir), path)
+        with SyncIndex(path) as index:
+            self.assertIsNotNone(index.package("vim"))
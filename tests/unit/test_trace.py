@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import unittest
+
+from context import archstrap
+
+from archstrap.trace import Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def test_span(self):
+        tracer = Tracer()
+        tracer.begin()
+        with tracer.span("command", section="section") as span:
+            span.cpu = 1.0
+            span.status = 0
+        tracer.end()
+
+        self.assertEqual(1, len(tracer.spans))
+        self.assertGreaterEqual(tracer.spans[0].end, tracer.spans[0].start)
+        self.assertGreaterEqual(tracer.run.end, tracer.spans[0].end)
+
+    def test_span_failure(self):
+        tracer = Tracer()
+        with self.assertRaises(RuntimeError):
+            with tracer.span("command"):
+                raise RuntimeError()
+
+        self.assertEqual("error", tracer.spans[0].status)
+
+    def test_sections(self):
+        tracer = Tracer()
+        tracer.begin()
+        for name, section, status in [
+            ("a", "first", 0),
+            ("b", "first", 1),
+            ("c", "second", "skipped"),
+        ]:
+            with tracer.span(name, section=section) as span:
+                span.cpu = 1.0
+                span.status = status
+
+        sections = tracer.sections()
+
+        self.assertListEqual(["first", "second"], [s.name for s in sections])
+        self.assertEqual(tracer.spans[0].start, sections[0].start)
+        self.assertEqual(tracer.spans[1].end, sections[0].end)
+        self.assertEqual(2.0, sections[0].cpu)
+        self.assertEqual(1, sections[0].status)
+        self.assertEqual(0, sections[1].status)
+
+    def test_write(self):
+        tracer = Tracer()
+        tracer.begin()
+        with tracer.span("command", section="section") as span:
+            span.status = 0
+        tracer.end()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "trace.json")
+            tracer.write(path)
+            with open(path, "r") as f:
+                trace = json.load(f)
+
+        events = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        self.assertListEqual(
+            [("run", "run"), ("section", "section"), ("command", "command")],
+            [(e["name"], e["cat"]) for e in events],
+        )
+        self.assertTrue(all(e["tid"] == 0 for e in events))
+        self.assertEqual(0, events[2]["args"]["status"])
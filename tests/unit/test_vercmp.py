@@ -0,0 +1,45 @@
+import unittest
+
+from context import archstrap
+
+from archstrap.vercmp import vercmp, version_key
+
+
+class VercmpTest(unittest.TestCase):
+    def test_vercmp(self):
+        # Pairs of versions from pacman's own vercmp tests, older first.
+        for older, newer in [
+            ("1.5.0", "1.5.1"),
+            ("1.5.1", "1.5.10"),
+            ("1.5.9", "1.5.10"),
+            ("1.0alpha", "1.0"),
+            ("1.0a", "1.0.a"),
+            ("1.0.a", "1.0.1"),
+            ("1.0rc", "1.0"),
+            ("1.0", "1.0.a"),
+            ("1.5-1", "1.5-2"),
+            ("1.5-2", "1.5.1-1"),
+            ("1:1.0-1", "2:0.1-1"),
+            ("1.0-1", "1:0.1-1"),
+            ("6.9.12-arch1-1", "6.10.2-arch1-1"),
+        ]:
+            with self.subTest(older=older, newer=newer):
+                self.assertLess(vercmp(older, newer), 0)
+                self.assertGreater(vercmp(newer, older), 0)
+
+    def test_vercmp_equal(self):
+        for a, b in [
+            ("1.5.0", "1.5.0"),
+            ("1.5-1", "1.5"),
+            ("0:1.5-1", "1.5-1"),
+            ("1.05", "1.5"),
+            ("1.0_1", "1.0.1"),
+        ]:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(0, vercmp(a, b))
+
+    def test_version_key(self):
+        self.assertEqual(
+            ["6.1.1", "6.9.12", "6.10.2"],
+            sorted(["6.10.2", "6.1.1", "6.9.12"], key=version_key),
+        )